@@ -0,0 +1,169 @@
+"""
+🚪 МИШУРА - Admission Control
+Отсечение нагрузки до начала работы, а не после таймаута Gemini
+
+Давление (pressure) - максимум из нормированных сигналов:
+- очередь лимитера Gemini: заполненность / ADMISSION_QUEUE_RATIO
+- пул обработки изображений: измеренное ожидание задач в очереди / ADMISSION_IMAGE_WAIT_MS
+  (а не заполненность очереди: всплеск, который пул быстро разбирает, давления не создает)
+- задержка event loop: лаг / ADMISSION_LAG_MS
+Давление 1.0 - порог перегрузки.
+
+Пороги по классам маршрутов (тяжелые отсекаются раньше дешевых):
+- консультации бесплатных пользователей - ADMISSION_HEAVY_PRESSURE
+- консультации платящих пользователей   - ADMISSION_PAID_PRESSURE
+- баланс, платежи и прочие дешевые API  - ADMISSION_LIGHT_PRESSURE
+Webhook платежей, health/ready и диагностика не отсекаются никогда.
+
+Отсеченная консультация получает бесплатный запасной совет (ADMISSION_SHED_MODE=fallback)
+или 503 с Retry-After (ADMISSION_SHED_MODE=reject); дешевые маршруты - 503.
+"""
+
+import os
+import math
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Dict, Any, Optional
+
+from gemini_limiter import gemini_limiter, PRIORITY_FREE
+from image_processing import image_pool
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_ENABLED = os.getenv('ADMISSION_ENABLED', 'true').lower() == 'true'
+ADMISSION_SHED_MODE = os.getenv('ADMISSION_SHED_MODE', 'fallback')  # fallback | reject
+ADMISSION_QUEUE_RATIO = float(os.getenv('ADMISSION_QUEUE_RATIO', 0.5))
+ADMISSION_IMAGE_WAIT_MS = float(os.getenv('ADMISSION_IMAGE_WAIT_MS', 5000))
+ADMISSION_LAG_MS = float(os.getenv('ADMISSION_LAG_MS', 250))
+ADMISSION_HEAVY_PRESSURE = float(os.getenv('ADMISSION_HEAVY_PRESSURE', 1.0))
+ADMISSION_PAID_PRESSURE = float(os.getenv('ADMISSION_PAID_PRESSURE', 1.5))
+ADMISSION_LIGHT_PRESSURE = float(os.getenv('ADMISSION_LIGHT_PRESSURE', 4.0))
+ADMISSION_RETRY_AFTER = float(os.getenv('ADMISSION_RETRY_AFTER', 5))
+
+LAG_PROBE_INTERVAL = 0.1
+
+ROUTE_HEAVY = 'heavy'
+ROUTE_LIGHT = 'light'
+ROUTE_EXEMPT = 'exempt'
+
+_HEAVY_PREFIXES = ('/api/v1/consultations/',)
+_EXEMPT_PREFIXES = ('/api/v1/payments/webhook', '/api/v1/health', '/api/v1/ready', '/api/v1/diagnostics/',
+                    '/health', '/ping', '/status')
+
+
+def route_class(path: str, method: str = 'POST') -> str:
+    if path.startswith(_EXEMPT_PREFIXES):
+        return ROUTE_EXEMPT
+    if path.startswith(_HEAVY_PREFIXES) and method == 'POST':
+        return ROUTE_HEAVY
+    # Чтение истории консультаций - дешевый маршрут
+    if path.startswith('/api/'):
+        return ROUTE_LIGHT
+    # Статика и страницы WebApp
+    return ROUTE_EXEMPT
+
+
+class EventLoopLagMonitor:
+    """⏱️ Задержка event loop: насколько позже срока просыпается периодическая задача"""
+
+    def __init__(self, interval: float = LAG_PROBE_INTERVAL):
+        self.interval = interval
+        self.lag_ms = 0.0
+        self._recent: deque = deque(maxlen=20)
+        self._task: Optional[asyncio.Task] = None
+
+    async def _probe(self) -> None:
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, (time.monotonic() - started - self.interval) * 1000)
+            self._recent.append(lag)
+            # Сглаживание: одиночный всплеск не отсекает запросы, затяжной лаг - отсекает
+            self.lag_ms = 0.7 * self.lag_ms + 0.3 * lag
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._probe())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'running': self._task is not None,
+            'lag_ms': round(self.lag_ms, 1),
+            'recent_max_ms': round(max(self._recent), 1) if self._recent else None
+        }
+
+
+class AdmissionController:
+    """🚪 Решение о приеме запроса по текущему давлению"""
+
+    def __init__(self, lag_monitor: EventLoopLagMonitor, enabled: bool = ADMISSION_ENABLED):
+        self.lag_monitor = lag_monitor
+        self.enabled = enabled
+        self.shed: Dict[str, int] = {}
+        self.admitted: Dict[str, int] = {}
+        self.last_shed_at: Optional[float] = None
+
+    def signals(self) -> Dict[str, float]:
+        limiter = gemini_limiter.stats()
+        return {
+            'gemini_queue': limiter['queue_length'] / max(1, limiter['max_queue']) / ADMISSION_QUEUE_RATIO,
+            'image_queue': image_pool.current_wait_ms() / ADMISSION_IMAGE_WAIT_MS,
+            'event_loop_lag': self.lag_monitor.lag_ms / ADMISSION_LAG_MS
+        }
+
+    def pressure(self) -> float:
+        return max(self.signals().values())
+
+    def threshold(self, route: str, priority: str = PRIORITY_FREE) -> float:
+        if route == ROUTE_EXEMPT:
+            return math.inf
+        if route == ROUTE_LIGHT:
+            return ADMISSION_LIGHT_PRESSURE
+        return ADMISSION_HEAVY_PRESSURE if priority == PRIORITY_FREE else ADMISSION_PAID_PRESSURE
+
+    def check(self, route: str, priority: str = PRIORITY_FREE) -> Optional[float]:
+        """
+        Returns:
+            None - запрос принят; иначе Retry-After в секундах (запрос отсечь)
+        """
+        if not self.enabled or route == ROUTE_EXEMPT:
+            return None
+        pressure = self.pressure()
+        key = f"{route}:{priority}" if route == ROUTE_HEAVY else route
+        if pressure < self.threshold(route, priority):
+            self.admitted[key] = self.admitted.get(key, 0) + 1
+            return None
+        self.shed[key] = self.shed.get(key, 0) + 1
+        self.last_shed_at = time.time()
+        logger.warning(f"🚪 Перегрузка (давление {pressure:.2f}): запрос {key} отсечен")
+        return max(1.0, math.ceil(ADMISSION_RETRY_AFTER * pressure))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'enabled': self.enabled,
+            'shed_mode': ADMISSION_SHED_MODE,
+            'pressure': round(self.pressure(), 2),
+            'signals': {name: round(value, 2) for name, value in self.signals().items()},
+            'thresholds': {
+                'heavy_free': ADMISSION_HEAVY_PRESSURE,
+                'heavy_paid': ADMISSION_PAID_PRESSURE,
+                'light': ADMISSION_LIGHT_PRESSURE
+            },
+            'event_loop': self.lag_monitor.stats(),
+            'admitted': dict(self.admitted),
+            'shed': dict(self.shed),
+            'last_shed_at': self.last_shed_at
+        }
+
+
+# Глобальные монитор и контроль процесса
+loop_lag_monitor = EventLoopLagMonitor()
+admission = AdmissionController(loop_lag_monitor)
@@ -0,0 +1,184 @@
+"""
+🗂️ МИШУРА - Advice Cache
+Двухуровневый кэш ответов стилиста по содержимому изображения
+
+Уровни:
+- Память процесса: LRU с TTL (cachetools.TTLCache)
+- Диск: diskcache, переживает перезапуски сервиса
+
+Ключ - хэш от оптимизированных байтов изображения, повода,
+нормализованных пожеланий, версии промпта и модели; ответы локальной
+имитации Gemini (fake/replay) хранятся под отдельными ключами.
+"""
+
+import os
+import hashlib
+import logging
+import threading
+from typing import Optional, Dict, Any, Iterable
+
+from cachetools import TTLCache
+
+try:
+    import diskcache
+    DISKCACHE_AVAILABLE = True
+except ImportError:
+    DISKCACHE_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+ADVICE_CACHE_ENABLED = os.getenv('ADVICE_CACHE_ENABLED', 'true').lower() == 'true'
+ADVICE_CACHE_MEMORY_SIZE = int(os.getenv('ADVICE_CACHE_MEMORY_SIZE', 256))
+ADVICE_CACHE_TTL = int(os.getenv('ADVICE_CACHE_TTL', 24 * 3600))
+ADVICE_CACHE_DISK_LIMIT_MB = int(os.getenv('ADVICE_CACHE_DISK_LIMIT_MB', 100))
+
+
+def get_cache_directory() -> str:
+    """Определить директорию дискового кэша (по аналогии с путем к БД)"""
+    env_dir = os.getenv('ADVICE_CACHE_DIR')
+    if env_dir:
+        return env_dir
+
+    # Persistent disk на Render
+    if os.path.exists('/opt/render/project/data'):
+        return '/opt/render/project/data/advice_cache'
+
+    return '.advice_cache'
+
+
+def normalize_text(value: Optional[str]) -> str:
+    """Нормализация текста для ключа: регистр и пробелы не влияют на совпадение"""
+    if not value:
+        return ""
+    return " ".join(str(value).lower().split())
+
+
+def make_cache_key(images: Iterable[bytes], occasion: Optional[str], preferences: Optional[str],
+                   prompt_version: str, model_name: Optional[str], mode: str = "analyze",
+                   transport: Optional[str] = None) -> str:
+    """
+    Построить ключ кэша по содержимому запроса.
+
+    Args:
+        images: Оптимизированные байты изображений (в порядке отправки)
+        occasion: Повод консультации
+        preferences: Пожелания пользователя
+        prompt_version: Версия промпта
+        model_name: Имя модели Gemini
+        mode: Режим консультации (analyze/compare)
+        transport: Локальный транспорт Gemini (fake/replay); None - настоящий API
+
+    Returns:
+        str: sha256 hex-дайджест
+    """
+    digest = hashlib.sha256()
+    for part in (mode, prompt_version, model_name or "", normalize_text(occasion), normalize_text(preferences)):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\x00')
+    if transport:
+        # Шаблонные ответы имитации не должны попасть к пользователям настоящего API
+        digest.update(f"transport:{transport}".encode('utf-8'))
+        digest.update(b'\x00')
+    for image_bytes in images:
+        digest.update(hashlib.sha256(image_bytes).digest())
+    return digest.hexdigest()
+
+
+class AdviceCache:
+    """
+    🗂️ Двухуровневый кэш советов стилиста
+
+    Хранит только успешные ответы Gemini. Ошибки дискового уровня
+    не влияют на работу консультаций - кэш просто пропускается.
+    """
+
+    def __init__(self, directory: Optional[str] = None, enabled: bool = ADVICE_CACHE_ENABLED,
+                 memory_size: int = ADVICE_CACHE_MEMORY_SIZE, ttl: int = ADVICE_CACHE_TTL):
+        self.enabled = enabled
+        self.ttl = ttl
+        self._memory = TTLCache(maxsize=memory_size, ttl=ttl)
+        self._lock = threading.Lock()
+        self._disk = None
+        self.stats_counters = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'errors': 0
+        }
+
+        if not self.enabled:
+            logger.info("🗂️ AdviceCache отключен (ADVICE_CACHE_ENABLED=false)")
+            return
+
+        if DISKCACHE_AVAILABLE:
+            self.directory = directory or get_cache_directory()
+            try:
+                self._disk = diskcache.Cache(
+                    self.directory,
+                    size_limit=ADVICE_CACHE_DISK_LIMIT_MB * 1024 * 1024
+                )
+                logger.info(f"🗂️ AdviceCache: дисковый уровень {self.directory}")
+            except Exception as e:
+                logger.warning(f"⚠️ Дисковый кэш недоступен, только память: {e}")
+                self._disk = None
+        else:
+            self.directory = None
+            logger.warning("⚠️ diskcache не установлен, AdviceCache работает только в памяти")
+
+    def get(self, key: str) -> Optional[str]:
+        """Получить совет из кэша (память, затем диск)"""
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self.stats_counters['memory_hits'] += 1
+                return value
+
+        if self._disk is not None:
+            try:
+                value = self._disk.get(key)
+            except Exception as e:
+                self.stats_counters['errors'] += 1
+                logger.warning(f"⚠️ Ошибка чтения дискового кэша: {e}")
+                value = None
+            if value is not None:
+                with self._lock:
+                    self._memory[key] = value
+                    self.stats_counters['disk_hits'] += 1
+                return value
+
+        with self._lock:
+            self.stats_counters['misses'] += 1
+        return None
+
+    def set(self, key: str, advice: str) -> None:
+        """Сохранить совет в оба уровня кэша"""
+        if not self.enabled or not advice:
+            return
+
+        with self._lock:
+            self._memory[key] = advice
+            self.stats_counters['stores'] += 1
+
+        if self._disk is not None:
+            try:
+                self._disk.set(key, advice, expire=self.ttl)
+            except Exception as e:
+                self.stats_counters['errors'] += 1
+                logger.warning(f"⚠️ Ошибка записи дискового кэша: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        """Счетчики попаданий/промахов для диагностики"""
+        counters = dict(self.stats_counters)
+        hits = counters['memory_hits'] + counters['disk_hits']
+        lookups = hits + counters['misses']
+        return {
+            'enabled': self.enabled,
+            'disk_enabled': self._disk is not None,
+            'memory_entries': len(self._memory),
+            'hit_rate': round(hits / lookups, 3) if lookups else 0.0,
+            **counters
+        }
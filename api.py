@@ -1,6 +1,7 @@
 # 🔄 ПОЛНАЯ ЗАМЕНА api.py - добавлены endpoints консультаций
 
 import os
+import json
 import uuid
 import logging
 import base64
@@ -13,7 +14,7 @@ import gc
 
 from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
 import uvicorn
 from pydantic import BaseModel
 import asyncio
@@ -26,8 +27,20 @@ except:
 
 # Импорты проекта
 from database import MishuraDB
-from gemini_ai import MishuraGeminiAI
+from gemini_ai import MishuraGeminiAI, COMPARE_LAYOUTS, GEMINI_COMPARE_LAYOUT
 from payment_service import PaymentService
+from image_processing import image_pool
+from gemini_breaker import GeminiUnavailableError
+from single_flight import consultation_flights, consultation_key
+from deadline import Deadline, DeadlineExceeded
+from gemini_keys import GEMINI_KEY_DAILY_LIMIT
+from gemini_quota import quota_ledger
+from gemini_priority import priority_resolver
+from gemini_usage import usage_recorder, STATUS_ERROR, STATUS_TIMEOUT, STATUS_CANCELLED
+from admission import admission, loop_lag_monitor, route_class, ROUTE_HEAVY, ROUTE_LIGHT, ADMISSION_SHED_MODE
+from warmup import warm_up
+from tournament import (Tournament, tournament_memo, tournament_price, planned_matches, TOURNAMENT_MAX_IMAGES,
+                        TOURNAMENT_LAYOUT, TOURNAMENT_TIMEOUT)
 
 # 🌐 НОВЫЕ ИМПОРТЫ ДЛЯ СИСТЕМЫ ОТЗЫВОВ (уже импортированы выше)
 
@@ -73,8 +86,8 @@ logger.info(f"   ADMIN_TELEGRAM_ID: {'установлен' if ADMIN_TELEGRAM_ID
 if ENVIRONMENT == 'production':
     if not TELEGRAM_TOKEN:
         raise ValueError("❌ TELEGRAM_TOKEN обязателен в продакшн режиме")
-    if not GEMINI_API_KEY:
-        raise ValueError("❌ GEMINI_API_KEY обязателен в продакшн режиме")
+    if not GEMINI_API_KEY and not os.getenv('GEMINI_API_KEYS'):
+        raise ValueError("❌ GEMINI_API_KEY или GEMINI_API_KEYS обязателен в продакшн режиме")
     if not YOOKASSA_SHOP_ID or not YOOKASSA_SECRET_KEY:
         raise ValueError("❌ ЮKassa настройки обязательны в продакшн режиме")
 
@@ -151,6 +164,10 @@ async def lifespan(app: FastAPI):
             logger.warning("⚠️ Система запущена БЕЗ финансовой безопасности (fallback режим)")
         gemini_ai = MishuraGeminiAI()
         logger.info("✅ Gemini AI инициализирован")
+        quota_ledger.attach(db)
+        priority_resolver.attach(db)
+        usage_recorder.attach(db)
+        loop_lag_monitor.start()
         if YOOKASSA_SHOP_ID and YOOKASSA_SECRET_KEY:
             payment_service = PaymentService(
                 shop_id=YOOKASSA_SHOP_ID,
@@ -162,10 +179,17 @@ async def lifespan(app: FastAPI):
         else:
             logger.warning("⚠️ Payment service НЕ ИНИЦИАЛИЗИРОВАН - отсутствуют настройки ЮKassa")
             payment_service = None
+        # 🔥 Прогрев в фоне: сервер уже принимает запросы, /api/v1/ready - после прогрева
+        warm_up.start(db=db, gemini_ai=gemini_ai)
     except Exception as e:
         logger.error(f"❌ Критическая ошибка при запуске: {e}", exc_info=True)
         raise
     yield
+    await warm_up.stop()
+    await loop_lag_monitor.stop()
+    await quota_ledger.flush()
+    await usage_recorder.flush()
+    image_pool.shutdown()
     logger.info("🛑 Сервер МИШУРА API остановлен.")
 
 # 🔐 НОВАЯ ФУНКЦИЯ: добавить ПОСЛЕ lifespan
@@ -219,6 +243,19 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+@app.middleware("http")
+async def admission_middleware(request: Request, call_next):
+    """🚪 Дешевые маршруты (баланс, платежи) отсекаются только при сильной перегрузке"""
+    if route_class(request.url.path, request.method) == ROUTE_LIGHT:
+        retry_after = admission.check(ROUTE_LIGHT)
+        if retry_after is not None:
+            return JSONResponse(
+                status_code=503,
+                content={"detail": "Сервис перегружен, повторите позже"},
+                headers={"Retry-After": str(int(retry_after))}
+            )
+    return await call_next(request)
+
 # 🔧 КРИТИЧЕСКИ ВАЖНО: Настройка статических файлов
 app.mount("/static", StaticFiles(directory="webapp"), name="static")
 
@@ -343,6 +380,15 @@ async def health_check_v1():
             }
         )
 
+@app.get("/api/v1/ready")
+async def readiness_check():
+    """🔥 Готовность: 200 только после прогрева (PIL, пул изображений, БД, Gemini)"""
+    report = warm_up.stats()
+    if not warm_up.ready:
+        return JSONResponse(status_code=503, content={"status": "warming_up", "warm_up": report},
+                            headers={"Retry-After": "1"})
+    return {"status": "ready", "warm_up": report, "timestamp": datetime.now().isoformat()}
+
 @app.get("/api/v1/users/{telegram_id}/balance")
 async def get_user_balance(telegram_id: int):
     """Получение баланса пользователя с дополнительной информацией"""
@@ -632,12 +678,363 @@ def _generate_fallback_advice_compare(occasion: str, preferences: str, images_co
     except Exception:
         return "Сервис сравнения временно недоступен. Сфокусируйтесь на посадке, пропорциях и уместности под повод."
 
+def _free_fallback_response(user_id: int, advice: str, correlation_id: str, start_time: float,
+                            retry_after: float, note: str) -> dict:
+    """Запасной совет без списания STcoins: Gemini заранее признан недоступным"""
+    logger.warning(f"[{correlation_id}] {note}, no charge")
+    try:
+        current_balance = db.get_user_balance(user_id)
+    except Exception:
+        current_balance = None
+    return {
+        "consultation_id": None,
+        "advice": advice,
+        "balance": current_balance,
+        "cost": 0,
+        "correlation_id": correlation_id,
+        "processing_time": round(time.time() - start_time, 2),
+        "status": "degraded",
+        "retry_after": round(retry_after),
+        "note": note
+    }
+
+_QUOTA_NOTE = "Gemini daily quota exhausted, returned fallback advice"
+_OVERLOAD_NOTE = "Service overloaded, returned fallback advice"
+
+def _admission_shed(user_id: int, priority: str, advice: str, correlation_id: str, start_time: float) -> Optional[dict]:
+    """
+    🚪 Контроль допуска тяжелого запроса.
+
+    Returns:
+        None - запрос принят; иначе бесплатный запасной совет (в режиме reject - 503 с Retry-After)
+    """
+    retry_after = admission.check(ROUTE_HEAVY, priority)
+    if retry_after is None:
+        return None
+    if ADMISSION_SHED_MODE == 'reject':
+        raise HTTPException(status_code=503, detail="Сервис перегружен, повторите позже",
+                            headers={"Retry-After": str(int(retry_after))})
+    return _free_fallback_response(user_id, advice, correlation_id, start_time, retry_after, _OVERLOAD_NOTE)
+
+def _check_images_payload(images: Any) -> None:
+    """Изображения запроса - список строк base64; числа, объекты и вложенные списки - 400"""
+    if not isinstance(images, list) or not all(isinstance(image, str) for image in images):
+        raise HTTPException(status_code=400, detail="Изображения должны передаваться строками base64")
+
+def _refund_consultation(user_id: int, amount: int, correlation_id: str, reason: str, **extra) -> None:
+    """🚨 КОМПЕНСАЦИЯ: возврат STcoins за несостоявшуюся консультацию"""
+    if financial_service:
+        financial_service.safe_balance_operation(
+            telegram_id=user_id,
+            amount_change=amount,
+            operation_type="consultation_refund",
+            correlation_id=correlation_id,
+            metadata={"reason": reason, **extra}
+        )
+
+def _debit_consultation(user_id: int, cost: int, operation_type: str, correlation_id: str,
+                        metadata: dict, insufficient_message: str) -> Optional[dict]:
+    """🔐 Списание за консультацию: общее для обычных, потоковых и турнирных endpoints"""
+    if financial_service:
+        operation_result = financial_service.safe_balance_operation(
+            telegram_id=user_id,
+            amount_change=-cost,
+            operation_type=operation_type,
+            correlation_id=correlation_id,
+            metadata=metadata
+        )
+        if not operation_result['success']:
+            if operation_result.get('error', 'unknown_error') == 'insufficient_balance':
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"{insufficient_message}. Требуется: {operation_result.get('required', cost)} доступно: {operation_result.get('available', 0)}"
+                )
+            logger.error(f"[{correlation_id}] Financial operation failed: {operation_result}")
+            raise HTTPException(status_code=500, detail="Ошибка обработки платежа")
+        return operation_result
+
+    # Fallback на старую систему
+    if db.get_user_balance(user_id) < cost:
+        raise HTTPException(status_code=400, detail=insufficient_message)
+    return None
+
+async def _run_analysis(user_id: int, occasion: str, preferences: str, image_data: str,
+                        correlation_id: str, start_time: float, deadline: Deadline) -> dict:
+    """
+    Списание, анализ Gemini и сохранение консультации (выполняется один раз на группу одинаковых запросов).
+
+    Все стадии после списания укладываются в срок запроса deadline.
+    """
+    # 📒 Квота Gemini на исходе: не списываем, чтобы не возвращать после отказа
+    quota_retry_after = await quota_ledger.should_degrade()
+    if quota_retry_after is not None:
+        return _free_fallback_response(user_id, _generate_fallback_advice_single(occasion, preferences),
+                                       correlation_id, start_time, quota_retry_after, _QUOTA_NOTE)
+
+    # 🔐 БЕЗОПАСНОЕ СПИСАНИЕ через financial_service
+    operation_result = _debit_consultation(
+        user_id, 10, "consultation_analysis", correlation_id,
+        metadata={
+            "occasion": occasion,
+            "service": "single_analysis",
+            "endpoint": "/consultations/analyze"
+        },
+        insufficient_message="Недостаточно STcoins"
+    )
+    
+    # Декодируем base64 изображение
+    try:
+        deadline.check("decode")
+        image_bytes = base64.b64decode(image_data)
+    except DeadlineExceeded:
+        _refund_consultation(user_id, 10, correlation_id, "deadline_exceeded", stage="decode")
+        raise HTTPException(status_code=504, detail="Анализ изображения занял слишком много времени")
+    except Exception as e:
+        # 🚨 КОМПЕНСАЦИЯ: возвращаем средства если изображение некорректно
+        _refund_consultation(user_id, 10, correlation_id, "invalid_image")
+        raise HTTPException(status_code=400, detail="Некорректные данные изображения")
+    
+    # 🤖 АНАЛИЗ ЧЕРЕЗ GEMINI AI (с timeout и retry)
+    gemini_meta = {}
+    try:
+        # Срок запроса действует внутри: оптимизация, попытки и паузы Gemini берут оставшееся время
+        analysis = await deadline.run(
+            gemini_ai.analyze_clothing_image(
+                image_data=image_bytes,
+                occasion=occasion,
+                preferences=preferences,
+                meta=gemini_meta,
+                deadline=deadline
+            ),
+            "analysis"
+        )
+    except asyncio.TimeoutError as e:
+        # 🚨 КОМПЕНСАЦИЯ: возвращаем средства при timeout (стадия, на которой истек срок, - в метаданных)
+        _refund_consultation(user_id, 10, correlation_id, "gemini_timeout", stage=getattr(e, "stage", None))
+        usage_recorder.record(gemini_meta, endpoint="/consultations/analyze", user_id=user_id,
+                              correlation_id=correlation_id, status=STATUS_TIMEOUT)
+        raise HTTPException(status_code=504, detail="Анализ изображения занял слишком много времени")
+    
+    except GeminiUnavailableError as e:
+        # 🔌 Автомат разомкнут: возвращаем средства и сразу отдаём запасной совет
+        _refund_consultation(user_id, 10, correlation_id, "circuit_open")
+        logger.warning(f"[{correlation_id}] Gemini circuit open, fallback advice served")
+        try:
+            current_balance = db.get_user_balance(user_id)
+        except Exception:
+            current_balance = None
+        return {
+            "consultation_id": None,
+            "advice": _generate_fallback_advice_single(occasion, preferences),
+            "balance": current_balance,
+            "cost": 0,
+            "correlation_id": correlation_id,
+            "processing_time": round(time.time() - start_time, 2),
+            "status": "degraded",
+            "retry_after": round(e.retry_after) if e.retry_after else None,
+            "note": "Gemini circuit open, returned fallback advice"
+        }
+    
+    except Exception as e:
+        # 🚨 КОМПЕНСАЦИЯ: возвращаем средства при ошибке Gemini
+        _refund_consultation(user_id, 10, correlation_id, "gemini_error", error=str(e))
+        logger.error(f"[{correlation_id}] Gemini analysis failed: {e}")
+        usage_recorder.record(gemini_meta, endpoint="/consultations/analyze", user_id=user_id,
+                              correlation_id=correlation_id, status=STATUS_ERROR)
+        # Вместо 500 — отдаём деградирующий ответ с нулевой стоимостью
+        processing_time = time.time() - start_time
+        try:
+            current_balance = db.get_user_balance(user_id)
+        except Exception:
+            current_balance = None
+        return {
+            "consultation_id": None,
+            "advice": _generate_fallback_advice_single(occasion, preferences),
+            "balance": current_balance,
+            "cost": 0,
+            "correlation_id": correlation_id,
+            "processing_time": round(processing_time, 2),
+            "status": "degraded",
+            "note": "Gemini unavailable, returned fallback advice"
+        }
+    
+    # Списываем средства ТОЛЬКО если анализ успешен (в случае fallback)
+    if not financial_service:
+        new_balance = db.update_user_balance(user_id, -10, "consultation")
+    else:
+        new_balance = operation_result['new_balance']
+    
+    # 📝 СОХРАНЯЕМ КОНСУЛЬТАЦИЮ (в потоке, в пределах оставшегося срока)
+    try:
+        consultation_id = await deadline.run(asyncio.to_thread(
+            db.save_consultation,
+            user_id=user_id,
+            occasion=occasion,
+            preferences=preferences,
+            image_path=None,
+            advice=analysis
+        ), "db_save")
+    except Exception as e:
+        logger.warning(f"[{correlation_id}] Failed to save consultation: {e}")
+        consultation_id = None
+    
+    # 📊 Расход Gemini консультации (в фоне)
+    usage_recorder.record(gemini_meta, endpoint="/consultations/analyze", user_id=user_id,
+                          correlation_id=correlation_id, consultation_id=consultation_id)
+    
+    processing_time = time.time() - start_time
+    
+    logger.info(f"✅ [{correlation_id}] Анализ завершен: user_id={user_id} time={processing_time:.2f}s, balance={new_balance}")
+    
+    return {
+        "consultation_id": consultation_id,
+        "advice": analysis,
+        "balance": new_balance,
+        "cost": 10,
+        "correlation_id": correlation_id,
+        "processing_time": round(processing_time, 2),
+        "cache_hit": gemini_meta.get("cache_hit", False),
+        "status": "success"
+    }
+
+async def _run_comparison(user_id: int, occasion: str, preferences: str, images_data: list,
+                          correlation_id: str, start_time: float, deadline: Deadline, layout: str) -> dict:
+    """
+    Списание, сравнение Gemini и сохранение консультации (выполняется один раз на группу одинаковых запросов).
+
+    Все стадии после списания укладываются в срок запроса deadline.
+    """
+    # 📒 Квота Gemini на исходе: не списываем, чтобы не возвращать после отказа
+    quota_retry_after = await quota_ledger.should_degrade()
+    if quota_retry_after is not None:
+        advice = _generate_fallback_advice_compare(occasion, preferences, len(images_data))
+        return _free_fallback_response(user_id, advice, correlation_id, start_time, quota_retry_after, _QUOTA_NOTE)
+
+    # 🔐 БЕЗОПАСНОЕ СПИСАНИЕ (15 STcoins за сравнение)
+    operation_result = _debit_consultation(
+        user_id, 15, "consultation_compare", correlation_id,
+        metadata={
+            "occasion": occasion,
+            "service": "comparison",
+            "images_count": len(images_data),
+            "layout": layout,
+            "endpoint": "/consultations/compare"
+        },
+        insufficient_message="Недостаточно STcoins для сравнения"
+    )
+    
+    # Декодируем base64 изображения
+    decoded_images = []
+    try:
+        deadline.check("decode")
+        for i, img_data in enumerate(images_data):
+            image_bytes = base64.b64decode(img_data)
+            decoded_images.append(image_bytes)
+    except DeadlineExceeded:
+        _refund_consultation(user_id, 15, correlation_id, "deadline_exceeded", stage="decode")
+        raise HTTPException(status_code=504, detail="Сравнение изображений заняло слишком много времени")
+    except Exception as e:
+        # 🚨 КОМПЕНСАЦИЯ: возвращаем средства если изображения некорректны
+        _refund_consultation(user_id, 15, correlation_id, "invalid_images")
+        raise HTTPException(status_code=400, detail=f"Некорректные данные изображения #{i+1}")
+    
+    # 🤖 СРАВНЕНИЕ ЧЕРЕЗ GEMINI AI (с timeout)
+    gemini_meta = {}
+    try:
+        # Срок запроса действует внутри: оптимизация, попытки и паузы Gemini берут оставшееся время
+        comparison = await deadline.run(
+            gemini_ai.compare_clothing_images(
+                image_data_list=decoded_images,
+                occasion=occasion,
+                preferences=preferences,
+                meta=gemini_meta,
+                deadline=deadline,
+                layout=layout
+            ),
+            "comparison"
+        )
+    except asyncio.TimeoutError as e:
+        # 🚨 КОМПЕНСАЦИЯ: возвращаем средства при timeout (стадия, на которой истек срок, - в метаданных)
+        _refund_consultation(user_id, 15, correlation_id, "gemini_timeout", stage=getattr(e, "stage", None))
+        usage_recorder.record(gemini_meta, endpoint="/consultations/compare", user_id=user_id,
+                              correlation_id=correlation_id, status=STATUS_TIMEOUT)
+        raise HTTPException(status_code=504, detail="Сравнение изображений заняло слишком много времени")
+    
+    except GeminiUnavailableError as e:
+        # 🔌 Автомат разомкнут: возвращаем средства и сразу отдаём запасной совет
+        _refund_consultation(user_id, 15, correlation_id, "circuit_open")
+        logger.warning(f"[{correlation_id}] Gemini circuit open, fallback comparison served")
+        try:
+            current_balance = db.get_user_balance(user_id)
+        except Exception:
+            current_balance = None
+        return {
+            "consultation_id": None,
+            "advice": _generate_fallback_advice_compare(occasion, preferences, len(decoded_images)),
+            "balance": current_balance,
+            "cost": 0,
+            "correlation_id": correlation_id,
+            "processing_time": round(time.time() - start_time, 2),
+            "status": "degraded",
+            "retry_after": round(e.retry_after) if e.retry_after else None,
+            "note": "Gemini circuit open, returned fallback advice"
+        }
+    
+    except Exception as e:
+        # 🚨 КОМПЕНСАЦИЯ: возвращаем средства при ошибке Gemini
+        _refund_consultation(user_id, 15, correlation_id, "gemini_error", error=str(e))
+        logger.error(f"[{correlation_id}] Gemini comparison failed: {e}")
+        usage_recorder.record(gemini_meta, endpoint="/consultations/compare", user_id=user_id,
+                              correlation_id=correlation_id, status=STATUS_ERROR)
+        raise HTTPException(status_code=500, detail="Сервис сравнения временно недоступен")
+    
+    # Списываем средства ТОЛЬКО если сравнение успешно (в случае fallback)
+    if not financial_service:
+        new_balance = db.update_user_balance(user_id, -15, "comparison")
+    else:
+        new_balance = operation_result['new_balance']
+    
+    # 📝 СОХРАНЯЕМ КОНСУЛЬТАЦИЮ (в потоке, в пределах оставшегося срока)
+    try:
+        consultation_id = await deadline.run(asyncio.to_thread(
+            db.save_consultation,
+            user_id=user_id,
+            occasion=occasion,
+            preferences=preferences,
+            image_path=None,
+            advice=comparison
+        ), "db_save")
+    except Exception as e:
+        logger.warning(f"[{correlation_id}] Failed to save consultation: {e}")
+        consultation_id = None
+    
+    # 📊 Расход Gemini консультации (в фоне)
+    usage_recorder.record(gemini_meta, endpoint="/consultations/compare", user_id=user_id,
+                          correlation_id=correlation_id, consultation_id=consultation_id)
+    
+    processing_time = time.time() - start_time
+    
+    logger.info(f"✅ [{correlation_id}] Сравнение завершено: user_id={user_id} time={processing_time:.2f}s, balance={new_balance}")
+    
+    return {
+        "consultation_id": consultation_id,
+        "advice": comparison,
+        "balance": new_balance,
+        "cost": 15,
+        "layout": layout,
+        "correlation_id": correlation_id,
+        "processing_time": round(processing_time, 2),
+        "cache_hit": gemini_meta.get("cache_hit", False),
+        "status": "success"
+    }
+
 @app.post("/api/v1/consultations/analyze")
 async def analyze_consultation(request: Request):
     """🔐 ЗАЩИЩЕННЫЙ анализ с финансовой безопасностью"""
     
     correlation_id = str(uuid.uuid4())
     start_time = time.time()
+    deadline = Deadline(60.0)  # 60 секунд на весь запрос
     
     try:
         data = await request.json()
@@ -650,289 +1047,681 @@ async def analyze_consultation(request: Request):
         
         if not image_data or not user_id:
             raise HTTPException(status_code=400, detail="Отсутствуют обязательные данные")
+        _check_images_payload([image_data])
+        
+        # 🎟️ Класс приоритета в очереди Gemini - по истории платежей
+        priority = await priority_resolver.apply(user_id)
+
+        # 🚪 Перегрузка: сразу бесплатный запасной совет вместо ожидания таймаута
+        shed = _admission_shed(user_id, priority, _generate_fallback_advice_single(occasion, preferences),
+                               correlation_id, start_time)
+        if shed is not None:
+            return shed
+
+        # 🛬 Одинаковый запрос уже выполняется - ждем его результат без повторного списания
+        flight_key = consultation_key(user_id, [image_data], occasion, preferences, "analyze")
+        result, coalesced = await consultation_flights.do(
+            flight_key,
+            lambda: _run_analysis(user_id, occasion, preferences, image_data, correlation_id, start_time, deadline)
+        )
+        if coalesced:
+            logger.info(f"🛬 [{correlation_id}] Повторный запрос анализа склеен с {result['correlation_id']}")
+            return {**result, "coalesced": True}
+        return result
         
-        # 🔐 БЕЗОПАСНОЕ СПИСАНИЕ через financial_service
-        if financial_service:
-            operation_result = financial_service.safe_balance_operation(
-                telegram_id=user_id,
-                amount_change=-10,
-                operation_type="consultation_analysis",
-                correlation_id=correlation_id,
-                metadata={
-                    "occasion": occasion,
-                    "service": "single_analysis",
-                    "endpoint": "/consultations/analyze"
-                }
-            )
-            
-            if not operation_result['success']:
-                error_detail = operation_result.get('error', 'unknown_error')
-                
-                if error_detail == 'insufficient_balance':
-                    raise HTTPException(
-                        status_code=400, 
-                        detail=f"Недостаточно STcoins. Требуется: {operation_result.get('required', 10)} доступно: {operation_result.get('available', 0)}"
-                    )
-                else:
-                    logger.error(f"[{correlation_id}] Financial operation failed: {operation_result}")
-                    raise HTTPException(status_code=500, detail="Ошибка обработки платежа")
-        else:
-            # Fallback на старую систему
-            current_balance = db.get_user_balance(user_id)
-            if current_balance < 10:
-                raise HTTPException(status_code=400, detail="Недостаточно STcoins для консультации")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ [{correlation_id}] Критическая ошибка анализа: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
+
+@app.post("/api/v1/consultations/compare")
+async def compare_consultation(request: Request):
+    """🔐 ЗАЩИЩЕННОЕ сравнение с финансовой безопасностью"""
+    
+    correlation_id = str(uuid.uuid4())
+    start_time = time.time()
+    deadline = Deadline(90.0)  # 90 секунд на весь запрос сравнения
+    
+    try:
+        data = await request.json()
+        user_id = data.get('user_id')
+        occasion = data.get('occasion', 'повседневный')
+        preferences = data.get('preferences', '')
+        images_data = data.get('images_data', [])
+        layout = data.get('layout') or GEMINI_COMPARE_LAYOUT
         
-        # Декодируем base64 изображение
-        try:
-            image_bytes = base64.b64decode(image_data)
-        except Exception as e:
-            # 🚨 КОМПЕНСАЦИЯ: возвращаем средства если изображение некорректно
-            if financial_service:
-                financial_service.safe_balance_operation(
-                    telegram_id=user_id,
-                    amount_change=10,
-                    operation_type="consultation_refund",
-                    correlation_id=correlation_id,
-                    metadata={"reason": "invalid_image"}
-                )
-            raise HTTPException(status_code=400, detail="Некорректные данные изображения")
+        _check_images_payload(images_data)
+        logger.info(f"⚖️ [{correlation_id}] Запрос сравнения от user_id: {user_id} изображений: {len(images_data)} ({layout})")
+        
+        if not user_id:
+            raise HTTPException(status_code=400, detail="Отсутствует user_id")
+        
+        if len(images_data) < 2:
+            raise HTTPException(status_code=400, detail="Нужно минимум 2 изображения для сравнения")
+        
+        if len(images_data) > 4:
+            raise HTTPException(status_code=400, detail="Максимум 4 изображения для сравнения")
+
+        if layout not in COMPARE_LAYOUTS:
+            raise HTTPException(status_code=400, detail=f"layout должен быть одним из: {', '.join(COMPARE_LAYOUTS)}")
         
-        # 🤖 АНАЛИЗ ЧЕРЕЗ GEMINI AI (с timeout и retry)
+        # 🎟️ Класс приоритета в очереди Gemini - по истории платежей
+        priority = await priority_resolver.apply(user_id)
+
+        # 🚪 Перегрузка: сразу бесплатный запасной совет вместо ожидания таймаута
+        advice = _generate_fallback_advice_compare(occasion, preferences, len(images_data))
+        shed = _admission_shed(user_id, priority, advice, correlation_id, start_time)
+        if shed is not None:
+            return shed
+
+        # 🛬 Одинаковый запрос уже выполняется - ждем его результат без повторного списания
+        flight_key = consultation_key(user_id, images_data, occasion, preferences, f"compare:{layout}")
+        result, coalesced = await consultation_flights.do(
+            flight_key,
+            lambda: _run_comparison(user_id, occasion, preferences, images_data, correlation_id, start_time, deadline,
+                                    layout)
+        )
+        if coalesced:
+            logger.info(f"🛬 [{correlation_id}] Повторный запрос сравнения склеен с {result['correlation_id']}")
+            return {**result, "coalesced": True}
+        return result
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ [{correlation_id}] Критическая ошибка сравнения: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
+
+# === ПОТОКОВЫЕ КОНСУЛЬТАЦИИ (SSE) ===
+
+def _sse_event(payload: dict) -> str:
+    """Одно событие Server-Sent Events с JSON-данными"""
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+async def _stream_consultation_events(stream, *, user_id: int, occasion: str, preferences: str,
+                                      cost: int, correlation_id: str, start_time: float,
+                                      deadline: Deadline, operation_result: Optional[dict],
+                                      balance_reason: str, fallback_advice: Optional[str],
+                                      unavailable_advice: str, meta: dict, timeout_detail: str, error_detail: str,
+                                      endpoint: str):
+    """
+    Пересылает фрагменты Gemini клиенту как SSE.
+
+    События: start, chunk (text), done (итог как у обычного endpoint) и error.
+    Консультация сохраняется только после полного ответа; при таймауте,
+    ошибке Gemini или отключении клиента средства возвращаются. Если автомат
+    Gemini разомкнут, сразу отдается unavailable_advice.
+    """
+    settled = False  # деньги списаны окончательно или уже возвращены
+    try:
+        yield _sse_event({"type": "start", "correlation_id": correlation_id, "cost": cost})
         try:
-            analysis = await asyncio.wait_for(
-                gemini_ai.analyze_clothing_image(
-                    image_data=image_bytes,
-                    occasion=occasion,
-                    preferences=preferences
-                ),
-                timeout=60.0  # 60 секунд timeout
-            )
+            while True:
+                try:
+                    chunk = await deadline.run(stream.__anext__(), "stream")
+                except StopAsyncIteration:
+                    break
+                yield _sse_event({"type": "chunk", "text": chunk})
         except asyncio.TimeoutError:
-            # 🚨 КОМПЕНСАЦИЯ: возвращаем средства при timeout
-            if financial_service:
-                financial_service.safe_balance_operation(
-                    telegram_id=user_id,
-                    amount_change=10,
-                    operation_type="consultation_refund",
-                    correlation_id=correlation_id,
-                    metadata={"reason": "gemini_timeout"}
-                )
-            raise HTTPException(status_code=504, detail="Анализ изображения занял слишком много времени")
-        
+            settled = True
+            _refund_consultation(user_id, cost, correlation_id, "gemini_timeout", stage="stream")
+            usage_recorder.record(meta, endpoint=endpoint, user_id=user_id, correlation_id=correlation_id,
+                                  status=STATUS_TIMEOUT)
+            yield _sse_event({"type": "error", "status_code": 504, "detail": timeout_detail,
+                              "correlation_id": correlation_id})
+            return
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            # 🚨 КОМПЕНСАЦИЯ: возвращаем средства при ошибке Gemini
-            if financial_service:
-                financial_service.safe_balance_operation(
-                    telegram_id=user_id,
-                    amount_change=10,
-                    operation_type="consultation_refund",
-                    correlation_id=correlation_id,
-                    metadata={"reason": "gemini_error", "error": str(e)}
-                )
-            logger.error(f"[{correlation_id}] Gemini analysis failed: {e}")
-            # Вместо 500 — отдаём деградирующий ответ с нулевой стоимостью
-            processing_time = time.time() - start_time
+            settled = True
+            circuit_open = isinstance(e, GeminiUnavailableError)
+            if circuit_open:
+                _refund_consultation(user_id, cost, correlation_id, "circuit_open")
+                logger.warning(f"[{correlation_id}] Gemini circuit open, fallback advice served")
+                fallback_advice = unavailable_advice
+            else:
+                _refund_consultation(user_id, cost, correlation_id, "gemini_error", error=str(e))
+                logger.error(f"[{correlation_id}] Gemini stream failed: {e}")
+                usage_recorder.record(meta, endpoint=endpoint, user_id=user_id, correlation_id=correlation_id,
+                                      status=STATUS_ERROR)
+            if fallback_advice is None:
+                yield _sse_event({"type": "error", "status_code": 500, "detail": error_detail,
+                                  "correlation_id": correlation_id})
+                return
+            # Вместо ошибки — деградирующий ответ с нулевой стоимостью
             try:
                 current_balance = db.get_user_balance(user_id)
             except Exception:
                 current_balance = None
-            return {
+            yield _sse_event({
+                "type": "done",
                 "consultation_id": None,
-                "advice": _generate_fallback_advice_single(occasion, preferences),
+                "advice": fallback_advice,
                 "balance": current_balance,
                 "cost": 0,
                 "correlation_id": correlation_id,
-                "processing_time": round(processing_time, 2),
+                "processing_time": round(time.time() - start_time, 2),
                 "status": "degraded",
-                "note": "Gemini unavailable, returned fallback advice"
-            }
-        
-        # Списываем средства ТОЛЬКО если анализ успешен (в случае fallback)
+                "note": "Gemini circuit open, returned fallback advice" if circuit_open
+                        else "Gemini unavailable, returned fallback advice"
+            })
+            return
+
+        settled = True
+        advice = meta.get("advice", "")
+
+        # Списываем средства ТОЛЬКО если ответ получен полностью (в случае fallback)
         if not financial_service:
-            new_balance = db.update_user_balance(user_id, -10, "consultation")
+            new_balance = db.update_user_balance(user_id, -cost, balance_reason)
         else:
             new_balance = operation_result['new_balance']
-        
+
         # 📝 СОХРАНЯЕМ КОНСУЛЬТАЦИЮ
         try:
-            consultation_id = db.save_consultation(
+            consultation_id = await deadline.run(asyncio.to_thread(
+                db.save_consultation,
                 user_id=user_id,
                 occasion=occasion,
                 preferences=preferences,
                 image_path=None,
-                advice=analysis
-            )
+                advice=advice
+            ), "db_save")
         except Exception as e:
             logger.warning(f"[{correlation_id}] Failed to save consultation: {e}")
             consultation_id = None
-        
+
+        usage_recorder.record(meta, endpoint=endpoint, user_id=user_id, correlation_id=correlation_id,
+                              consultation_id=consultation_id)
+
         processing_time = time.time() - start_time
-        
-        logger.info(f"✅ [{correlation_id}] Анализ завершен: user_id={user_id} time={processing_time:.2f}s, balance={new_balance}")
-        
-        return {
+        logger.info(f"✅ [{correlation_id}] Потоковая консультация завершена: user_id={user_id} time={processing_time:.2f}s, balance={new_balance}")
+
+        yield _sse_event({
+            "type": "done",
             "consultation_id": consultation_id,
-            "advice": analysis,
+            "advice": advice,
             "balance": new_balance,
-            "cost": 10,
+            "cost": cost,
             "correlation_id": correlation_id,
             "processing_time": round(processing_time, 2),
+            "cache_hit": meta.get("cache_hit", False),
             "status": "success"
-        }
-        
+        })
+    finally:
+        if not settled:
+            # Клиент закрыл соединение до конца ответа
+            logger.warning(f"[{correlation_id}] Клиент отключился во время потока, возврат средств")
+            _refund_consultation(user_id, cost, correlation_id, "client_disconnected")
+            usage_recorder.record(meta, endpoint=endpoint, user_id=user_id, correlation_id=correlation_id,
+                                  status=STATUS_CANCELLED)
+        await stream.aclose()
+
+async def _fallback_events(result: dict):
+    """Поток из одного итогового события с запасным советом"""
+    yield _sse_event({"type": "start", "correlation_id": result["correlation_id"], "cost": 0})
+    yield _sse_event({"type": "done", **result})
+
+def _sse_response(events) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/api/v1/consultations/analyze/stream")
+async def analyze_consultation_stream(request: Request):
+    """📡 Потоковый анализ (SSE) с той же финансовой логикой, что /consultations/analyze"""
+
+    correlation_id = str(uuid.uuid4())
+    start_time = time.time()
+    deadline = Deadline(60.0)
+
+    try:
+        data = await request.json()
+        user_id = data.get('user_id')
+        occasion = data.get('occasion', 'повседневный')
+        preferences = data.get('preferences', '')
+        image_data = data.get('image_data')
+
+        logger.info(f"📡 [{correlation_id}] Потоковый запрос анализа от user_id: {user_id}")
+
+        if not image_data or not user_id:
+            raise HTTPException(status_code=400, detail="Отсутствуют обязательные данные")
+        _check_images_payload([image_data])
+
+        priority = await priority_resolver.apply(user_id)
+        advice = _generate_fallback_advice_single(occasion, preferences)
+        shed = _admission_shed(user_id, priority, advice, correlation_id, start_time)
+        if shed is not None:
+            return _sse_response(_fallback_events(shed))
+        quota_retry_after = await quota_ledger.should_degrade()
+        if quota_retry_after is not None:
+            return _sse_response(_fallback_events(
+                _free_fallback_response(user_id, advice, correlation_id, start_time, quota_retry_after, _QUOTA_NOTE)))
+
+        operation_result = _debit_consultation(
+            user_id, 10, "consultation_analysis", correlation_id,
+            metadata={
+                "occasion": occasion,
+                "service": "single_analysis",
+                "endpoint": "/consultations/analyze/stream"
+            },
+            insufficient_message="Недостаточно STcoins"
+        )
+
+        try:
+            image_bytes = base64.b64decode(image_data)
+        except Exception:
+            _refund_consultation(user_id, 10, correlation_id, "invalid_image")
+            raise HTTPException(status_code=400, detail="Некорректные данные изображения")
+
+        gemini_meta = {}
+        stream = gemini_ai.stream_clothing_analysis(
+            image_data=image_bytes,
+            occasion=occasion,
+            preferences=preferences,
+            meta=gemini_meta,
+            deadline=deadline
+        )
+        return _sse_response(_stream_consultation_events(
+            stream,
+            user_id=user_id,
+            occasion=occasion,
+            preferences=preferences,
+            cost=10,
+            correlation_id=correlation_id,
+            start_time=start_time,
+            deadline=deadline,
+            operation_result=operation_result,
+            balance_reason="consultation",
+            fallback_advice=_generate_fallback_advice_single(occasion, preferences),
+            unavailable_advice=_generate_fallback_advice_single(occasion, preferences),
+            meta=gemini_meta,
+            timeout_detail="Анализ изображения занял слишком много времени",
+            error_detail="Сервис анализа временно недоступен",
+            endpoint="/consultations/analyze/stream"
+        ))
+
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"❌ [{correlation_id}] Критическая ошибка анализа: {e}", exc_info=True)
+        logger.error(f"❌ [{correlation_id}] Критическая ошибка потокового анализа: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
 
-@app.post("/api/v1/consultations/compare")
-async def compare_consultation(request: Request):
-    """🔐 ЗАЩИЩЕННОЕ сравнение с финансовой безопасностью"""
-    
+@app.post("/api/v1/consultations/compare/stream")
+async def compare_consultation_stream(request: Request):
+    """📡 Потоковое сравнение (SSE) с той же финансовой логикой, что /consultations/compare"""
+
     correlation_id = str(uuid.uuid4())
     start_time = time.time()
-    
+    deadline = Deadline(90.0)
+
     try:
         data = await request.json()
         user_id = data.get('user_id')
         occasion = data.get('occasion', 'повседневный')
         preferences = data.get('preferences', '')
         images_data = data.get('images_data', [])
-        
-        logger.info(f"⚖️ [{correlation_id}] Запрос сравнения от user_id: {user_id} изображений: {len(images_data)}")
-        
+        layout = data.get('layout') or GEMINI_COMPARE_LAYOUT
+
+        _check_images_payload(images_data)
+        logger.info(f"📡 [{correlation_id}] Потоковый запрос сравнения от user_id: {user_id} изображений: {len(images_data)} ({layout})")
+
         if not user_id:
             raise HTTPException(status_code=400, detail="Отсутствует user_id")
-        
         if len(images_data) < 2:
             raise HTTPException(status_code=400, detail="Нужно минимум 2 изображения для сравнения")
-        
         if len(images_data) > 4:
             raise HTTPException(status_code=400, detail="Максимум 4 изображения для сравнения")
-        
-        # 🔐 БЕЗОПАСНОЕ СПИСАНИЕ (15 STcoins за сравнение)
-        if financial_service:
-            operation_result = financial_service.safe_balance_operation(
-                telegram_id=user_id,
-                amount_change=-15,
-                operation_type="consultation_compare",
-                correlation_id=correlation_id,
-                metadata={
-                    "occasion": occasion,
-                    "service": "comparison",
-                    "images_count": len(images_data),
-                    "endpoint": "/consultations/compare"
-                }
-            )
-            
-            if not operation_result['success']:
-                error_detail = operation_result.get('error', 'unknown_error')
-                
-                if error_detail == 'insufficient_balance':
-                    raise HTTPException(
-                        status_code=400, 
-                        detail=f"Недостаточно STcoins для сравнения. Требуется: {operation_result.get('required', 15)} доступно: {operation_result.get('available', 0)}"
-                    )
-                else:
-                    logger.error(f"[{correlation_id}] Financial operation failed: {operation_result}")
-                    raise HTTPException(status_code=500, detail="Ошибка обработки платежа")
-        else:
-            # Fallback на старую систему
-            current_balance = db.get_user_balance(user_id)
-            if current_balance < 15:
-                raise HTTPException(status_code=400, detail="Недостаточно STcoins для сравнения")
-        
-        # Декодируем base64 изображения
+        if layout not in COMPARE_LAYOUTS:
+            raise HTTPException(status_code=400, detail=f"layout должен быть одним из: {', '.join(COMPARE_LAYOUTS)}")
+
+        priority = await priority_resolver.apply(user_id)
+        advice = _generate_fallback_advice_compare(occasion, preferences, len(images_data))
+        shed = _admission_shed(user_id, priority, advice, correlation_id, start_time)
+        if shed is not None:
+            return _sse_response(_fallback_events(shed))
+        quota_retry_after = await quota_ledger.should_degrade()
+        if quota_retry_after is not None:
+            return _sse_response(_fallback_events(
+                _free_fallback_response(user_id, advice, correlation_id, start_time, quota_retry_after, _QUOTA_NOTE)))
+
+        operation_result = _debit_consultation(
+            user_id, 15, "consultation_compare", correlation_id,
+            metadata={
+                "occasion": occasion,
+                "service": "comparison",
+                "images_count": len(images_data),
+                "layout": layout,
+                "endpoint": "/consultations/compare/stream"
+            },
+            insufficient_message="Недостаточно STcoins для сравнения"
+        )
+
         decoded_images = []
         try:
             for i, img_data in enumerate(images_data):
-                image_bytes = base64.b64decode(img_data)
-                decoded_images.append(image_bytes)
-        except Exception as e:
-            # 🚨 КОМПЕНСАЦИЯ: возвращаем средства если изображения некорректны
-            if financial_service:
-                financial_service.safe_balance_operation(
-                    telegram_id=user_id,
-                    amount_change=15,
-                    operation_type="consultation_refund",
-                    correlation_id=correlation_id,
-                    metadata={"reason": "invalid_images"}
-                )
+                decoded_images.append(base64.b64decode(img_data))
+        except Exception:
+            _refund_consultation(user_id, 15, correlation_id, "invalid_images")
             raise HTTPException(status_code=400, detail=f"Некорректные данные изображения #{i+1}")
-        
-        # 🤖 СРАВНЕНИЕ ЧЕРЕЗ GEMINI AI (с timeout)
+
+        gemini_meta = {}
+        stream = gemini_ai.stream_clothing_comparison(
+            image_data_list=decoded_images,
+            occasion=occasion,
+            preferences=preferences,
+            meta=gemini_meta,
+            deadline=deadline,
+            layout=layout
+        )
+        return _sse_response(_stream_consultation_events(
+            stream,
+            user_id=user_id,
+            occasion=occasion,
+            preferences=preferences,
+            cost=15,
+            correlation_id=correlation_id,
+            start_time=start_time,
+            deadline=deadline,
+            operation_result=operation_result,
+            balance_reason="comparison",
+            fallback_advice=None,
+            unavailable_advice=_generate_fallback_advice_compare(occasion, preferences, len(decoded_images)),
+            meta=gemini_meta,
+            timeout_detail="Сравнение изображений заняло слишком много времени",
+            error_detail="Сервис сравнения временно недоступен",
+            endpoint="/consultations/compare/stream"
+        ))
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ [{correlation_id}] Критическая ошибка потокового сравнения: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
+
+# === ТУРНИР ОБРАЗОВ ===
+
+def _start_tournament(user_id: int, occasion: str, preferences: str, images_data: list, layout: str,
+                      correlation_id: str, deadline: Deadline, endpoint: str):
+    """
+    Списание за все запланированные сравнения турнира и декодирование изображений.
+
+    Returns:
+        (Tournament, результат списания)
+    """
+    planned_cost = tournament_price(planned_matches(len(images_data)))
+    operation_result = _debit_consultation(
+        user_id, planned_cost, "consultation_tournament", correlation_id,
+        metadata={
+            "occasion": occasion,
+            "service": "tournament",
+            "images_count": len(images_data),
+            "matches": planned_matches(len(images_data)),
+            "layout": layout,
+            "endpoint": endpoint
+        },
+        insufficient_message="Недостаточно STcoins для турнира образов"
+    )
+
+    decoded_images = []
+    try:
+        for i, img_data in enumerate(images_data):
+            decoded_images.append(base64.b64decode(img_data))
+    except Exception:
+        _refund_consultation(user_id, planned_cost, correlation_id, "invalid_images")
+        raise HTTPException(status_code=400, detail=f"Некорректные данные изображения #{i+1}")
+
+    tournament = Tournament(gemini_ai, decoded_images, occasion, preferences, deadline=deadline, layout=layout)
+    return tournament, operation_result
+
+async def _tournament_events(tournament: Tournament, *, user_id: int, occasion: str, preferences: str,
+                             correlation_id: str, start_time: float, deadline: Deadline,
+                             operation_result: Optional[dict]):
+    """
+    События турнира (словари): start, plan, match, round, done и error.
+
+    Заранее списана цена всех запланированных сравнений; после турнира
+    возвращается часть за сравнения, разрешенные по памяти исходов.
+    При таймауте, ошибке Gemini или отключении клиента возвращается все.
+    Расход Gemini пишется по каждому вызову сравнения со своим статусом.
+    """
+    planned_cost = tournament_price(tournament.planned_matches)
+    settled = False  # деньги списаны окончательно или уже возвращены
+    consultation_id = None
+    try:
+        yield {"type": "start", "correlation_id": correlation_id, "cost": planned_cost}
+        result = None
         try:
-            comparison = await asyncio.wait_for(
-                gemini_ai.compare_clothing_images(
-                    image_data_list=decoded_images,
-                    occasion=occasion,
-                    preferences=preferences
-                ),
-                timeout=90.0  # 90 секунд для сравнения
-            )
-        except asyncio.TimeoutError:
-            # 🚨 КОМПЕНСАЦИЯ: возвращаем средства при timeout
-            if financial_service:
-                financial_service.safe_balance_operation(
-                    telegram_id=user_id,
-                    amount_change=15,
-                    operation_type="consultation_refund",
-                    correlation_id=correlation_id,
-                    metadata={"reason": "gemini_timeout"}
-                )
-            raise HTTPException(status_code=504, detail="Сравнение изображений заняло слишком много времени")
-        
+            async for event in tournament.run():
+                if event["type"] == "result":
+                    result = event
+                else:
+                    yield event
+        except asyncio.TimeoutError as e:
+            settled = True
+            _refund_consultation(user_id, planned_cost, correlation_id, "gemini_timeout",
+                                 stage=getattr(e, "stage", None))
+            yield {"type": "error", "status_code": 504, "detail": "Турнир образов занял слишком много времени",
+                   "correlation_id": correlation_id}
+            return
+        except asyncio.CancelledError:
+            raise
+        except GeminiUnavailableError:
+            settled = True
+            _refund_consultation(user_id, planned_cost, correlation_id, "circuit_open")
+            logger.warning(f"[{correlation_id}] Gemini circuit open, fallback tournament advice served")
+            try:
+                current_balance = db.get_user_balance(user_id)
+            except Exception:
+                current_balance = None
+            yield {
+                "type": "done",
+                "consultation_id": None,
+                "advice": _generate_fallback_advice_compare(occasion, preferences, len(tournament.images)),
+                "balance": current_balance,
+                "cost": 0,
+                "correlation_id": correlation_id,
+                "processing_time": round(time.time() - start_time, 2),
+                "status": "degraded",
+                "note": "Gemini circuit open, returned fallback advice"
+            }
+            return
         except Exception as e:
-            # 🚨 КОМПЕНСАЦИЯ: возвращаем средства при ошибке Gemini
-            if financial_service:
-                financial_service.safe_balance_operation(
-                    telegram_id=user_id,
-                    amount_change=15,
-                    operation_type="consultation_refund",
-                    correlation_id=correlation_id,
-                    metadata={"reason": "gemini_error", "error": str(e)}
-                )
-            logger.error(f"[{correlation_id}] Gemini comparison failed: {e}")
-            raise HTTPException(status_code=500, detail="Сервис сравнения временно недоступен")
-        
-        # Списываем средства ТОЛЬКО если сравнение успешно (в случае fallback)
+            settled = True
+            _refund_consultation(user_id, planned_cost, correlation_id, "gemini_error", error=str(e))
+            logger.error(f"[{correlation_id}] Tournament failed: {e}")
+            yield {"type": "error", "status_code": 500, "detail": "Сервис сравнения временно недоступен",
+                   "correlation_id": correlation_id}
+            return
+
+        settled = True
+        cost = tournament_price(tournament.charged_matches)
+        unused = planned_cost - cost
+
+        # Списываем только сравнения, дошедшие до Gemini или кэша (в случае fallback - сейчас)
         if not financial_service:
-            new_balance = db.update_user_balance(user_id, -15, "comparison")
+            new_balance = db.update_user_balance(user_id, -cost, "tournament") if cost else db.get_user_balance(user_id)
         else:
             new_balance = operation_result['new_balance']
-        
+            if unused:
+                _refund_consultation(user_id, unused, correlation_id, "tournament_unused_matches",
+                                     planned=tournament.planned_matches, charged=tournament.charged_matches)
+                new_balance += unused
+
         # 📝 СОХРАНЯЕМ КОНСУЛЬТАЦИЮ
         try:
-            consultation_id = db.save_consultation(
+            consultation_id = await deadline.run(asyncio.to_thread(
+                db.save_consultation,
                 user_id=user_id,
                 occasion=occasion,
                 preferences=preferences,
                 image_path=None,
-                advice=comparison
-            )
+                advice=result["advice"]
+            ), "db_save")
         except Exception as e:
             logger.warning(f"[{correlation_id}] Failed to save consultation: {e}")
             consultation_id = None
-        
+
         processing_time = time.time() - start_time
-        
-        logger.info(f"✅ [{correlation_id}] Сравнение завершено: user_id={user_id} time={processing_time:.2f}s, balance={new_balance}")
-        
-        return {
+        logger.info(f"🏆 [{correlation_id}] Турнир завершен: user_id={user_id} образов={len(tournament.images)} "
+                    f"сравнений={tournament.charged_matches}/{tournament.planned_matches} "
+                    f"time={processing_time:.2f}s, balance={new_balance}")
+
+        yield {
+            "type": "done",
             "consultation_id": consultation_id,
-            "advice": comparison,
+            "advice": result["advice"],
+            "ranking": result["ranking"],
             "balance": new_balance,
-            "cost": 15,
+            "cost": cost,
+            "matches": tournament.planned_matches,
+            "charged_matches": tournament.charged_matches,
+            "layout": tournament.layout,
             "correlation_id": correlation_id,
             "processing_time": round(processing_time, 2),
             "status": "success"
         }
-        
+    finally:
+        if not settled:
+            # Клиент закрыл соединение до конца турнира
+            logger.warning(f"[{correlation_id}] Клиент отключился во время турнира, возврат средств")
+            _refund_consultation(user_id, planned_cost, correlation_id, "client_disconnected")
+        # 📊 Расход Gemini: каждый вызов сравнения отдельной строкой
+        for call_meta, call_status in tournament.calls:
+            usage_recorder.record(call_meta, endpoint="/consultations/tournament", user_id=user_id,
+                                  correlation_id=correlation_id, consultation_id=consultation_id,
+                                  status=call_status)
+
+async def _run_tournament(user_id: int, occasion: str, preferences: str, images_data: list, layout: str,
+                          correlation_id: str, start_time: float, deadline: Deadline) -> dict:
+    """Турнир целиком: итог как у обычного сравнения плюс рейтинг и сетка сравнений"""
+    tournament, operation_result = _start_tournament(user_id, occasion, preferences, images_data, layout,
+                                                     correlation_id, deadline, "/consultations/tournament")
+    events = _tournament_events(tournament, user_id=user_id, occasion=occasion, preferences=preferences,
+                                correlation_id=correlation_id, start_time=start_time, deadline=deadline,
+                                operation_result=operation_result)
+    bracket = []
+    try:
+        async for event in events:
+            if event["type"] == "match":
+                bracket.append({key: value for key, value in event.items() if key != "type"})
+            elif event["type"] == "error":
+                raise HTTPException(status_code=event["status_code"], detail=event["detail"])
+            elif event["type"] == "done":
+                result = {key: value for key, value in event.items() if key != "type"}
+                if result["status"] == "success":
+                    result["bracket"] = bracket
+                return result
+    finally:
+        await events.aclose()
+    raise HTTPException(status_code=500, detail="Сервис сравнения временно недоступен")
+
+def _tournament_request(data: dict, correlation_id: str) -> tuple:
+    """Проверка запроса турнира: (user_id, occasion, preferences, images_data, layout)"""
+    user_id = data.get('user_id')
+    occasion = data.get('occasion', 'повседневный')
+    preferences = data.get('preferences', '')
+    images_data = data.get('images_data', [])
+    layout = data.get('layout') or TOURNAMENT_LAYOUT
+
+    _check_images_payload(images_data)
+    logger.info(f"🏆 [{correlation_id}] Запрос турнира от user_id: {user_id} изображений: {len(images_data)} ({layout})")
+
+    if not user_id:
+        raise HTTPException(status_code=400, detail="Отсутствует user_id")
+    if len(images_data) < 2:
+        raise HTTPException(status_code=400, detail="Нужно минимум 2 изображения для турнира")
+    if len(images_data) > TOURNAMENT_MAX_IMAGES:
+        raise HTTPException(status_code=400, detail=f"Максимум {TOURNAMENT_MAX_IMAGES} изображений для турнира")
+    if layout not in COMPARE_LAYOUTS:
+        raise HTTPException(status_code=400, detail=f"layout должен быть одним из: {', '.join(COMPARE_LAYOUTS)}")
+    return user_id, occasion, preferences, images_data, layout
+
+@app.post("/api/v1/consultations/tournament")
+async def tournament_consultation(request: Request):
+    """
+    🏆 Турнир образов: до TOURNAMENT_MAX_IMAGES образов, раунды сравнений по 2-4 образа.
+
+    Стоимость - TOURNAMENT_MATCH_PRICE STcoins за каждое сравнение, дошедшее до Gemini.
+    """
+    correlation_id = str(uuid.uuid4())
+    start_time = time.time()
+    deadline = Deadline(TOURNAMENT_TIMEOUT)
+
+    try:
+        data = await request.json()
+        user_id, occasion, preferences, images_data, layout = _tournament_request(data, correlation_id)
+
+        priority = await priority_resolver.apply(user_id)
+        advice = _generate_fallback_advice_compare(occasion, preferences, len(images_data))
+        shed = _admission_shed(user_id, priority, advice, correlation_id, start_time)
+        if shed is not None:
+            return shed
+        quota_retry_after = await quota_ledger.should_degrade()
+        if quota_retry_after is not None:
+            return _free_fallback_response(user_id, advice, correlation_id, start_time, quota_retry_after, _QUOTA_NOTE)
+
+        # 🛬 Одинаковый турнир уже выполняется - ждем его результат без повторного списания
+        flight_key = consultation_key(user_id, images_data, occasion, preferences, f"tournament:{layout}")
+        result, coalesced = await consultation_flights.do(
+            flight_key,
+            lambda: _run_tournament(user_id, occasion, preferences, images_data, layout, correlation_id,
+                                    start_time, deadline)
+        )
+        if coalesced:
+            logger.info(f"🛬 [{correlation_id}] Повторный запрос турнира склеен с {result['correlation_id']}")
+            return {**result, "coalesced": True}
+        return result
+
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"❌ [{correlation_id}] Критическая ошибка сравнения: {e}", exc_info=True)
+        logger.error(f"❌ [{correlation_id}] Критическая ошибка турнира: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
+
+@app.post("/api/v1/consultations/tournament/stream")
+async def tournament_consultation_stream(request: Request):
+    """📡 Турнир образов (SSE): план, каждое сравнение, прошедшие в раунде и итоговый рейтинг"""
+    correlation_id = str(uuid.uuid4())
+    start_time = time.time()
+    deadline = Deadline(TOURNAMENT_TIMEOUT)
+
+    try:
+        data = await request.json()
+        user_id, occasion, preferences, images_data, layout = _tournament_request(data, correlation_id)
+
+        priority = await priority_resolver.apply(user_id)
+        advice = _generate_fallback_advice_compare(occasion, preferences, len(images_data))
+        shed = _admission_shed(user_id, priority, advice, correlation_id, start_time)
+        if shed is not None:
+            return _sse_response(_fallback_events(shed))
+        quota_retry_after = await quota_ledger.should_degrade()
+        if quota_retry_after is not None:
+            return _sse_response(_fallback_events(
+                _free_fallback_response(user_id, advice, correlation_id, start_time, quota_retry_after, _QUOTA_NOTE)))
+
+        tournament, operation_result = _start_tournament(user_id, occasion, preferences, images_data, layout,
+                                                         correlation_id, deadline,
+                                                         "/consultations/tournament/stream")
+
+        async def events():
+            stream = _tournament_events(tournament, user_id=user_id, occasion=occasion, preferences=preferences,
+                                        correlation_id=correlation_id, start_time=start_time, deadline=deadline,
+                                        operation_result=operation_result)
+            try:
+                async for event in stream:
+                    yield _sse_event(event)
+            finally:
+                await stream.aclose()
+
+        return _sse_response(events())
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ [{correlation_id}] Критическая ошибка потокового турнира: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
 
 # === ПЛАТЕЖИ ENDPOINTS ===
@@ -1730,8 +2519,19 @@ async def comprehensive_health_check():
                 },
                 "gemini_ai": {
                     "status": gemini_status,
-                    "response_time_ms": round(gemini_response_time * 1000, 2) if gemini_response_time else None
+                    "response_time_ms": round(gemini_response_time * 1000, 2) if gemini_response_time else None,
+                    "advice_cache": gemini_ai.get_cache_stats(),
+                    "limiter": gemini_ai.get_limiter_stats(),
+                    **gemini_ai.get_breaker_stats(),
+                    "routing": gemini_ai.get_routing_stats(),
+                    "api_keys": gemini_ai.get_key_pool_stats(),
+                    "quota_ledger": quota_ledger.stats(),
+                    "priority": priority_resolver.stats()
                 },
+                "image_pool": image_pool.stats(),
+                "single_flight": consultation_flights.stats(),
+                "admission": admission.stats(),
+                "warm_up": warm_up.stats(),
                 "python": {
                     "gc_collections": len(gc_stats),
                     "gc_objects": sum(stat['collected'] for stat in gc_stats)
@@ -1790,6 +2590,7 @@ async def cold_start_test():
             "operations": {k: round(v * 1000, 2) if isinstance(v, float) else v 
                          for k, v in operations.items()},
             "environment": env_vars,
+            "warm_up": warm_up.stats(),
             "timestamp": datetime.now().isoformat()
         },
         "recommendations": {
@@ -1841,7 +2642,7 @@ async def gemini_quota_diagnostics():
             import google.generativeai as genai
             genai.configure(api_key=GEMINI_API_KEY)
             model = genai.GenerativeModel('gemini-1.5-flash')
-            response = model.generate_content("Hi", 
+            response = await model.generate_content_async("Hi", 
                 generation_config=genai.types.GenerationConfig(
                     max_output_tokens=1,
                     temperature=0
@@ -1855,10 +2656,17 @@ async def gemini_quota_diagnostics():
                     "model": "gemini-1.5-flash",
                     "quota_info": {
                         "tier": "free",
-                        "daily_limit": 50,
+                        "daily_limit": GEMINI_KEY_DAILY_LIMIT,
                         "note": "Quota resets at 00:00 UTC"
                     }
                 },
+                "api_keys": gemini_ai.get_key_pool_stats(),
+                "quota_ledger": quota_ledger.stats(),
+                "usage": usage_recorder.stats(),
+                "tournament_memo": tournament_memo.stats(),
+                "limiter": gemini_ai.get_limiter_stats(),
+                **gemini_ai.get_breaker_stats(),
+                "routing": gemini_ai.get_routing_stats(),
                 "timestamp": datetime.now().isoformat()
             }
         except Exception as e:
@@ -1868,10 +2676,14 @@ async def gemini_quota_diagnostics():
                     "gemini_quota_status": {
                         "status": "quota_exceeded",
                         "error": str(e),
-                        "diagnosis": "Daily quota of 50 requests exceeded",
+                        "diagnosis": f"Daily quota of {GEMINI_KEY_DAILY_LIMIT} requests exceeded",
                         "reset_time": "00:00 UTC tomorrow",
-                        "recommendation": "Wait for quota reset or upgrade to paid tier"
+                        "recommendation": "Wait for quota reset, add keys to GEMINI_API_KEYS or upgrade to paid tier"
                     },
+                    "api_keys": gemini_ai.get_key_pool_stats(),
+                    "quota_ledger": quota_ledger.stats(),
+                    "limiter": gemini_ai.get_limiter_stats(),
+                    **gemini_ai.get_breaker_stats(),
                     "timestamp": datetime.now().isoformat()
                 }
             else:
@@ -1881,6 +2693,8 @@ async def gemini_quota_diagnostics():
                         "error": str(e),
                         "diagnosis": "API connectivity or configuration issue"
                     },
+                    "limiter": gemini_ai.get_limiter_stats(),
+                    **gemini_ai.get_breaker_stats(),
                     "timestamp": datetime.now().isoformat()
                 }
     except Exception as e:
@@ -1892,6 +2706,37 @@ async def gemini_quota_diagnostics():
             "timestamp": datetime.now().isoformat()
         }
 
+@app.get("/api/v1/diagnostics/prompts")
+async def prompt_diagnostics():
+    """🧾 Версии промптов: вызовы, токены и задержки по версиям"""
+    try:
+        return {
+            "prompts": gemini_ai.get_prompt_report(),
+            "timestamp": datetime.now().isoformat()
+        }
+    except Exception as e:
+        return {"error": str(e), "timestamp": datetime.now().isoformat()}
+
+@app.get("/api/v1/diagnostics/gemini-usage")
+async def gemini_usage_diagnostics(days: int = 7, group_by: str = "mode"):
+    """
+    📊 Расход Gemini по суткам UTC: стоимость, токены, кэш, p50/p95 задержки.
+
+    group_by: mode, endpoint, model, key_id, prompt_version, telegram_id или status.
+    """
+    if not 1 <= days <= 90:
+        raise HTTPException(status_code=400, detail="days должен быть от 1 до 90")
+    try:
+        summary = await usage_recorder.summary(days=days, group_by=group_by)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "days_requested": days,
+        **summary,
+        "recorder": usage_recorder.stats(),
+        "timestamp": datetime.now().isoformat()
+    }
+
 @app.get("/api/v1/diagnostics/render-logs")
 async def render_deployment_info():
     """📋 Информация о deployment в Render"""
@@ -0,0 +1,265 @@
+"""
+📦 МИШУРА - Batch Analysis
+Офлайн-прогон набора изображений через конвейер стилиста без HTTP
+
+Каждое изображение проходит тот же путь, что и /api/v1/consultations/analyze:
+MishuraGeminiAI.analyze_clothing_image (optimize_image -> Gemini через
+лимитер, автомат защиты и цепочку моделей -> _clean_gemini_response).
+Списаний STcoins и записи в БД нет.
+
+Источник - директория с изображениями или манифест:
+- .jsonl/.ndjson: по строке {"path": ..., "id": ..., "occasion": ..., "preferences": ...}
+- любой другой файл: по пути к изображению на строку
+
+Результаты пишутся построчно в NDJSON; файл результатов служит
+контрольной точкой: с --resume уже успешно обработанные id пропускаются.
+Без настроенного Gemini API записываются демо-ответы со статусом "demo";
+--resume их не пропускает, и после настройки ключа они прогоняются заново.
+
+Запуск:
+    python -m batch_analysis samples/ -o results.ndjson --concurrency 4
+    python -m batch_analysis manifest.jsonl -o results.ndjson --resume
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+from datetime import datetime
+from typing import Dict, Any, Iterator, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif')
+DEFAULT_OCCASION = "повседневный"
+
+
+def iter_directory(directory: str) -> Iterator[Dict[str, Any]]:
+    """Изображения директории (рекурсивно, в стабильном порядке)"""
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(root, name)
+                yield {"id": os.path.relpath(path, directory), "path": path}
+
+
+def iter_manifest(manifest: str) -> Iterator[Dict[str, Any]]:
+    """Элементы манифеста; относительные пути считаются от директории манифеста"""
+    base_dir = os.path.dirname(os.path.abspath(manifest))
+    is_ndjson = manifest.lower().endswith(('.jsonl', '.ndjson'))
+    with open(manifest, encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            item = json.loads(line) if is_ndjson else {"path": line}
+            if not item.get("path"):
+                raise ValueError(f"Строка {line_no} манифеста без path")
+            item.setdefault("id", item["path"])
+            if not os.path.isabs(item["path"]):
+                item["path"] = os.path.join(base_dir, item["path"])
+            yield item
+
+
+def iter_items(source: str) -> Iterator[Dict[str, Any]]:
+    if os.path.isdir(source):
+        return iter_directory(source)
+    return iter_manifest(source)
+
+
+def load_checkpoint(output_path: str) -> Set[str]:
+    """id, уже успешно обработанные в предыдущих запусках"""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Оборванная последняя строка после аварийной остановки
+                continue
+            if record.get("status") == "ok":
+                done.add(record.get("id"))
+    return done
+
+
+def _percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+class BatchRunner:
+    """📦 Ограниченный пул воркеров поверх MishuraGeminiAI"""
+
+    def __init__(self, gemini_ai, output, concurrency: int = 4, occasion: str = DEFAULT_OCCASION,
+                 preferences: str = "", skip_ids: Optional[Set[str]] = None):
+        self.gemini_ai = gemini_ai
+        self.output = output
+        self.concurrency = max(1, concurrency)
+        self.occasion = occasion
+        self.preferences = preferences
+        self.skip_ids = skip_ids or set()
+        self.latencies: List[float] = []
+        self.counters = {
+            'ok': 0,
+            'demo': 0,
+            'failed': 0,
+            'skipped': 0,
+            'cache_hits': 0,
+            'input_tokens': 0,
+            'output_tokens': 0
+        }
+
+    async def _process(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        occasion = item.get("occasion") or self.occasion
+        preferences = item.get("preferences", self.preferences)
+        record = {"id": item["id"], "path": item["path"], "occasion": occasion}
+        meta: Dict[str, Any] = {}
+        started = time.monotonic()
+        try:
+            image_data = await asyncio.to_thread(_read_file, item["path"])
+            advice = await self.gemini_ai.analyze_clothing_image(image_data, occasion, preferences, meta=meta)
+            # Демо-ответ не настоящий анализ: статус "demo" не считается готовым для --resume
+            status = "ok" if self.gemini_ai.api_configured else "demo"
+            record.update(status=status, advice=advice)
+        except Exception as e:
+            record.update(status="error", error=f"{type(e).__name__}: {e}")
+        latency = time.monotonic() - started
+        record.update(
+            latency_ms=round(latency * 1000),
+            model=meta.get("model"),
+            prompt_version=meta.get("prompt_version"),
+            cache_hit=meta.get("cache_hit", False),
+            input_tokens=meta.get("input_tokens"),
+            output_tokens=meta.get("output_tokens"),
+            finished_at=datetime.now().isoformat()
+        )
+        if record["status"] == "ok":
+            self.counters['ok'] += 1
+            self.latencies.append(latency)
+        elif record["status"] == "demo":
+            self.counters['demo'] += 1
+        else:
+            self.counters['failed'] += 1
+        self.counters['cache_hits'] += int(bool(record["cache_hit"]))
+        self.counters['input_tokens'] += record["input_tokens"] or 0
+        self.counters['output_tokens'] += record["output_tokens"] or 0
+        return record
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        # Строка на запись и flush: файл остается годной контрольной точкой при остановке
+        self.output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.output.flush()
+
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        while True:
+            item = await queue.get()
+            try:
+                if item is None:
+                    return
+                record = await self._process(item)
+                self._write(record)
+                status = {"ok": "✅", "demo": "🧪"}.get(record["status"], "❌")
+                logger.info(f"{status} {record['id']} за {record['latency_ms']} мс")
+            finally:
+                queue.task_done()
+
+    async def run(self, items: Iterator[Dict[str, Any]]) -> Dict[str, Any]:
+        """Прогнать элементы; очередь ограничена, поэтому источник читается по мере обработки"""
+        started = time.monotonic()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.concurrency)]
+        try:
+            for item in items:
+                if item["id"] in self.skip_ids:
+                    self.counters['skipped'] += 1
+                    continue
+                await queue.put(item)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+        return self.summary(time.monotonic() - started)
+
+    def summary(self, elapsed: float) -> Dict[str, Any]:
+        processed = self.counters['ok'] + self.counters['demo'] + self.counters['failed']
+        p50 = _percentile(self.latencies, 50)
+        p95 = _percentile(self.latencies, 95)
+        return {
+            **self.counters,
+            'processed': processed,
+            'concurrency': self.concurrency,
+            'elapsed_s': round(elapsed, 2),
+            'throughput_per_min': round(processed / elapsed * 60, 2) if elapsed > 0 else None,
+            'p50_latency_ms': round(p50 * 1000) if p50 is not None else None,
+            'p95_latency_ms': round(p95 * 1000) if p95 is not None else None,
+            'max_latency_ms': round(max(self.latencies) * 1000) if self.latencies else None
+        }
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m batch_analysis",
+        description="Офлайн-анализ набора изображений через конвейер стилиста МИШУРА"
+    )
+    parser.add_argument("source", help="Директория с изображениями или манифест (.jsonl или список путей)")
+    parser.add_argument("-o", "--output", default="batch_results.ndjson", help="Файл результатов NDJSON")
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="Число одновременно обрабатываемых изображений")
+    parser.add_argument("--occasion", default=DEFAULT_OCCASION, help="Повод по умолчанию")
+    parser.add_argument("--preferences", default="", help="Пожелания по умолчанию")
+    parser.add_argument("--resume", action="store_true", help="Пропустить id, уже успешно записанные в файл результатов")
+    parser.add_argument("--no-cache", action="store_true", help="Не использовать кэш советов (каждое изображение идет в Gemini)")
+    return parser.parse_args(argv)
+
+
+async def run_batch(args: argparse.Namespace) -> Dict[str, Any]:
+    # Импорт после разбора аргументов: --no-cache должен попасть в окружение до создания кэша
+    from gemini_ai import MishuraGeminiAI
+    from image_processing import image_pool
+
+    skip_ids = load_checkpoint(args.output) if args.resume else set()
+    if skip_ids:
+        logger.info(f"↩️ Контрольная точка: пропускаем {len(skip_ids)} уже обработанных")
+
+    try:
+        with open(args.output, 'a' if args.resume else 'w', encoding='utf-8') as output:
+            runner = BatchRunner(
+                MishuraGeminiAI(), output,
+                concurrency=args.concurrency,
+                occasion=args.occasion,
+                preferences=args.preferences,
+                skip_ids=skip_ids
+            )
+            return await runner.run(iter_items(args.source))
+    finally:
+        image_pool.shutdown()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    if args.no_cache:
+        os.environ['ADVICE_CACHE_ENABLED'] = 'false'
+    logging.basicConfig(level=logging.INFO)
+
+    summary = asyncio.run(run_batch(args))
+    print("📊 Итог прогона:", file=sys.stderr)
+    print(json.dumps(summary, ensure_ascii=False, indent=2), file=sys.stderr)
+    return 0 if summary['failed'] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,129 @@
+"""
+📊 МИШУРА - Benchmark: автообрезка фона перед кодированием для Gemini
+
+Сравнивает image_processing.optimize_image_bytes без обрезки и с ней
+(autocrop=True): время подготовки, объем JPEG, размер кадра и оценку
+токенов изображения. Токены оцениваются по правилу тайлов Gemini 2.0:
+кадр не больше 384 px по обеим сторонам - 258 токенов, иначе 258 токенов
+на каждый тайл 768x768 (Gemini 1.5 берет 258 токенов за любое изображение,
+там выигрыш - только объем загрузки).
+
+Запуск:
+    python benchmarks/bench_autocrop.py                 # синтетические фото
+    python benchmarks/bench_autocrop.py photos/*.jpg    # свои фото
+"""
+
+import os
+import sys
+import math
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw, ImageFilter
+
+REPEATS = 5
+TOKENS_PER_TILE = 258
+
+# (размер, фон, доля ширины кадра, занятая человеком)
+SYNTHETIC_PHOTOS = [
+    ((3024, 4032), 'wall', 0.30),
+    ((3024, 4032), 'mirror', 0.45),
+    ((4000, 3000), 'wall', 0.25),
+    ((1600, 1200), 'floor', 0.35),
+    ((1200, 1600), 'busy', 0.40),
+]
+
+
+def make_outfit_photo(size, background: str, figure_share: float) -> bytes:
+    """Человек по центру однородного фона: стена, зеркало (рамка), пол или пестрый фон"""
+    width, height = size
+    if background == 'busy':
+        img = Image.effect_noise(size, 90).convert('RGB').filter(ImageFilter.GaussianBlur(2))
+    else:
+        img = Image.linear_gradient('L').resize(size).convert('RGB')
+        img = Image.blend(img, Image.new('RGB', size, (214, 206, 196)), 0.85)
+    draw = ImageDraw.Draw(img)
+    if background == 'mirror':
+        draw.rectangle((width * 0.12, height * 0.03, width * 0.88, height * 0.97), outline=(90, 70, 50),
+                       width=max(4, width // 150))
+    if background == 'floor':
+        draw.rectangle((0, height * 0.8, width, height), fill=(150, 120, 90))
+
+    center = width / 2
+    half = width * figure_share / 2
+    draw.ellipse((center - half * 0.35, height * 0.06, center + half * 0.35, height * 0.2), fill=(228, 182, 160))
+    draw.rectangle((center - half, height * 0.2, center + half, height * 0.58), fill=(128, 42, 64))
+    draw.rectangle((center - half * 0.8, height * 0.58, center + half * 0.8, height * 0.93), fill=(32, 36, 92))
+    noise = Image.effect_noise(size, 30).convert('RGB')
+    img = Image.blend(img, noise, 0.12).filter(ImageFilter.SMOOTH)
+    out = BytesIO()
+    img.save(out, format='JPEG', quality=92)
+    return out.getvalue()
+
+
+def image_tokens(size) -> int:
+    width, height = size
+    if width <= 384 and height <= 384:
+        return TOKENS_PER_TILE
+    return math.ceil(width / 768) * math.ceil(height / 768) * TOKENS_PER_TILE
+
+
+def measure(data: bytes, autocrop: bool) -> dict:
+    from image_processing import optimize_image_bytes
+
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = optimize_image_bytes(data, autocrop=autocrop)
+        timings.append(time.perf_counter() - start)
+    size = Image.open(BytesIO(result)).size
+    return {
+        'median_ms': sorted(timings)[len(timings) // 2] * 1000,
+        'bytes': len(result),
+        'size': size,
+        'tokens': image_tokens(size)
+    }
+
+
+def main(paths):
+    import logging
+    logging.disable(logging.CRITICAL)
+    from image_processing import NUMPY_AVAILABLE
+    if not NUMPY_AVAILABLE:
+        print("❌ NumPy не установлен - автообрезка недоступна")
+        return 1
+
+    samples = []
+    if paths:
+        for path in paths:
+            with open(path, 'rb') as f:
+                samples.append((os.path.basename(path), f.read()))
+    else:
+        for size, background, share in SYNTHETIC_PHOTOS:
+            samples.append((f"{size[0]}x{size[1]} {background}", make_outfit_photo(size, background, share)))
+
+    totals = {False: {'bytes': 0, 'ms': 0.0, 'tokens': 0}, True: {'bytes': 0, 'ms': 0.0, 'tokens': 0}}
+    for name, data in samples:
+        print(f"\n📷 {name} {len(data) // 1024} KB")
+        for autocrop in (False, True):
+            result = measure(data, autocrop)
+            totals[autocrop]['bytes'] += result['bytes']
+            totals[autocrop]['ms'] += result['median_ms']
+            totals[autocrop]['tokens'] += result['tokens']
+            label = 'autocrop' if autocrop else 'baseline'
+            print(f"   {label:<9} {result['median_ms']:>7.1f} ms   -> {result['size'][0]}x{result['size'][1]} "
+                  f"{result['bytes'] // 1024:>4} KB   ~{result['tokens']} токенов")
+
+    base, crop = totals[False], totals[True]
+    print(f"\n📊 Итого по {len(samples)} фото:")
+    print(f"   объем:   {base['bytes'] // 1024} KB -> {crop['bytes'] // 1024} KB "
+          f"({(1 - crop['bytes'] / base['bytes']) * 100:.1f}% экономии)")
+    print(f"   токены:  {base['tokens']} -> {crop['tokens']} (оценка для тайлов Gemini 2.0)")
+    print(f"   время:   {base['ms']:.1f} ms -> {crop['ms']:.1f} ms ({crop['ms'] - base['ms']:+.1f} ms)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
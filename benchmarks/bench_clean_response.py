@@ -0,0 +1,129 @@
+"""
+📊 МИШУРА - Benchmark: очистка ответа Gemini
+
+1. Сверяет текущий gemini_ai._clean_gemini_response с прежней реализацией
+   (16 проходов re.sub с DOTALL) на корпусе ответов benchmarks/data/gemini_responses.json:
+   вывод должен совпадать побайтно.
+2. Замеряет обе реализации на ответах 2-50 KB: обычный текст и строки,
+   на которых прежние шаблоны уходят в квадратичный перебор.
+
+На склеенных ответах вывод может отличаться ("≠"): прежние шаблоны вида
+"Надеюсь.*помогли?" с DOTALL захватывали текст от первого "Надеюсь" до
+последнего "помог" во всем ответе, вырезая целые абзацы. Новая версия
+применяет каждую фразу в пределах строки.
+
+Запуск:
+    python benchmarks/bench_clean_response.py
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.disable(logging.CRITICAL)
+
+from gemini_ai import _clean_gemini_response
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'gemini_responses.json')
+SIZES_KB = [2, 5, 10, 20, 50]
+REPEATS = 5
+
+
+def legacy_clean(response: str) -> str:
+    """Реализация _clean_gemini_response до однопроходной версии"""
+    if not response:
+        return response
+    meta_patterns = [
+        r"Я проанализировал.*?(?=\n|$)",
+        r"Анализируя.*?(?=\n|$)",
+        r"При анализе.*?(?=\n|$)",
+        r"Исходя из анализа.*?(?=\n|$)",
+        r"Как ИИ-стилист.*?(?=\n|$)",
+        r"В качестве ИИ.*?(?=\n|$)",
+        r"Я как ИИ.*?(?=\n|$)",
+        r"Надеюсь.*помогли?.*?(?=\n|$)",
+        r"Если у вас есть.*вопросы.*?(?=\n|$)",
+        r"Буду рад.*помочь.*?(?=\n|$)",
+        r"Пожалуйста.*дайте знать.*?(?=\n|$)",
+        r"Обратите внимание.*качество.*?(?=\n|$)",
+        r"Учтите что.*ограничения.*?(?=\n|$)",
+        r"В заключение.*?(?=\n|$)",
+        r"Подводя итог.*?(?=\n|$)",
+        r"Таким образом.*?(?=\n|$)"
+    ]
+    cleaned = response.strip()
+    for pattern in meta_patterns:
+        cleaned = re.sub(pattern, "", cleaned, flags=re.IGNORECASE | re.DOTALL)
+    cleaned = re.sub(r'\n\s*\n\s*\n', '\n\n', cleaned)
+    cleaned = cleaned.strip()
+    if len(cleaned) < len(response) * 0.3:
+        return response
+    return cleaned
+
+
+def load_corpus():
+    with open(CORPUS_PATH, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def check_golden(corpus) -> bool:
+    """Побайтная сверка с прежней реализацией"""
+    mismatches = 0
+    for item in corpus:
+        expected = legacy_clean(item['response'])
+        actual = _clean_gemini_response(item['response'])
+        if actual != expected:
+            mismatches += 1
+            print(f"   ❌ {item['name']}\n      ожидалось: {expected!r}\n      получено:  {actual!r}")
+    print(f"🔎 Корпус: {len(corpus)} ответов, расхождений: {mismatches}")
+    return mismatches == 0
+
+
+def make_typical(corpus, size_kb: int) -> str:
+    """Обычный ответ нужного размера из склеенных ответов корпуса"""
+    text = ""
+    index = 0
+    while len(text.encode('utf-8')) < size_kb * 1024:
+        text += corpus[index % len(corpus)]['response'] + "\n\n"
+        index += 1
+    return text
+
+
+def make_adversarial(size_kb: int) -> str:
+    """Много "Надеюсь" без "помогли" и пустые строки из пробелов - худший случай для DOTALL-шаблонов"""
+    line = "Надеюсь, образ подойдёт. Если у вас есть сомнения, примерьте ещё раз.\n   \n"
+    return line * max(1, size_kb * 1024 // len(line.encode('utf-8')))
+
+
+def measure(func, text: str) -> float:
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        func(text)
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2] * 1000
+
+
+def main():
+    corpus = load_corpus()
+    ok = check_golden(corpus)
+
+    for label, make in (('typical', lambda kb: make_typical(corpus, kb)), ('adversarial', make_adversarial)):
+        print(f"\n⏱️ {label}")
+        for size_kb in SIZES_KB:
+            text = make(size_kb)
+            legacy_ms = measure(legacy_clean, text)
+            current_ms = measure(_clean_gemini_response, text)
+            same = "=" if legacy_clean(text) == _clean_gemini_response(text) else "≠"
+            print(f"   {size_kb:>3} KB   legacy {legacy_ms:>10.2f} ms   line-pass {current_ms:>8.2f} ms   "
+                  f"x{legacy_ms / current_ms:>8.1f}   вывод {same}")
+
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
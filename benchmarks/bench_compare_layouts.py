@@ -0,0 +1,171 @@
+"""
+📊 МИШУРА - Benchmark: виды сравнения образов
+
+Для 2, 3 и 4 образов сравнивает подготовку изображений для layout=images
+(каждый образ отдельным изображением) и layout=collage (одна сетка с
+пронумерованными панелями):
+- подготовка в пуле обработки изображений (медиана, после прогрева)
+- объем загрузки, число изображений и оценка токенов изображений
+  (Gemini 1.5 - 258 токенов за изображение, Gemini 2.0 - 258 за тайл 768x768)
+
+С --live дополнительно выполняет сравнения всех видов, включая
+layout=fanout (параллельные описания образов и текстовое сравнение), через
+gemini_ai (нужен GEMINI_API_KEY) и сообщает задержку ответа, токены
+запроса/ответа из usage_metadata и качество ответа. Кэш советов работает
+во временной директории: первый раунд fanout описывает образы, следующие
+берут описания из кэша (как повторные сравнения с теми же фото):
+- охват - доля образов 1..N, упомянутых в ответе
+- лучший образ - номер после «лучший»; совпадение выбора с layout=images
+
+Запуск:
+    python benchmarks/bench_compare_layouts.py
+    python benchmarks/bench_compare_layouts.py --live --rounds 3
+    python benchmarks/bench_compare_layouts.py --live photos/a.jpg photos/b.jpg photos/c.jpg photos/d.jpg
+"""
+
+import os
+import re
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+from bench_autocrop import SYNTHETIC_PHOTOS, TOKENS_PER_TILE, image_tokens, make_outfit_photo
+
+REPEATS = 5
+PREPARED_LAYOUTS = ('images', 'collage')
+_BEST_PATTERN = re.compile(r'лучш\w*[^\d\n]{0,40}?(\d)', re.IGNORECASE)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Виды сравнения образов: изображения, коллаж, веер")
+    parser.add_argument("photos", nargs="*", help="Свои фото (2-4); по умолчанию синтетические")
+    parser.add_argument("--live", action="store_true", help="Выполнить сравнения через Gemini")
+    parser.add_argument("--rounds", type=int, default=2, help="Повторов каждого live-сравнения")
+    parser.add_argument("--occasion", default="офис")
+    return parser.parse_args()
+
+
+async def prepare(photos, layout: str):
+    from gemini_ai import _prepare_comparison_images
+    return await _prepare_comparison_images(photos, layout, None)
+
+
+async def measure_prepare(photos, layout: str) -> dict:
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        images = await prepare(photos, layout)
+        timings.append(time.perf_counter() - start)
+    sizes = [Image.open(BytesIO(data)).size for data in images]
+    return {
+        'median_ms': sorted(timings)[len(timings) // 2] * 1000,
+        'images': len(images),
+        'bytes': sum(len(data) for data in images),
+        'tokens_15': len(images) * TOKENS_PER_TILE,
+        'tokens_20': sum(image_tokens(size) for size in sizes),
+        'sizes': sizes
+    }
+
+
+def mentioned_outfits(text: str, count: int) -> set:
+    return {n for n in range(1, count + 1) if re.search(rf'(образ\w*|№|#)\s*{n}\b|^\s*{n}[.)]', text,
+                                                       re.IGNORECASE | re.MULTILINE)}
+
+
+def best_outfit(text: str):
+    match = _BEST_PATTERN.search(text)
+    return int(match.group(1)) if match else None
+
+
+async def measure_live(photos, layout: str, occasion: str, rounds: int) -> dict:
+    from gemini_ai import compare_clothing_images
+    results = []
+    card_cache_hits = []
+    for round_index in range(rounds):
+        meta = {}
+        start = time.perf_counter()
+        # Пожелания различаются по раундам: ответы не склеиваются и не берутся из кэша
+        text = await compare_clothing_images(photos, occasion, f"раунд {round_index + 1}", meta=meta, layout=layout)
+        results.append({
+            'ms': (time.perf_counter() - start) * 1000,
+            'input_tokens': meta.get('input_tokens'),
+            'output_tokens': meta.get('output_tokens'),
+            'coverage': len(mentioned_outfits(text, len(photos))) / len(photos),
+            'best': best_outfit(text)
+        })
+        if 'fanout' in meta:
+            card_cache_hits.append(meta['fanout']['card_cache_hits'])
+    return {
+        'first_ms': results[0]['ms'],
+        'median_ms': sorted(r['ms'] for r in results)[len(results) // 2],
+        'input_tokens': [r['input_tokens'] for r in results],
+        'output_tokens': [r['output_tokens'] for r in results],
+        'coverage': sum(r['coverage'] for r in results) / len(results),
+        'best': [r['best'] for r in results],
+        'card_cache_hits': card_cache_hits
+    }
+
+
+async def main(args) -> int:
+    import logging
+    logging.disable(logging.CRITICAL)
+    if args.live:
+        os.environ['ADVICE_CACHE_DIR'] = tempfile.mkdtemp(prefix='mishura_bench_cache_')
+    from image_processing import image_pool
+
+    if args.photos:
+        if not 2 <= len(args.photos) <= 4:
+            print("❌ Нужно от 2 до 4 фото")
+            return 1
+        photos = []
+        for path in args.photos:
+            with open(path, 'rb') as f:
+                photos.append(f.read())
+        counts = [len(photos)]
+    else:
+        photos = [make_outfit_photo(size, background, share) for size, background, share in SYNTHETIC_PHOTOS[:4]]
+        counts = [2, 3, 4]
+
+    await image_pool.warm_up()
+    try:
+        for count in counts:
+            sample = photos[:count]
+            print(f"\n⚖️ Образов: {count}")
+            for layout in PREPARED_LAYOUTS:
+                result = await measure_prepare(sample, layout)
+                sizes = ', '.join(f"{w}x{h}" for w, h in result['sizes'])
+                print(f"   {layout:<8} подготовка {result['median_ms']:>6.1f} ms   {result['images']} изобр. "
+                      f"{result['bytes'] // 1024:>4} KB   токены изобр. ~{result['tokens_15']} (1.5) / "
+                      f"~{result['tokens_20']} (2.0)   [{sizes}]")
+
+            if not args.live:
+                continue
+            import gemini_ai
+            if not gemini_ai.API_CONFIGURED_SUCCESSFULLY:
+                print("   ⚠️ Gemini не сконфигурирован - live-сравнение пропущено")
+                continue
+            picks = {}
+            for layout in gemini_ai.COMPARE_LAYOUTS:
+                result = await measure_live(sample, layout, args.occasion, args.rounds)
+                picks[layout] = result['best']
+                cards = f"   описаний из кэша {result['card_cache_hits']}" if result['card_cache_hits'] else ""
+                print(f"   {layout:<8} ответ {result['median_ms']:>7.0f} ms (первый {result['first_ms']:.0f} ms)   "
+                      f"токены запроса {result['input_tokens']} ответа {result['output_tokens']}   "
+                      f"охват {result['coverage'] * 100:.0f}%   лучший {result['best']}{cards}")
+            for layout in gemini_ai.COMPARE_LAYOUTS[1:]:
+                agreement = sum(a == b and a is not None for a, b in zip(picks['images'], picks[layout]))
+                print(f"   {layout}: совпадение лучшего образа с images {agreement}/{args.rounds}")
+    finally:
+        image_pool.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main(parse_args())))
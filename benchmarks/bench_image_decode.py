@@ -0,0 +1,132 @@
+"""
+📊 МИШУРА - Benchmark: декодирование и оптимизация фото для Gemini
+
+Сравнивает прежний путь (полное декодирование + LANCZOS) с текущим
+image_processing.optimize_image_bytes (JPEG draft/DCT scaling + reducing_gap).
+Каждый вариант запускается в отдельном процессе, чтобы пиковый RSS
+не смешивался между замерами.
+
+Запуск:
+    python benchmarks/bench_image_decode.py                 # синтетические фото
+    python benchmarks/bench_image_decode.py photos/*.jpg    # свои фото
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import subprocess
+import tempfile
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw, ImageFilter
+
+REPEATS = 5
+SYNTHETIC_SIZES = [(4000, 3000), (3024, 4032), (1600, 1200)]
+
+
+def legacy_optimize(image_data: bytes, max_size: int = 1024, quality: int = 85) -> bytes:
+    """Реализация optimize_image до появления JPEG fast path"""
+    img_pil = Image.open(BytesIO(image_data))
+    width, height = img_pil.size
+    if width > max_size or height > max_size:
+        if width > height:
+            new_size = (max_size, int(height * (max_size / width)))
+        else:
+            new_size = (int(width * (max_size / height)), max_size)
+        img_pil = img_pil.resize(new_size, Image.Resampling.LANCZOS)
+    if img_pil.mode != 'RGB':
+        img_pil = img_pil.convert('RGB')
+    out = BytesIO()
+    img_pil.save(out, format='JPEG', quality=quality, optimize=True)
+    return out.getvalue()
+
+
+def make_synthetic_photo(size) -> bytes:
+    """Фото-подобная картинка: градиент фона, фигура, шум текстуры, EXIF-ориентация"""
+    width, height = size
+    img = Image.linear_gradient('L').resize(size).convert('RGB')
+    draw = ImageDraw.Draw(img)
+    draw.ellipse((width * 0.3, height * 0.1, width * 0.7, height * 0.95), fill=(120, 40, 60))
+    noise = Image.effect_noise(size, 40).convert('RGB')
+    img = Image.blend(img, noise, 0.25).filter(ImageFilter.SMOOTH)
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation: повернуто на 90°
+    out = BytesIO()
+    img.save(out, format='JPEG', quality=92, exif=exif)
+    return out.getvalue()
+
+
+def peak_rss_mb() -> float:
+    """Пиковый RSS процесса (VmHWM не наследуется через exec, в отличие от ru_maxrss)"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def run_variant(variant: str, path: str) -> dict:
+    """Замер внутри дочернего процесса"""
+    from image_processing import optimize_image_bytes
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    func = legacy_optimize if variant == 'legacy' else optimize_image_bytes
+
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = func(data)
+        timings.append(time.perf_counter() - start)
+
+    output = Image.open(BytesIO(result))
+    return {
+        'variant': variant,
+        'median_ms': round(sorted(timings)[len(timings) // 2] * 1000, 1),
+        'peak_rss_mb': peak_rss_mb(),
+        'output_size': output.size,
+        'output_bytes': len(result)
+    }
+
+
+def main(paths):
+    cleanup = []
+    if not paths:
+        for size in SYNTHETIC_SIZES:
+            fd, path = tempfile.mkstemp(suffix=f'_{size[0]}x{size[1]}.jpg')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(make_synthetic_photo(size))
+            paths.append(path)
+            cleanup.append(path)
+
+    try:
+        for path in paths:
+            with Image.open(path) as img:
+                print(f"\n📷 {os.path.basename(path)} {img.size[0]}x{img.size[1]} {os.path.getsize(path) // 1024} KB")
+            for variant in ('legacy', 'fast_path'):
+                proc = subprocess.run(
+                    [sys.executable, __file__, '--child', variant, path],
+                    capture_output=True, text=True, check=True
+                )
+                result = json.loads(proc.stdout.strip().splitlines()[-1])
+                print(f"   {variant:<10} {result['median_ms']:>8} ms   peak RSS {result['peak_rss_mb']:>7} MB   "
+                      f"-> {result['output_size'][0]}x{result['output_size'][1]} {result['output_bytes'] // 1024} KB")
+    finally:
+        for path in cleanup:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--child':
+        import logging
+        logging.disable(logging.CRITICAL)
+        print(json.dumps(run_variant(sys.argv[2], sys.argv[3])))
+    else:
+        main(sys.argv[1:])
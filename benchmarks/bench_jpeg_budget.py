@@ -0,0 +1,96 @@
+"""
+📊 МИШУРА - Benchmark: кодирование JPEG под бюджет байт
+
+Сравнивает прежнее кодирование (quality=85) с encode_jpeg_budget для
+бюджетов режимов: анализ (одно фото) и сравнение 4 образов (бюджет режима
+делится между фото). Для каждого варианта - объем, SSIM относительно
+исходного кадра (та же метрика, что в поиске) и время кодирования.
+
+Запуск:
+    python benchmarks/bench_jpeg_budget.py                 # синтетические фото
+    python benchmarks/bench_jpeg_budget.py photos/*.jpg    # свои фото
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+from bench_autocrop import SYNTHETIC_PHOTOS, make_outfit_photo
+
+REPEATS = 3
+
+
+def prepare(data: bytes) -> Image.Image:
+    """Кадр в том виде, в каком он попадает на кодирование (декодирование + ресайз)"""
+    from image_processing import DEFAULT_MAX_SIZE, RESIZE_REDUCING_GAP, _fit_size, decode_image
+
+    img = decode_image(data)
+    new_size = _fit_size(*img.size, DEFAULT_MAX_SIZE)
+    if new_size:
+        img = img.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+    return img.convert('RGB')
+
+
+def measure(encode) -> tuple:
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = encode()
+        timings.append(time.perf_counter() - start)
+    return result, sorted(timings)[len(timings) // 2] * 1000
+
+
+def main(paths):
+    import logging
+    logging.disable(logging.CRITICAL)
+    from image_processing import (DEFAULT_QUALITY, IMAGE_JPEG_MIN_SSIM, NUMPY_AVAILABLE, _encode_jpeg,
+                                  _ssim_planes, encode_jpeg_budget, image_byte_budget, jpeg_ssim)
+    if not NUMPY_AVAILABLE:
+        print("❌ NumPy не установлен - SSIM недоступен")
+        return 1
+
+    samples = []
+    if paths:
+        for path in paths:
+            with open(path, 'rb') as f:
+                samples.append((os.path.basename(path), f.read()))
+    else:
+        for size, background, share in SYNTHETIC_PHOTOS:
+            samples.append((f"{size[0]}x{size[1]} {background}", make_outfit_photo(size, background, share)))
+
+    budgets = [('analyze', image_byte_budget('analyze', 1)), ('compare x4', image_byte_budget('compare', 4))]
+    print(f"Порог SSIM {IMAGE_JPEG_MIN_SSIM}; бюджеты на фото: " +
+          ", ".join(f"{name} {budget}" for name, budget in budgets))
+
+    totals = {'q85': [0, 0.0]}
+    for name, data in samples:
+        img = prepare(data)
+        reference = _ssim_planes(img)
+        print(f"\n📷 {name} -> {img.size[0]}x{img.size[1]}")
+        result, ms = measure(lambda: _encode_jpeg(img, DEFAULT_QUALITY))
+        totals['q85'][0] += len(result)
+        totals['q85'][1] += ms
+        print(f"   q{DEFAULT_QUALITY:<13} {len(result) // 1024:>4} KB   SSIM {jpeg_ssim(reference, result):.4f}   {ms:>6.1f} ms")
+        for label, budget in budgets:
+            if budget is None:
+                continue
+            result, ms = measure(lambda: encode_jpeg_budget(img, budget))
+            totals.setdefault(label, [0, 0.0])
+            totals[label][0] += len(result)
+            totals[label][1] += ms
+            print(f"   {label:<14} {len(result) // 1024:>4} KB   SSIM {jpeg_ssim(reference, result):.4f}   {ms:>6.1f} ms")
+
+    print(f"\n📊 Итого по {len(samples)} фото:")
+    base_bytes, base_ms = totals['q85']
+    for label, (total_bytes, total_ms) in totals.items():
+        print(f"   {label:<14} {total_bytes // 1024:>5} KB ({(total_bytes / base_bytes - 1) * 100:+.1f}%)   "
+              f"{total_ms:>7.1f} ms ({total_ms - base_ms:+.1f} ms)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
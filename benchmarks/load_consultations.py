@@ -0,0 +1,144 @@
+"""
+📊 МИШУРА - Load test: консультации на локальной имитации Gemini
+
+Поднимает приложение api.py в процессе (lifespan: БД, финансовая
+безопасность, Gemini AI) с GEMINI_TRANSPORT=fake и временной SQLite-базой
+и отправляет параллельные запросы /api/v1/consultations/analyze и /compare.
+Проходят все стадии: декодирование, пул обработки изображений, лимитер,
+автомат защиты, списания/возвраты STcoins и сохранение консультаций.
+
+Запуск:
+    python benchmarks/load_consultations.py --requests 200 --concurrency 20 --profile realistic
+    python benchmarks/load_consultations.py --profile degraded
+    python benchmarks/load_consultations.py --profile '{"latency_median_s": 0.5, "rate_429": 0.05}'
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import base64
+import random
+import asyncio
+import argparse
+import logging
+import tempfile
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон консультаций на имитации Gemini")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--profile", default="fast", help="Профиль имитации: имя или JSON")
+    parser.add_argument("--compare-share", type=float, default=0.2, help="Доля запросов сравнения")
+    parser.add_argument("--users", type=int, default=50)
+    return parser.parse_args()
+
+
+def make_image(seed: int) -> str:
+    """Уникальное изображение: кэш советов и склейка запросов не срабатывают"""
+    from PIL import Image, ImageDraw
+    rng = random.Random(seed)
+    img = Image.new('RGB', (1200, 1600), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(20):
+        x, y = rng.randrange(1200), rng.randrange(1600)
+        draw.rectangle([x, y, x + 200, y + 300], fill=tuple(rng.randrange(256) for _ in range(3)))
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=90)
+    return base64.b64encode(buf.getvalue()).decode()
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+async def run(args) -> dict:
+    import httpx
+    import api
+
+    async with api.app.router.lifespan_context(api.app):
+        # Замеры - на прогретом процессе, как после готовности в продакшене
+        await api.warm_up.wait(60)
+        user_ids = list(range(9_000_000, 9_000_000 + args.users))
+        for user_id in user_ids:
+            api.db.save_user(user_id, username=f"load_{user_id}")
+            api.db.update_user_balance(user_id, 100_000, "load_test_topup")
+
+        images = [make_image(seed) for seed in range(max(8, args.concurrency))]
+        queue: asyncio.Queue = asyncio.Queue()
+        for index in range(args.requests):
+            queue.put_nowait(index)
+
+        statuses: Counter = Counter()
+        latencies = []
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://load", timeout=300) as client:
+            async def worker():
+                while not queue.empty():
+                    index = queue.get_nowait()
+                    user_id = user_ids[index % len(user_ids)]
+                    # Индекс в пожеланиях - запросы не совпадают между собой
+                    body = {"user_id": user_id, "occasion": "работа", "preferences": f"запрос {index}"}
+                    if random.random() < args.compare_share:
+                        endpoint = "/api/v1/consultations/compare"
+                        body["images_data"] = random.sample(images, 2)
+                    else:
+                        endpoint = "/api/v1/consultations/analyze"
+                        body["image_data"] = random.choice(images)
+                    started = time.perf_counter()
+                    response = await client.post(endpoint, json=body)
+                    latencies.append(time.perf_counter() - started)
+                    status = response.json().get("status", response.status_code) if response.status_code == 200 \
+                        else response.status_code
+                    statuses[str(status)] += 1
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+            elapsed = time.perf_counter() - started
+
+        info = api.gemini_ai.get_model_info()
+        return {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "elapsed_s": round(elapsed, 2),
+            "throughput_rps": round(args.requests / elapsed, 2),
+            "p50_ms": round(percentile(latencies, 50) * 1000),
+            "p95_ms": round(percentile(latencies, 95) * 1000),
+            "p99_ms": round(percentile(latencies, 99) * 1000),
+            "statuses": dict(statuses),
+            "limiter": info["limiter"],
+            "circuit_breaker": info["circuit_breaker"],
+            "image_pool": api.image_pool.stats(),
+            "admission": api.admission.stats(),
+            "database": api.db.get_stats()
+        }
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="mishura_load_")
+    os.environ.update(
+        GEMINI_TRANSPORT="fake",
+        GEMINI_FAKE_PROFILE=args.profile,
+        DATABASE_PATH=os.path.join(workdir, "load.db"),
+        ADVICE_CACHE_ENABLED="false",
+        ENVIRONMENT="development"
+    )
+    os.environ.pop("DATABASE_URL", None)
+    logging.disable(logging.WARNING)
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -71,6 +71,13 @@ def get_database_config():
 # Глобальная конфигурация БД
 DB_CONFIG = get_database_config()
 
+# Колонки таблицы gemini_usage (расход Gemini по консультациям)
+GEMINI_USAGE_COLUMNS = [
+    'consultation_id', 'correlation_id', 'telegram_id', 'mode', 'endpoint', 'status', 'model', 'key_id',
+    'prompt_version', 'input_tokens', 'output_tokens', 'image_count', 'image_bytes', 'latency_ms',
+    'attempts', 'cache_hit', 'cost_usd', 'created_ts'
+]
+
 class MishuraDB:
     """
     🎭 МИШУРА Database Class
@@ -97,6 +104,12 @@ class MishuraDB:
         # 🆕 СОЗДАНИЕ ТАБЛИЦ ОТЗЫВОВ
         self.create_feedback_tables()
         
+        # 🔑 Учет квоты Gemini (общий для всех воркеров)
+        self.create_gemini_quota_table()
+        
+        # 📊 Учет расхода Gemini по консультациям
+        self.create_gemini_usage_table()
+        
         self.logger.info(f"✅ MishuraDB инициализирована")
     
     def get_connection(self):
@@ -750,6 +763,20 @@ class MishuraDB:
             self.logger.error(f"❌ Ошибка получения ожидающих платежей: {e}")
             return []
 
+    def get_succeeded_payment_plans(self, telegram_id: int, since: datetime) -> Dict[str, int]:
+        """Число успешных платежей пользователя по тарифам начиная с since (UTC)"""
+        try:
+            query = """
+                SELECT plan_id, COUNT(*) FROM payments
+                WHERE telegram_id = ? AND status = 'succeeded' AND created_at >= ?
+                GROUP BY plan_id
+            """
+            rows = self._execute_query(query, (telegram_id, since.strftime('%Y-%m-%d %H:%M:%S')), fetch_all=True)
+            return {plan_id: count for plan_id, count in rows or []}
+        except Exception as e:
+            self.logger.error(f"❌ Ошибка получения платежей пользователя {telegram_id}: {e}")
+            return {}
+
     def get_stats(self) -> Dict[str, int]:
         """Получает общую статистику сервиса МИШУРА"""
         self.logger.debug("Запрос общей статистики сервиса.")
@@ -1131,6 +1158,171 @@ class MishuraDB:
             self.logger.error(f"❌ Ошибка получения статистики отзывов: {e}")
             return {}
 
+    # --- 🔑 УЧЕТ КВОТЫ GEMINI ---
+
+    def create_gemini_quota_table(self):
+        """Создание таблицы учета вызовов Gemini по ключам и суткам UTC"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            # Время первого/последнего вызова - unix time: одинаково в SQLite и PostgreSQL
+            timestamp_type = 'DOUBLE PRECISION' if self.DB_CONFIG['type'] == 'postgresql' else 'REAL'
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS gemini_quota_ledger (
+                    key_id TEXT NOT NULL,
+                    quota_day TEXT NOT NULL,
+                    calls INTEGER NOT NULL DEFAULT 0,
+                    rate_limited INTEGER NOT NULL DEFAULT 0,
+                    first_call_ts {timestamp_type},
+                    last_call_ts {timestamp_type},
+                    exhausted_ts {timestamp_type},
+                    PRIMARY KEY (key_id, quota_day)
+                )
+            """)
+            
+            conn.commit()
+            conn.close()
+            return True
+            
+        except Exception as e:
+            self.logger.error(f"❌ Ошибка создания таблицы квоты Gemini: {e}")
+            if 'conn' in locals():
+                conn.rollback()
+                conn.close()
+            return False
+
+    def record_gemini_quota_call(self, key_id: str, quota_day: str, timestamp: float) -> Optional[int]:
+        """
+        Атомарно учесть вызов Gemini через ключ.
+
+        Returns:
+            Число вызовов ключа за сутки по всем воркерам или None при ошибке
+        """
+        try:
+            query = """
+                INSERT INTO gemini_quota_ledger (key_id, quota_day, calls, first_call_ts, last_call_ts)
+                VALUES (?, ?, 1, ?, ?)
+                ON CONFLICT (key_id, quota_day) DO UPDATE
+                SET calls = gemini_quota_ledger.calls + 1, last_call_ts = excluded.last_call_ts
+                RETURNING calls
+            """
+            row = self._execute_query(query, (key_id, quota_day, timestamp, timestamp), fetch_one=True)
+            return row[0] if row else None
+        except Exception as e:
+            self.logger.error(f"❌ Ошибка учета вызова Gemini: {e}")
+            return None
+
+    def record_gemini_quota_error(self, key_id: str, quota_day: str, timestamp: float,
+                                  exhausted: bool = False) -> bool:
+        """Учесть 429 ключа; exhausted - суточная квота ключа исчерпана"""
+        try:
+            query = """
+                INSERT INTO gemini_quota_ledger (key_id, quota_day, rate_limited, exhausted_ts)
+                VALUES (?, ?, 1, ?)
+                ON CONFLICT (key_id, quota_day) DO UPDATE
+                SET rate_limited = gemini_quota_ledger.rate_limited + 1,
+                    exhausted_ts = COALESCE(excluded.exhausted_ts, gemini_quota_ledger.exhausted_ts)
+            """
+            self._execute_query(query, (key_id, quota_day, timestamp if exhausted else None))
+            return True
+        except Exception as e:
+            self.logger.error(f"❌ Ошибка учета 429 Gemini: {e}")
+            return False
+
+    def get_gemini_quota_usage(self, quota_day: str) -> List[Dict[str, Any]]:
+        """Вызовы Gemini по ключам за сутки UTC"""
+        try:
+            query = """
+                SELECT key_id, calls, rate_limited, first_call_ts, last_call_ts, exhausted_ts
+                FROM gemini_quota_ledger WHERE quota_day = ?
+            """
+            rows = self._execute_query(query, (quota_day,), fetch_all=True) or []
+            columns = ['key_id', 'calls', 'rate_limited', 'first_call_ts', 'last_call_ts', 'exhausted_ts']
+            return [dict(zip(columns, row)) for row in rows]
+        except Exception as e:
+            self.logger.error(f"❌ Ошибка чтения квоты Gemini: {e}")
+            return []
+
+
+    def create_gemini_usage_table(self):
+        """Создание таблицы расхода Gemini: одна строка на консультацию"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            if self.DB_CONFIG['type'] == 'postgresql':
+                id_column = 'id SERIAL PRIMARY KEY'
+                timestamp_type = 'DOUBLE PRECISION'
+            else:
+                id_column = 'id INTEGER PRIMARY KEY AUTOINCREMENT'
+                timestamp_type = 'REAL'
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS gemini_usage (
+                    {id_column},
+                    consultation_id INTEGER,
+                    correlation_id TEXT,
+                    telegram_id BIGINT,
+                    mode TEXT NOT NULL,
+                    endpoint TEXT,
+                    status TEXT NOT NULL,
+                    model TEXT,
+                    key_id TEXT,
+                    prompt_version TEXT,
+                    input_tokens INTEGER NOT NULL DEFAULT 0,
+                    output_tokens INTEGER NOT NULL DEFAULT 0,
+                    image_count INTEGER NOT NULL DEFAULT 0,
+                    image_bytes INTEGER NOT NULL DEFAULT 0,
+                    latency_ms {timestamp_type},
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    cache_hit INTEGER NOT NULL DEFAULT 0,
+                    cost_usd {timestamp_type} NOT NULL DEFAULT 0,
+                    created_ts {timestamp_type} NOT NULL
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_gemini_usage_created ON gemini_usage(created_ts)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_gemini_usage_consultation ON gemini_usage(consultation_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_gemini_usage_correlation ON gemini_usage(correlation_id)")
+            
+            conn.commit()
+            conn.close()
+            return True
+            
+        except Exception as e:
+            self.logger.error(f"❌ Ошибка создания таблицы расхода Gemini: {e}")
+            if 'conn' in locals():
+                conn.rollback()
+                conn.close()
+            return False
+
+    def save_gemini_usage(self, record: Dict[str, Any]) -> bool:
+        """Записать расход Gemini одной консультации (ключи record - GEMINI_USAGE_COLUMNS)"""
+        try:
+            columns = GEMINI_USAGE_COLUMNS
+            query = f"""
+                INSERT INTO gemini_usage ({', '.join(columns)})
+                VALUES ({', '.join('?' for _ in columns)})
+            """
+            self._execute_query(query, tuple(record.get(column) for column in columns))
+            return True
+        except Exception as e:
+            self.logger.error(f"❌ Ошибка записи расхода Gemini: {e}")
+            return False
+
+    def get_gemini_usage(self, since_ts: float, limit: int = 50000) -> List[Dict[str, Any]]:
+        """Строки расхода Gemini начиная с since_ts (unix time), новые первыми"""
+        try:
+            columns = ['id'] + GEMINI_USAGE_COLUMNS
+            query = f"""
+                SELECT {', '.join(columns)} FROM gemini_usage
+                WHERE created_ts >= ? ORDER BY created_ts DESC LIMIT ?
+            """
+            rows = self._execute_query(query, (since_ts, limit), fetch_all=True) or []
+            return [dict(zip(columns, row)) for row in rows]
+        except Exception as e:
+            self.logger.error(f"❌ Ошибка чтения расхода Gemini: {e}")
+            return []
+
 
 # === ФУНКЦИИ СОВМЕСТИМОСТИ ===
 
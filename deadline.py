@@ -0,0 +1,96 @@
+"""
+⏱️ МИШУРА - Deadline
+Сквозной срок выполнения запроса консультации
+
+Срок создается один раз на запрос и передается через все стадии:
+декодирование, оптимизацию изображений, попытки Gemini и сохранение в БД.
+Каждая стадия получает только оставшееся время; по истечении срока
+ожидание отменяется (asyncio-отмена доходит до вызова Gemini и очереди
+пула изображений), а новые попытки и паузы между ними не начинаются.
+"""
+
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """Срок запроса истек; наследует asyncio.TimeoutError - обработчики таймаутов ловят его как раньше"""
+
+    def __init__(self, stage: str):
+        super().__init__(f"Срок запроса истек на стадии: {stage}")
+        self.stage = stage
+
+
+class Deadline:
+    """⏱️ Оставшийся бюджет времени одного запроса"""
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + timeout
+        self.stages: Dict[str, float] = {}
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def check(self, stage: str) -> None:
+        """Не начинать стадию, если срок уже истек"""
+        if self.expired:
+            logger.warning(f"⏱️ Срок запроса истек до стадии {stage} ({self.elapsed():.1f} с)")
+            raise DeadlineExceeded(stage)
+
+    async def run(self, awaitable: Awaitable[Any], stage: str, cap: Optional[float] = None) -> Any:
+        """
+        Выполнить стадию в пределах оставшегося срока (и не дольше cap, если задан).
+
+        По истечении времени стадия отменяется и выбрасывается DeadlineExceeded.
+        """
+        budget = self.remaining() if cap is None else min(cap, self.remaining())
+        if budget <= 0:
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            self.check(stage)
+            raise DeadlineExceeded(stage)
+        started = time.monotonic()
+        try:
+            return await asyncio.wait_for(awaitable, timeout=budget)
+        except asyncio.TimeoutError as e:
+            if isinstance(e, DeadlineExceeded):
+                raise
+            logger.warning(f"⏱️ Стадия {stage} отменена: срок запроса истек ({self.elapsed():.1f} с)")
+            raise DeadlineExceeded(stage) from e
+        finally:
+            self.stages[stage] = round(self.stages.get(stage, 0.0) + time.monotonic() - started, 3)
+
+    async def sleep(self, delay: float, stage: str) -> None:
+        """Пауза между попытками: если после нее не останется времени, не ждать напрасно"""
+        if delay >= self.remaining():
+            logger.warning(f"⏱️ Пауза {delay:.1f} с перед {stage} не помещается в срок запроса")
+            raise DeadlineExceeded(stage)
+        await asyncio.sleep(delay)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'timeout_s': self.timeout,
+            'elapsed_s': round(self.elapsed(), 3),
+            'remaining_s': round(self.remaining(), 3),
+            'stages_s': dict(self.stages)
+        }
+
+
+async def within(deadline: Optional[Deadline], awaitable: Awaitable[Any], stage: str) -> Any:
+    """Выполнить стадию в сроке запроса; без срока - просто дождаться"""
+    if deadline is None:
+        return await awaitable
+    return await deadline.run(awaitable, stage)
@@ -21,10 +21,23 @@ import google.generativeai as genai
 from dotenv import load_dotenv
 from PIL import Image, ImageOps, ImageDraw
 from io import BytesIO
-from typing import Optional, List, Tuple, Union, Dict, Any
+from typing import Optional, List, Tuple, Union, Dict, Any, AsyncIterator
 import traceback
+from contextlib import asynccontextmanager
 import re
+import bisect
+import random
 import base64
+from advice_cache import AdviceCache, make_cache_key
+from image_processing import (optimize_image, optimize_image_async, optimize_images_async, optimize_collage_async,
+                              mode_options)
+from gemini_limiter import gemini_limiter, is_overload_error, GeminiOverloadedError
+from gemini_breaker import gemini_breaker, retry_budget, GeminiUnavailableError
+from gemini_routing import ModelRouter, build_model_chain
+from prompt_registry import prompt_registry, RenderedPrompt, usage_tokens
+from gemini_transport import gemini_transport
+from gemini_keys import PooledModel, gemini_key_pool
+from deadline import Deadline, DeadlineExceeded, within
 # Настройка логирования
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -34,64 +47,125 @@ logger.info("Инициализация модуля Gemini AI для МИШУР
 # Загрузка переменных окружения
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+# Пул ключей (GEMINI_API_KEYS или один GEMINI_API_KEY): ключ выбирается на каждый вызов
+API_KEYS_AVAILABLE = gemini_key_pool.size > 0
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
 
-# Простой заглушка кеш-менеджера
-class DummyCacheManager:
-    def __init__(self):
-        logger.info("DummyCacheManager инициализирован")
-
 # Конфигурация Gemini API
 API_CONFIGURED_SUCCESSFULLY = False
+VISION_MODEL = None
+MODEL_CHAIN = build_model_chain(GEMINI_MODEL)
+model_router = ModelRouter(MODEL_CHAIN)
 
-if not GEMINI_API_KEY:
-    logger.warning("GEMINI_API_KEY не найден. Модуль запустится в демо-режиме без вызовов API")
+if not API_KEYS_AVAILABLE and not gemini_transport.is_local:
+    logger.warning("GEMINI_API_KEY/GEMINI_API_KEYS не найдены. Модуль запустится в демо-режиме без вызовов API")
 
 try:
     # Конфигурируем API
-    genai.configure(api_key=GEMINI_API_KEY)
-    
-    # Проверяем доступные модели
-    logger.info("Проверка доступных моделей Gemini...")
-    
-    # Список моделей для тестирования (без -latest). Можно задать через GEMINI_MODEL
-    models_to_try = [
-        GEMINI_MODEL,
-        "gemini-1.5-flash",
-        "gemini-pro-vision",
-        "gemini-pro"
-    ]
+    genai.configure(api_key=GEMINI_API_KEY or (gemini_key_pool.keys[0].api_key if API_KEYS_AVAILABLE else None))
     
-    VISION_MODEL = None
-    
-    for model_name in models_to_try:
-        try:
-            # Создаем модель для проверки
-            test_model = genai.GenerativeModel(model_name)
-            VISION_MODEL = model_name
-            logger.info(f"Модель {model_name} доступна и будет использована")
-            break
-        except Exception as model_error:
-            logger.warning(f"Модель {model_name} недоступна: {str(model_error)}")
-            continue
+    # Цепочка моделей: основная (GEMINI_MODEL) и резервные (GEMINI_FALLBACK_MODELS).
+    # Доступность проверяется во время работы: ошибки и задержки каждой модели
+    # учитывает model_router, а не пробное создание GenerativeModel при импорте
+    VISION_MODEL = MODEL_CHAIN[0] if MODEL_CHAIN else None
+    logger.info(f"Цепочка моделей Gemini: {' -> '.join(MODEL_CHAIN)}")
     
-    if VISION_MODEL:
+    # Локальной имитации (GEMINI_TRANSPORT=fake/replay) ключ не нужен
+    if (API_KEYS_AVAILABLE or gemini_transport.is_local) and VISION_MODEL:
         API_CONFIGURED_SUCCESSFULLY = True
         logger.info(f"✅ Gemini API успешно сконфигурирован с моделью: {VISION_MODEL}")
+        if API_KEYS_AVAILABLE:
+            logger.info(f"🔑 Ключей Gemini в пуле: {gemini_key_pool.size}")
     else:
-        logger.warning("⚠️ Ни одна из моделей Gemini не доступна. Переходим в демо-режим")
+        logger.warning("⚠️ Gemini API не сконфигурирован. Переходим в демо-режим")
         API_CONFIGURED_SUCCESSFULLY = False
         
 except Exception as e:
     logger.error(f"❌ Ошибка конфигурации Gemini API: {str(e)}. Переходим в демо-режим")
     API_CONFIGURED_SUCCESSFULLY = False
 
+# Сравнение (по умолчанию для запросов без layout): каждый образ отдельным изображением,
+# все одним коллажем или веером - параллельные описания образов и текстовое сравнение описаний
+COMPARE_LAYOUT_IMAGES = "images"
+COMPARE_LAYOUT_COLLAGE = "collage"
+COMPARE_LAYOUT_FANOUT = "fanout"
+COMPARE_LAYOUTS = (COMPARE_LAYOUT_IMAGES, COMPARE_LAYOUT_COLLAGE, COMPARE_LAYOUT_FANOUT)
+GEMINI_COMPARE_LAYOUT = os.getenv("GEMINI_COMPARE_LAYOUT", COMPARE_LAYOUT_IMAGES)
+if GEMINI_COMPARE_LAYOUT not in COMPARE_LAYOUTS:
+    logger.warning(f"⚠️ Неизвестный GEMINI_COMPARE_LAYOUT: {GEMINI_COMPARE_LAYOUT}, используется {COMPARE_LAYOUT_IMAGES}")
+    GEMINI_COMPARE_LAYOUT = COMPARE_LAYOUT_IMAGES
+
 # Параметры повторных запросов
 MAX_RETRIES = 3
 RETRY_DELAY = 2
 
-# Инициализация кэша
-cache_manager = DummyCacheManager()
+def _retry_delay(attempt: int, error: Exception) -> float:
+    """Пауза перед повтором: при перегрузке - экспоненциальная с джиттером, чтобы повторы не шли волной"""
+    if is_overload_error(error):
+        return random.uniform(RETRY_DELAY / 2, RETRY_DELAY * (2 ** attempt))
+    return RETRY_DELAY
+
+# Реестр заранее созданных моделей: один объект на (режим, модель) на весь процесс
+_model_registry: Dict[Tuple[str, str], Any] = {}
+
+def get_model(mode: str = "analyze", model_name: Optional[str] = None):
+    """
+    Возвращает заранее созданную модель Gemini для режима консультации.
+
+    Модели создаются один раз на процесс и переиспользуются всеми запросами,
+    вместо создания GenerativeModel на каждую попытку.
+
+    Args:
+        mode: Режим консультации (analyze/compare)
+        model_name: Модель из цепочки (по умолчанию основная)
+
+    Returns:
+        Модель транспорта (genai.GenerativeModel или имитация) с конфигурацией генерации режима
+    """
+    if mode not in prompt_registry.modes():
+        raise ValueError(f"Неизвестный режим модели: {mode}")
+    model_name = model_name or VISION_MODEL
+    model = _model_registry.get((mode, model_name))
+    if model is None:
+        model = gemini_transport.create_model(model_name, mode, prompt_registry.generation_config(mode))
+        _model_registry[(mode, model_name)] = model
+        logger.info(f"🧩 Модель {model_name} зарегистрирована для режима {mode}")
+    return model
+
+def _build_model_registry() -> None:
+    """Предварительно создает модели цепочки для всех режимов."""
+    for mode in prompt_registry.modes():
+        for model_name in MODEL_CHAIN:
+            try:
+                get_model(mode, model_name)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось создать модель {model_name} для режима {mode}: {e}")
+
+# Инициализация кэша ответов
+cache_manager = AdviceCache()
+# Ответы fake/replay кэшируются отдельно от ответов настоящего API (в т.ч. на диске)
+CACHE_TRANSPORT = gemini_transport.kind if gemini_transport.is_local else None
+
+if API_CONFIGURED_SUCCESSFULLY:
+    _build_model_registry()
+
+async def warm_up_gemini(channel_timeout: float) -> Dict[str, Any]:
+    """
+    Прогрев Gemini без расхода квоты: модели и клиенты всех ключей, открытые gRPC-каналы.
+
+    Returns:
+        dict: Число моделей и состояние канала каждого ключа
+    """
+    if not API_CONFIGURED_SUCCESSFULLY:
+        return {'skipped': 'demo_mode'}
+    _build_model_registry()
+    for model in _model_registry.values():
+        if isinstance(model, PooledModel):
+            model.prebuild()
+    report: Dict[str, Any] = {'models': len(_model_registry)}
+    if not gemini_transport.is_local:
+        report['channels'] = await gemini_key_pool.open_channels(channel_timeout)
+    return report
 
 async def test_gemini_connection() -> bool:
     """
@@ -107,10 +181,11 @@ async def test_gemini_connection() -> bool:
         return False
     
     try:
-        model = genai.GenerativeModel(VISION_MODEL)
+        model = get_model("analyze")
         
         # Используем простой текстовый запрос
-        response = model.generate_content("Привет! Ответь одним словом: работает")
+        async with gemini_limiter.slot():
+            response = await model.generate_content_async("Привет! Ответь одним словом: работает")
         
         if response and response.text:
             logger.info(f"✅ Gemini API работает! Ответ: {response.text.strip()}")
@@ -139,275 +214,481 @@ def handle_gemini_error(error: Exception, context: str = "Gemini AI") -> str:
     else:
         return f"Произошла ошибка при обработке запроса: {type(error).__name__}"
 
-def optimize_image(img_pil: Image.Image, max_size: int = 1024, quality: int = 85) -> bytes:
-    """
-    Оптимизирует изображение для отправки в API.
-    
-    Args:
-        img_pil: Объект PIL.Image
-        max_size: Максимальный размер стороны
-        quality: Качество JPEG
-        
-    Returns:
-        bytes: Оптимизированные данные изображения
-    """
-    logger.info(f"📷 Оптимизация изображения: исходный размер {img_pil.size}")
-    
-    try:
-        # Изменение размера если нужно
-        width, height = img_pil.size
-        if width > max_size or height > max_size:
-            if width > height:
-                new_width = max_size
-                new_height = int(height * (max_size / width))
-            else:
-                new_height = max_size
-                new_width = int(width * (max_size / height))
-            
-            img_pil = img_pil.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            logger.info(f"📏 Размер изменен на {new_width}x{new_height}")
-        
-        # Конвертация в RGB если нужно
-        if img_pil.mode in ('RGBA', 'LA') or (img_pil.mode == 'P' and 'transparency' in img_pil.info):
-            background = Image.new("RGB", img_pil.size, (255, 255, 255))
-            if img_pil.mode == 'P':
-                img_pil = img_pil.convert('RGBA')
-            background.paste(img_pil, mask=img_pil.split()[-1] if img_pil.mode == 'RGBA' else None)
-            img_pil = background
-        elif img_pil.mode != 'RGB':
-            img_pil = img_pil.convert('RGB')
-        
-        # Сохранение в JPEG
-        img_byte_arr = BytesIO()
-        img_pil.save(img_byte_arr, format='JPEG', quality=quality, optimize=True)
-        optimized_bytes = img_byte_arr.getvalue()
-        
-        logger.info(f"✅ Изображение оптимизировано: {len(optimized_bytes)} байт")
-        return optimized_bytes
-        
-    except Exception as e:
-        logger.error(f"❌ Ошибка оптимизации изображения: {str(e)}")
-        raise ValueError(f"Ошибка оптимизации изображения: {str(e)}")
-
 def create_analysis_prompt(occasion: str, preferences: Optional[str] = None) -> str:
-    """Создает промпт для анализа одежды с улучшенным форматированием."""
-    base_prompt = f"""Ты - профессиональный стилист МИШУРА. Проанализируй одежду на изображении для повода: {occasion}.
-
-ВАЖНО! Используй точно такую структуру ответа:
-
-🎽 **АНАЛИЗ ОБРАЗА**
-
-**🎯 Общая оценка**
-✅ Краткая оценка уместности образа для указанного повода
-
-**🎨 Цветовая гамма**  
-✅ Анализ цветов и их сочетания в образе
-
-**⚖️ Гармония образа**
-✅ Оценка сбалансированности всех элементов
-
-**👟 Практичность**
-✅ Удобство и функциональность для повода
-
-⸻
-
-**📌 РЕКОМЕНДАЦИИ**
-
-**Дополнить образ:**
-• Конкретные предметы гардероба
-• Аксессуары и обувь
-
-**Общие советы:**
-• Практические рекомендации по стилю
-
-⸻
-
-💡 **Совет от МИШУРЫ:** [практический совет для будущих консультаций]
-
-Отвечай на русском языке, дружелюбно и профессионально. НЕ используй цифры в конце предложений."""
-    
-    if preferences:
-        base_prompt += f"\n\nУчитывай дополнительный вопрос: {preferences}"
-    
-    return base_prompt
+    """Создает структурированный промпт анализа (версия structured из prompt_registry)."""
+    return prompt_registry.render("analyze", occasion, preferences, version="structured-2025-06-20").text
 
 def create_comparison_prompt(occasion: str, num_images: int, preferences: Optional[str] = None) -> str:
-    """Создает ПРИНУДИТЕЛЬНЫЙ промпт для анализа ВСЕХ образов."""
-    image_emojis = ["🎽", "👖", "👔", "👗", "🧥", "👕"]
-
-    base_prompt = f"""Ты - профессиональный стилист МИШУРА.
-
-⚠️ КРИТИЧЕСКИ ВАЖНО: Я отправляю тебе ТОЧНО {num_images} изображений. Ты ОБЯЗАН проанализировать КАЖДОЕ из {num_images} изображений. НЕ пропускай ни одного!
-
-Сравни ВСЕ {num_images} представленных образов для повода: {occasion}.
-
-СТРУКТУРА ОБЯЗАТЕЛЬНОГО ОТВЕТА (АНАЛИЗИРУЙ КАЖДЫЙ ОБРАЗ, НЕ ПРОПУСКАЙ!):
-
-"""
-
-    for i in range(num_images):
-        emoji = image_emojis[i % len(image_emojis)]
-        base_prompt += f"""{emoji} **ОБРАЗ {i+1} (ОБЯЗАТЕЛЬНО АНАЛИЗИРУЙ):** [опиши что видишь на {i+1}-м изображении]
-
-**Уместность для {occasion}**
-✅ Подходит ли этот образ для {occasion}
-
-**Цветовая гамма образа {i+1}**
-✅ Какие цвета в {i+1}-м образе
-
-**Гармония образа {i+1}**
-✅ Насколько сбалансирован {i+1}-й образ
-
-**Практичность образа {i+1}**
-✅ Удобство {i+1}-го образа для {occasion}
-
-⸻
-
-"""
-
-    base_prompt += f"""🏆 **ОБЯЗАТЕЛЬНОЕ СРАВНЕНИЕ ВСЕХ {num_images} ОБРАЗОВ**
-
-⚠️ ВАЖНО: Ты ДОЛЖЕН сравнить ВСЕ {num_images} образов!
-
-**Лучший образ из {num_images}:** Образ [номер от 1 до {num_images}] - [почему именно этот]
-
-**Худший образ из {num_images}:** Образ [номер от 1 до {num_images}] - [почему именно этот]
-
-**Рекомендации по улучшению (ДЛЯ КАЖДОГО ИЗ {num_images} ОБРАЗОВ):**"""
-
-    for i in range(num_images):
-        base_prompt += f"\n• ОБРАЗ {i+1}: [как улучшить {i+1}-й образ]"
-
-    base_prompt += f"""
-
-⸻
-
-💡 **Совет от МИШУРЫ:** [практический совет учитывая все {num_images} образа]
-
-⚠️ ПРОВЕРЬ СЕБЯ: Ты проанализировал ВСЕ {num_images} образов? Если нет - начни заново!
+    """Создает структурированный промпт сравнения ВСЕХ образов (версия structured из prompt_registry)."""
+    return prompt_registry.render("compare", occasion, preferences, image_count=num_images,
+                                  version="structured-2025-06-20").text
+
+@asynccontextmanager
+async def _guarded_call():
+    """Один вызов Gemini под автоматом защиты и адаптивным лимитером"""
+    gemini_breaker.before_call()
+    try:
+        async with gemini_limiter.slot():
+            yield
+    except (asyncio.CancelledError, GeneratorExit, GeminiOverloadedError):
+        gemini_breaker.release_probe()
+        raise
+    except Exception as e:
+        gemini_breaker.record_failure(e)
+        raise
+    else:
+        gemini_breaker.record_success()
 
-**ЧЕК-ЛИСТ для тебя:**
-- [ ] Проанализированы ВСЕ {num_images} образов
-- [ ] Даны рекомендации для КАЖДОГО образа
-- [ ] Выбран лучший и худший образ
-- [ ] Дана финальная рекомендация
+def _give_up(error: Exception, context: str, attempt: int) -> Optional[Exception]:
+    """
+    Решает, прекращать ли повторы после ошибки.
 
-Отвечай на русском языке, дружелюбно и профессионально."""
+    Returns:
+        Исключение для выброса или None, если можно повторить
+    """
+    if attempt < MAX_RETRIES - 1 and not gemini_breaker.is_open:
+        if retry_budget.try_acquire():
+            return None
+        logger.warning("🔁 Бюджет повторов Gemini исчерпан, повтор пропущен")
+    error_msg = handle_gemini_error(error, context)
+    if gemini_breaker.is_open:
+        logger.error(f"🔌 Автомат Gemini разомкнут, повторы прекращены: {error_msg}")
+        return GeminiUnavailableError()
+    logger.error(f"❌ Все попытки исчерпаны: {error_msg}")
+    return RuntimeError(error_msg)
+
+def _is_content_error(error: BaseException) -> bool:
+    """Ответ отклонен по содержимому - другая модель цепочки тоже не поможет"""
+    return isinstance(error, ValueError) or "safety" in str(error).lower()
+
+def _generation_kwargs(prompt: Optional[RenderedPrompt]) -> Dict[str, Any]:
+    """Параметры генерации версии промпта для конкретного вызова"""
+    if prompt is None:
+        return {}
+    return {"generation_config": genai.types.GenerationConfig(**prompt.generation_config)}
+
+def _record_usage(prompt: Optional[RenderedPrompt], response: Any, latency: Optional[float],
+                  meta: Optional[Dict[str, Any]]) -> None:
+    """Учесть токены и задержку вызова по версии промпта"""
+    input_tokens, output_tokens = usage_tokens(response)
+    if prompt is not None:
+        prompt_registry.record_call(prompt.mode, prompt.version, latency, input_tokens, output_tokens)
+    if meta is not None:
+        meta["input_tokens"] = input_tokens
+        meta["output_tokens"] = output_tokens
+        meta["latency_ms"] = round(latency * 1000, 1) if latency is not None else None
+        # Ключ пула, через который прошел вызов (см. PooledModel)
+        meta["key_id"] = getattr(response, "gemini_key_id", None)
+
+def _store_advice(cache_key: str, advice: str, meta: Dict[str, Any]) -> None:
+    """Кэшировать ответ основной модели: ключ строится по VISION_MODEL, ответ резервной или хедж-модели не кэшируется"""
+    if meta.get("model") != VISION_MODEL:
+        logger.info(f"🗂️ Ответ модели {meta.get('model')} не кэшируется (ключ кэша - по {VISION_MODEL})")
+        return
+    cache_manager.set(cache_key, advice)
+
+def _record_images(meta: Dict[str, Any], images: List[Any]) -> None:
+    """Число и объем изображений, отправляемых в Gemini"""
+    meta["image_count"] = len(images)
+    meta["image_bytes"] = sum(len(image) for image in images)
+
+async def _generate_with_model(model_name: str, parts: List[Any], mode: str, hedged: bool = False,
+                               prompt: Optional[RenderedPrompt] = None,
+                               admitted: Optional[asyncio.Event] = None) -> Tuple[str, str, Any]:
+    """Один вызов конкретной модели цепочки с учетом ее статистики; admitted - слот лимитера получен"""
+    model = get_model(mode, model_name)
+    try:
+        async with _guarded_call():
+            if admitted is not None:
+                admitted.set()
+            # Задержка модели - без ожидания слота лимитера
+            started = time.monotonic()
+            response = await model.generate_content_async(parts, **_generation_kwargs(prompt))
+
+        if not (response and response.text):
+            error_msg = "API не вернул текстовый ответ"
+            if response and hasattr(response, 'prompt_feedback'):
+                if response.prompt_feedback and hasattr(response.prompt_feedback, 'block_reason'):
+                    error_msg += f": {response.prompt_feedback.block_reason}"
+            raise ValueError(error_msg)
+    except asyncio.CancelledError:
+        model_router.record_cancelled(model_name)
+        raise
+    except (GeminiUnavailableError, GeminiOverloadedError):
+        # Автомат разомкнут или лимитер отказал - модель тут ни при чем
+        raise
+    except Exception:
+        model_router.record_failure(model_name)
+        raise
+    model_router.record_success(model_name, time.monotonic() - started, hedged=hedged)
+    return response.text, model_name, response
+
+async def _hedged_generate(parts: List[Any], mode: str,
+                           prompt: Optional[RenderedPrompt] = None) -> Tuple[str, str, Any]:
+    """
+    Запрос по цепочке моделей.
 
-    if preferences:
-        base_prompt += f"\n\nДополнительно учитывай: {preferences}"
+    Если основная модель не ответила за свой перцентиль задержки, запускается
+    хедж к следующей модели; при ошибке основной - переход к следующей.
+    Задержка хеджа отсчитывается с момента получения слота лимитера, как и
+    перцентиль: пока вызов ждет в очереди, хедж только добавил бы нагрузки.
+    Возвращается первый успешный ответ, остальные вызовы отменяются.
 
-    return base_prompt
+    Returns:
+        (текст ответа, имя ответившей модели, ответ SDK)
+    """
+    chain = model_router.chain()
+    model_router.record_request()
+    pending: Dict[asyncio.Task, str] = {}
+    admitted: Dict[asyncio.Task, asyncio.Event] = {}
+    errors: List[BaseException] = []
+    next_index = 0
+
+    def launch(hedged: bool = False) -> None:
+        nonlocal next_index
+        model_name = chain[next_index]
+        next_index += 1
+        slot_acquired = asyncio.Event()
+        task = asyncio.create_task(_generate_with_model(model_name, parts, mode, hedged=hedged, prompt=prompt,
+                                                        admitted=slot_acquired))
+        pending[task] = model_name
+        admitted[task] = slot_acquired
+
+    launch()
+    try:
+        while pending:
+            hedge_delay = None
+            if len(pending) == 1 and next_index < len(chain):
+                task, model_name = next(iter(pending.items()))
+                if not admitted[task].is_set():
+                    # Часы хеджа еще не идут: ждем слот лимитера или завершения вызова
+                    slot_wait = asyncio.ensure_future(admitted[task].wait())
+                    try:
+                        await asyncio.wait([task, slot_wait], return_when=asyncio.FIRST_COMPLETED)
+                    finally:
+                        slot_wait.cancel()
+                    if not task.done():
+                        continue
+                else:
+                    # Перцентиль той модели, которая сейчас отвечает (после перехода - резервной)
+                    hedge_delay = model_router.hedge_delay(model_name)
+            done, _ = await asyncio.wait(pending, timeout=hedge_delay, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                model_router.record_hedge(chain[next_index])
+                launch(hedged=True)
+                continue
+
+            for task in done:
+                pending.pop(task)
+                error = task.exception()
+                if error is None:
+                    return task.result()
+                errors.append(error)
+                if _is_content_error(error):
+                    raise error
+
+            # Автомат разомкнут или лимитер отказал - резервная модель не запускается
+            last_error_blocks = isinstance(errors[-1], (GeminiUnavailableError, GeminiOverloadedError))
+            if not pending and next_index < len(chain) and not last_error_blocks:
+                model_router.record_fallback(chain[next_index])
+                launch()
+
+        raise errors[-1]
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+async def _sleep_before_retry(delay: float, deadline: Optional[Deadline]) -> None:
+    if deadline is None:
+        await asyncio.sleep(delay)
+    else:
+        await deadline.sleep(delay, "gemini_retry")
 
-async def _send_to_gemini_with_retries(parts: List[Any], context: str) -> str:
-    """Отправляет запрос к Gemini API с повторными попытками."""
+async def _send_to_gemini_with_retries(parts: List[Any], context: str, mode: str = "analyze",
+                                       meta: Optional[Dict[str, Any]] = None,
+                                       prompt: Optional[RenderedPrompt] = None,
+                                       deadline: Optional[Deadline] = None) -> str:
+    """
+    Отправляет запрос к Gemini API с повторными попытками.
+
+    Вызов выполняется через асинхронный API SDK, поэтому ожидание ответа
+    не блокирует event loop и корректно отменяется через asyncio.wait_for.
+    Каждая попытка проходит по цепочке моделей (_hedged_generate); имя
+    ответившей модели, токены, задержка, ключ и число попыток записываются в meta. Со сроком
+    запроса (deadline) попытка получает только оставшееся время и
+    отменяется по его истечении; повтор, не помещающийся в срок, не начинается.
+    """
     logger.info(f"📤 Отправка запроса к Gemini: {context}")
+    retry_budget.record_request()
     
     for attempt in range(MAX_RETRIES):
+        if meta is not None:
+            meta["attempts"] = attempt + 1
         try:
-            model = genai.GenerativeModel(VISION_MODEL)
-            response = model.generate_content(parts)
-            
-            if response and response.text:
-                logger.info(f"✅ Получен ответ от Gemini ({len(response.text)} символов)")
-                return response.text
-            else:
-                error_msg = "API не вернул текстовый ответ"
-                if response and hasattr(response, 'prompt_feedback'):
-                    if response.prompt_feedback and hasattr(response.prompt_feedback, 'block_reason'):
-                        error_msg += f": {response.prompt_feedback.block_reason}"
-                raise ValueError(error_msg)
+            started = time.monotonic()
+            text, model_name, response = await within(deadline, _hedged_generate(parts, mode, prompt), "gemini")
+            logger.info(f"✅ Получен ответ от Gemini {model_name} ({len(text)} символов)")
+            _record_usage(prompt, response, time.monotonic() - started, meta)
+            if meta is not None:
+                meta["model"] = model_name
+            return text
                 
+        except (GeminiUnavailableError, DeadlineExceeded) as e:
+            if isinstance(e, GeminiUnavailableError):
+                logger.warning(f"🔌 Gemini недоступен ({e}), запрос не отправлен: {context}")
+            raise
+        except GeminiOverloadedError as e:
+            logger.error(f"🚦 Запрос к Gemini отклонен лимитером: {e}")
+            raise RuntimeError("Сервис перегружен. Попробуйте позже.")
         except Exception as e:
+            # Версия промпта учитывает попытки: и успех, и неудачу - по одной на попытку
+            if prompt is not None:
+                prompt_registry.record_call(prompt.mode, prompt.version, success=False)
             logger.warning(f"⚠️ Попытка {attempt + 1}/{MAX_RETRIES} не удалась: {str(e)}")
-            if attempt < MAX_RETRIES - 1:
-                await asyncio.sleep(RETRY_DELAY)
-            else:
-                error_msg = handle_gemini_error(e, context)
-                logger.error(f"❌ Все попытки исчерпаны: {error_msg}")
-                raise RuntimeError(error_msg)
+            final_error = _give_up(e, context, attempt)
+            if final_error is not None:
+                raise final_error from e
+            await _sleep_before_retry(_retry_delay(attempt, e), deadline)
+
+def _demo_analysis_advice(occasion: str) -> str:
+    """Демо-ответ анализа без внешнего API."""
+    return (
+        f"🎨 Анализ образа (демо)\n\n"
+        f"Повод: {occasion}\n"
+        f"Рекомендации: Подчеркните силуэт аксессуаром, добавьте контрастный акцент."
+    )
+
+def _demo_comparison_advice(occasion: str) -> str:
+    """Демо-ответ сравнения без внешнего API."""
+    return (
+        f"🏆 Сравнение образов (демо)\n\n"
+        f"Повод: {occasion}\n"
+        f"Лучший образ: №1 — более гармоничная палитра.\n"
+        f"Советы: добавьте акцент и следите за посадкой."
+    )
+
+async def analyze_clothing_image(image_data: bytes, occasion: str = "повседневный", preferences: str = "",
+                                 meta: Optional[Dict[str, Any]] = None,
+                                 deadline: Optional[Deadline] = None) -> str:
+    """
+    Анализ одежды на изображении с чистым ответом без комментариев.
 
-async def analyze_clothing_image(image_data: bytes, occasion: str = "повседневный", preferences: str = "") -> str:
-    """Анализ одежды на изображении с чистым ответом без комментариев"""
+    Если передан словарь meta, в него записываются сведения о запросе
+    (например, cache_hit). Со сроком deadline оптимизация и попытки Gemini
+    укладываются в оставшееся время, иначе выбрасывается DeadlineExceeded.
+    """
+    if meta is None:
+        meta = {}
+    meta["mode"] = "analyze"
+    meta["cache_hit"] = False
     try:
         logger.info(f"🎨 Начало анализа образа для: {occasion}")
         if not API_CONFIGURED_SUCCESSFULLY:
             # Демо-ответ без внешнего API
-            return (
-                f"🎨 Анализ образа (демо)\n\n"
-                f"Повод: {occasion}\n"
-                f"Рекомендации: Подчеркните силуэт аксессуаром, добавьте контрастный акцент."
-            )
+            return _demo_analysis_advice(occasion)
         # Оптимизируем изображение
-        optimized_image = optimize_image(Image.open(BytesIO(image_data)))
+        optimized_image = await within(
+            deadline, optimize_image_async(image_data, **mode_options("analyze")), "optimize")
         logger.info("✅ Изображение оптимизировано")
-        # 🔧 ИСПРАВЛЕННЫЙ ПРОМТ БЕЗ МЕТАКОММЕНТАРИЕВ
-        system_prompt = f"""Ты профессиональный стилист-консультант. Проанализируй образ на фотографии и дай ТОЛЬКО практические рекомендации.
-
-ПРАВИЛА ОТВЕТА:
-- НЕ комментируй свою работу
-- НЕ объясняй как ты анализируешь  
-- НЕ добавляй метаинформацию
-- Отвечай ТОЛЬКО как стилист клиенту
-
-ФОРМАТ ОТВЕТА:
-Дай краткий анализ образа и практические советы для улучшения стиля.
-
-КОНТЕКСТ:
-Повод: {occasion}
-Пожелания: {preferences if preferences else "Общие рекомендации"}
-
-Проанализируй образ и дай профессиональные рекомендации по стилю."""
+        prompt = prompt_registry.render("analyze", occasion, preferences)
+        meta["prompt_version"] = prompt.version
+        cache_key = make_cache_key([optimized_image], occasion, preferences, prompt.version, VISION_MODEL,
+                                   mode="analyze", transport=CACHE_TRANSPORT)
+        cached_advice = cache_manager.get(cache_key)
+        if cached_advice is not None:
+            meta["cache_hit"] = True
+            logger.info("🗂️ Анализ образа получен из кэша")
+            return cached_advice
+        _record_images(meta, [optimized_image])
         response = await _send_to_gemini_with_retries(
-            [system_prompt, {"mime_type": "image/jpeg", "data": optimized_image}],
-            f"анализ образа для {occasion}"
+            [prompt.text, {"mime_type": "image/jpeg", "data": optimized_image}],
+            f"анализ образа для {occasion}",
+            mode="analyze",
+            meta=meta,
+            prompt=prompt,
+            deadline=deadline
         )
         cleaned_response = _clean_gemini_response(response)
+        _store_advice(cache_key, cleaned_response, meta)
         logger.info("✅ Анализ образа завершен")
         return cleaned_response
+    except (GeminiUnavailableError, DeadlineExceeded):
+        raise
     except Exception as e:
         logger.error(f"❌ Ошибка анализа образа для {occasion}: {e}")
         raise RuntimeError(f"Произошла ошибка при обработке запроса: {type(e).__name__}")
 
-async def compare_clothing_images(image_data_list: list, occasion: str = "повседневный", preferences: str = "") -> str:
-    """Сравнение нескольких образов с чистым ответом"""
+def _cache_mode(mode: str, ranking: bool) -> str:
+    """Режим ключа кэша: ответ со строкой рейтинга не подменяет обычный и наоборот"""
+    return f"{mode}_ranking" if ranking else mode
+
+def _comparison_layout(layout: Optional[str]) -> str:
+    layout = layout or GEMINI_COMPARE_LAYOUT
+    if layout not in COMPARE_LAYOUTS:
+        raise ValueError(f"Неизвестный вид сравнения: {layout} (допустимы: {', '.join(COMPARE_LAYOUTS)})")
+    return layout
+
+async def _prepare_comparison_images(image_data_list: list, layout: str,
+                                     deadline: Optional[Deadline]) -> List[bytes]:
+    """Изображения для Gemini: по одному на образ или один коллаж с пронумерованными панелями"""
+    if layout == COMPARE_LAYOUT_COLLAGE:
+        return [await within(deadline, optimize_collage_async(image_data_list, "compare"), "optimize")]
+    return await within(
+        deadline, optimize_images_async(image_data_list, **mode_options("compare", len(image_data_list))),
+        "optimize")
+
+async def _outfit_card(image_data: bytes, number: int, image_count: int, meta: Dict[str, Any],
+                       deadline: Optional[Deadline]) -> str:
+    """
+    Описание одного образа для сравнения веером.
+
+    Описание не зависит от повода и пожеланий и кэшируется по хэшу исходной
+    загрузки: то же фото в следующих сравнениях не оптимизируется и не
+    отправляется в Gemini.
+    """
+    prompt = prompt_registry.render("outfit_card", "")
+    meta["cache_hit"] = False
+    cache_key = make_cache_key([image_data], None, None, prompt.version, VISION_MODEL, mode="outfit_card",
+                               transport=CACHE_TRANSPORT)
+    card = cache_manager.get(cache_key)
+    if card is not None:
+        meta["cache_hit"] = True
+        return card
+    optimized_image = await within(
+        deadline, optimize_image_async(image_data, **mode_options("compare", image_count)), "optimize")
+    _record_images(meta, [optimized_image])
+    card = await _send_to_gemini_with_retries(
+        [prompt.text, {"mime_type": "image/jpeg", "data": optimized_image}],
+        f"описание образа {number}",
+        mode="outfit_card",
+        meta=meta,
+        prompt=prompt,
+        deadline=deadline
+    )
+    card = card.strip()
+    _store_advice(cache_key, card, meta)
+    return card
+
+async def _fanout_ranking(image_data_list: list, occasion: str, preferences: str, meta: Dict[str, Any],
+                          card_metas: List[Dict[str, Any]], deadline: Optional[Deadline],
+                          ranking: bool = False) -> Tuple[RenderedPrompt, List[Any], str]:
+    """
+    Описания образов параллельно (время - по самому долгому образу, а не
+    сумма) и текстовый запрос их сравнения: (промпт, части запроса, ключ кэша).
+    При ошибке одного описания остальные отменяются.
+    """
+    tasks = [asyncio.create_task(_outfit_card(image_data, number, len(image_data_list), card_meta, deadline))
+             for number, (image_data, card_meta) in enumerate(zip(image_data_list, card_metas), 1)]
+    try:
+        cards = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    prompt = prompt_registry.render("compare_rank", occasion, preferences, image_count=len(cards), ranking=ranking)
+    meta["prompt_version"] = prompt.version
+    text = prompt.text + "".join(f"\n\nОбраз {number}:\n{card}" for number, card in enumerate(cards, 1))
+    cache_key = make_cache_key([card.encode("utf-8") for card in cards], occasion, preferences,
+                               prompt.version, VISION_MODEL, mode=_cache_mode("compare_rank", ranking),
+                               transport=CACHE_TRANSPORT)
+    return prompt, [text], cache_key
+
+def _merge_fanout_meta(meta: Dict[str, Any], card_metas: List[Dict[str, Any]], rank_meta: Dict[str, Any]) -> None:
+    """
+    Сводка вызовов веера в meta запроса: токены, изображения и попытки
+    суммируются, задержка - критический путь (самое долгое описание и
+    сравнение), модель и ключ - вызова сравнения.
+    """
+    calls = card_metas + [rank_meta]
+    for field in ("input_tokens", "output_tokens", "image_count", "image_bytes", "attempts"):
+        meta[field] = sum(call.get(field) or 0 for call in calls)
+    latencies = [call.get("latency_ms") for call in calls if call.get("latency_ms") is not None]
+    meta["latency_ms"] = round(max((card.get("latency_ms") or 0 for card in card_metas), default=0)
+                               + (rank_meta.get("latency_ms") or 0), 1) if latencies else None
+    meta["model"] = rank_meta.get("model") or next((card["model"] for card in card_metas if card.get("model")), None)
+    meta["key_id"] = rank_meta.get("key_id")
+    meta["cache_hit"] = all(call.get("cache_hit") for call in calls)
+    meta["fanout"] = {
+        "cards": len(card_metas),
+        "card_cache_hits": sum(1 for card in card_metas if card.get("cache_hit"))
+    }
+
+async def _fanout_comparison(image_data_list: list, occasion: str, preferences: str, meta: Dict[str, Any],
+                             deadline: Optional[Deadline], ranking: bool = False, refresh: bool = False) -> str:
+    """Сравнение веером: описания образов параллельно, затем одно текстовое сравнение"""
+    card_metas = [{} for _ in image_data_list]
+    rank_meta = {"cache_hit": False}
+    try:
+        prompt, parts, cache_key = await _fanout_ranking(image_data_list, occasion, preferences, meta,
+                                                         card_metas, deadline, ranking)
+        cached_advice = None if refresh else cache_manager.get(cache_key)
+        if cached_advice is not None:
+            rank_meta["cache_hit"] = True
+            logger.info("🗂️ Сравнение описаний образов получено из кэша")
+            return cached_advice
+        response = await _send_to_gemini_with_retries(
+            parts,
+            f"сравнение описаний {len(image_data_list)} образов для {occasion}",
+            mode="compare_rank",
+            meta=rank_meta,
+            prompt=prompt,
+            deadline=deadline
+        )
+        cleaned_response = _clean_gemini_response(response)
+        _store_advice(cache_key, cleaned_response, rank_meta)
+        return cleaned_response
+    finally:
+        _merge_fanout_meta(meta, card_metas, rank_meta)
+
+async def compare_clothing_images(image_data_list: list, occasion: str = "повседневный", preferences: str = "",
+                                  meta: Optional[Dict[str, Any]] = None,
+                                  deadline: Optional[Deadline] = None, layout: Optional[str] = None,
+                                  ranking: bool = False, refresh: bool = False) -> str:
+    """
+    Сравнение нескольких образов с чистым ответом (meta и deadline - как в analyze_clothing_image).
+
+    layout: "images" - каждый образ отдельным изображением, "collage" - все
+    образы одним коллажем, "fanout" - описание каждого образа отдельным
+    параллельным вызовом и текстовое сравнение описаний; None - GEMINI_COMPARE_LAYOUT.
+    ranking: ответ заканчивается строкой рейтинга (prompt_registry.RANKING_LINE_PREFIX) - для турнира.
+    refresh: не брать ответ из кэша (повтор после непригодного ответа); новый ответ заменяет кэшированный.
+    """
+    if meta is None:
+        meta = {}
+    meta["mode"] = "compare"
+    meta["cache_hit"] = False
     if len(image_data_list) < 2:
         raise ValueError("Для сравнения нужно минимум 2 изображения")
     if len(image_data_list) > 4:
         raise ValueError("Максимум 4 изображения для сравнения")
+    layout = meta["layout"] = _comparison_layout(layout)
     try:
         if not API_CONFIGURED_SUCCESSFULLY:
-            return (
-                f"🏆 Сравнение образов (демо)\n\n"
-                f"Повод: {occasion}\n"
-                f"Лучший образ: №1 — более гармоничная палитра.\n"
-                f"Советы: добавьте акцент и следите за посадкой."
-            )
-        logger.info(f"⚖️ Начало сравнения {len(image_data_list)} образов для: {occasion}")
-        optimized_images = []
-        for i, image_data in enumerate(image_data_list):
-            optimized_image = optimize_image(Image.open(BytesIO(image_data)))
-            optimized_images.append(optimized_image)
-            logger.info(f"📷 Оптимизировано изображение {i+1}/{len(image_data_list)}")
-        system_prompt = f"""Ты профессиональный стилист. Сравни образы на фотографиях и дай ТОЛЬКО практические рекомендации.
-
-ПРАВИЛА ОТВЕТА:
-- НЕ комментируй процесс анализа
-- НЕ объясняй как ты сравниваешь
-- НЕ добавляй метаинформацию о своей работе
-- Отвечай ТОЛЬКО как стилист клиенту
-
-ФОРМАТ ОТВЕТА:
-1. Краткая оценка каждого образа
-2. Рейтинг от лучшего к худшему  
-3. Рекомендации по улучшению
-
-КОНТЕКСТ:
-Повод: {occasion}
-Пожелания: {preferences if preferences else "Общие рекомендации"}
-
-Сравни образы и дай профессиональную оценку."""
-        parts = [system_prompt]
+            return _demo_comparison_advice(occasion)
+        logger.info(f"⚖️ Начало сравнения {len(image_data_list)} образов для: {occasion} ({layout})")
+        if layout == COMPARE_LAYOUT_FANOUT:
+            cleaned_response = await _fanout_comparison(image_data_list, occasion, preferences, meta, deadline,
+                                                        ranking, refresh)
+            logger.info("✅ Сравнение образов веером завершено")
+            return cleaned_response
+        optimized_images = await _prepare_comparison_images(image_data_list, layout, deadline)
+        logger.info(f"📷 Оптимизировано изображений: {len(optimized_images)}")
+        prompt = prompt_registry.render("compare", occasion, preferences, image_count=len(image_data_list),
+                                        collage=layout == COMPARE_LAYOUT_COLLAGE, ranking=ranking)
+        meta["prompt_version"] = prompt.version
+        cache_key = make_cache_key(optimized_images, occasion, preferences, prompt.version, VISION_MODEL,
+                                   mode=_cache_mode("compare", ranking), transport=CACHE_TRANSPORT)
+        cached_advice = None if refresh else cache_manager.get(cache_key)
+        if cached_advice is not None:
+            meta["cache_hit"] = True
+            logger.info("🗂️ Сравнение образов получено из кэша")
+            return cached_advice
+        _record_images(meta, optimized_images)
+        parts = [prompt.text]
         for optimized_image in optimized_images:
             parts.append({
                 "mime_type": "image/jpeg",
@@ -416,42 +697,358 @@ async def compare_clothing_images(image_data_list: list, occasion: str = "пов
         logger.info("📤 Отправка запроса к Gemini: сравнение образов")
         response = await _send_to_gemini_with_retries(
             parts,
-            f"сравнение {len(image_data_list)} образов для {occasion}"
+            f"сравнение {len(image_data_list)} образов для {occasion}",
+            mode="compare",
+            meta=meta,
+            prompt=prompt,
+            deadline=deadline
         )
         cleaned_response = _clean_gemini_response(response)
+        _store_advice(cache_key, cleaned_response, meta)
         logger.info("✅ Сравнение образов завершено")
         return cleaned_response
+    except (GeminiUnavailableError, DeadlineExceeded):
+        raise
     except Exception as e:
         logger.error(f"❌ Ошибка сравнение {len(image_data_list)} образов для {occasion}: {e}")
         raise RuntimeError(f"Произошла ошибка при обработке запроса: {type(e).__name__}")
 
+async def _stream_from_gemini(parts: List[Any], context: str, mode: str = "analyze",
+                              meta: Optional[Dict[str, Any]] = None,
+                              prompt: Optional[RenderedPrompt] = None,
+                              deadline: Optional[Deadline] = None) -> AsyncIterator[str]:
+    """
+    Потоковая генерация ответа Gemini.
+
+    Повторные попытки возможны только пока клиенту не отправлено ни одного
+    фрагмента; ошибка посреди потока пробрасывается как RuntimeError.
+    Поток не хеджируется: каждая следующая попытка идет к следующей модели цепочки.
+    """
+    logger.info(f"📤 Потоковый запрос к Gemini: {context}")
+    retry_budget.record_request()
+    chain = model_router.chain()
+
+    for attempt in range(MAX_RETRIES):
+        if meta is not None:
+            meta["attempts"] = attempt + 1
+        started = False
+        model_name = chain[attempt % len(chain)]
+        if attempt and model_name != chain[(attempt - 1) % len(chain)]:
+            model_router.record_fallback(model_name)
+        call_started = time.monotonic()
+        try:
+            try:
+                async with _guarded_call():
+                    response = await get_model(mode, model_name).generate_content_async(
+                        parts, stream=True, **_generation_kwargs(prompt))
+                    async for chunk in response:
+                        text = chunk.text
+                        if text:
+                            started = True
+                            yield text
+                if not started:
+                    raise ValueError("API не вернул текстовый ответ")
+            except (GeminiUnavailableError, GeminiOverloadedError):
+                raise
+            except Exception:
+                model_router.record_failure(model_name)
+                if prompt is not None:
+                    prompt_registry.record_call(prompt.mode, prompt.version, success=False)
+                raise
+            model_router.record_success(model_name, None)
+            # usage_metadata потока заполняется после последнего фрагмента
+            _record_usage(prompt, response, time.monotonic() - call_started, meta)
+            if meta is not None:
+                meta["model"] = model_name
+            return
+        except GeminiUnavailableError:
+            logger.warning(f"🔌 Автомат Gemini разомкнут, поток не начат: {context}")
+            raise
+        except GeminiOverloadedError as e:
+            logger.error(f"🚦 Потоковый запрос к Gemini отклонен лимитером: {e}")
+            raise RuntimeError("Сервис перегружен. Попробуйте позже.")
+        except Exception as e:
+            if started:
+                error_msg = handle_gemini_error(e, context)
+                logger.error(f"❌ Поток Gemini прерван: {error_msg}")
+                raise RuntimeError(error_msg)
+            logger.warning(f"⚠️ Попытка {attempt + 1}/{MAX_RETRIES} не удалась: {str(e)}")
+            final_error = _give_up(e, context, attempt)
+            if final_error is not None:
+                raise final_error from e
+            await _sleep_before_retry(_retry_delay(attempt, e), deadline)
+
+async def _stream_cleaned_advice(parts: List[Any], context: str, prompt: RenderedPrompt, cache_key: str,
+                                 meta: Dict[str, Any], deadline: Optional[Deadline] = None) -> AsyncIterator[str]:
+    """Поток очищенных фрагментов; итоговый совет кладется в meta["advice"] и в кэш"""
+    cleaner = IncrementalResponseCleaner()
+    raw_chunks = []
+    async for chunk in _stream_from_gemini(parts, context, prompt.mode, meta=meta, prompt=prompt, deadline=deadline):
+        raw_chunks.append(chunk)
+        cleaned = cleaner.feed(chunk)
+        if cleaned:
+            yield cleaned
+    tail = cleaner.flush()
+    if tail:
+        yield tail
+    advice = _clean_gemini_response("".join(raw_chunks))
+    _store_advice(cache_key, advice, meta)
+    meta["advice"] = advice
+
+async def stream_clothing_analysis(image_data: bytes, occasion: str = "повседневный", preferences: str = "",
+                                   meta: Optional[Dict[str, Any]] = None,
+                                   deadline: Optional[Deadline] = None) -> AsyncIterator[str]:
+    """
+    Потоковый анализ образа: отдает очищенные фрагменты по мере генерации.
+
+    После завершения в meta["advice"] лежит итоговый совет - тот же текст,
+    который вернул бы analyze_clothing_image.
+    """
+    if meta is None:
+        meta = {}
+    meta["mode"] = "analyze"
+    meta["cache_hit"] = False
+    try:
+        if not API_CONFIGURED_SUCCESSFULLY:
+            meta["advice"] = _demo_analysis_advice(occasion)
+            yield meta["advice"]
+            return
+        optimized_image = await within(
+            deadline, optimize_image_async(image_data, **mode_options("analyze")), "optimize")
+        prompt = prompt_registry.render("analyze", occasion, preferences)
+        meta["prompt_version"] = prompt.version
+        cache_key = make_cache_key([optimized_image], occasion, preferences, prompt.version, VISION_MODEL,
+                                   mode="analyze", transport=CACHE_TRANSPORT)
+        cached_advice = cache_manager.get(cache_key)
+        if cached_advice is not None:
+            meta["cache_hit"] = True
+            meta["advice"] = cached_advice
+            yield cached_advice
+            return
+        _record_images(meta, [optimized_image])
+        parts = [prompt.text, {"mime_type": "image/jpeg", "data": optimized_image}]
+        async for chunk in _stream_cleaned_advice(parts, f"анализ образа для {occasion}", prompt, cache_key, meta, deadline):
+            yield chunk
+        logger.info("✅ Потоковый анализ образа завершен")
+    except (GeminiUnavailableError, DeadlineExceeded):
+        raise
+    except Exception as e:
+        logger.error(f"❌ Ошибка потокового анализа образа для {occasion}: {e}")
+        raise RuntimeError(f"Произошла ошибка при обработке запроса: {type(e).__name__}")
+
+async def _stream_fanout_comparison(image_data_list: list, occasion: str, preferences: str, meta: Dict[str, Any],
+                                    deadline: Optional[Deadline]) -> AsyncIterator[str]:
+    """Потоковое сравнение веером: описания образов целиком, текстовое сравнение - потоком"""
+    card_metas = [{} for _ in image_data_list]
+    rank_meta = {"cache_hit": False}
+    try:
+        prompt, parts, cache_key = await _fanout_ranking(image_data_list, occasion, preferences, meta,
+                                                         card_metas, deadline)
+        cached_advice = cache_manager.get(cache_key)
+        if cached_advice is not None:
+            rank_meta["cache_hit"] = True
+            meta["advice"] = cached_advice
+            yield cached_advice
+            return
+        context = f"сравнение описаний {len(image_data_list)} образов для {occasion}"
+        async for chunk in _stream_cleaned_advice(parts, context, prompt, cache_key, rank_meta, deadline):
+            yield chunk
+        meta["advice"] = rank_meta["advice"]
+    finally:
+        _merge_fanout_meta(meta, card_metas, rank_meta)
+
+async def stream_clothing_comparison(image_data_list: list, occasion: str = "повседневный", preferences: str = "",
+                                     meta: Optional[Dict[str, Any]] = None,
+                                     deadline: Optional[Deadline] = None,
+                                     layout: Optional[str] = None) -> AsyncIterator[str]:
+    """Потоковое сравнение образов (meta и deadline - как в stream_clothing_analysis, layout - как в compare_clothing_images)"""
+    if meta is None:
+        meta = {}
+    meta["mode"] = "compare"
+    meta["cache_hit"] = False
+    if len(image_data_list) < 2:
+        raise ValueError("Для сравнения нужно минимум 2 изображения")
+    if len(image_data_list) > 4:
+        raise ValueError("Максимум 4 изображения для сравнения")
+    layout = meta["layout"] = _comparison_layout(layout)
+    try:
+        if not API_CONFIGURED_SUCCESSFULLY:
+            meta["advice"] = _demo_comparison_advice(occasion)
+            yield meta["advice"]
+            return
+        if layout == COMPARE_LAYOUT_FANOUT:
+            async for chunk in _stream_fanout_comparison(image_data_list, occasion, preferences, meta, deadline):
+                yield chunk
+            logger.info("✅ Потоковое сравнение образов веером завершено")
+            return
+        optimized_images = await _prepare_comparison_images(image_data_list, layout, deadline)
+        prompt = prompt_registry.render("compare", occasion, preferences, image_count=len(image_data_list),
+                                        collage=layout == COMPARE_LAYOUT_COLLAGE)
+        meta["prompt_version"] = prompt.version
+        cache_key = make_cache_key(optimized_images, occasion, preferences, prompt.version, VISION_MODEL,
+                                   mode="compare", transport=CACHE_TRANSPORT)
+        cached_advice = cache_manager.get(cache_key)
+        if cached_advice is not None:
+            meta["cache_hit"] = True
+            meta["advice"] = cached_advice
+            yield cached_advice
+            return
+        _record_images(meta, optimized_images)
+        parts = [prompt.text]
+        parts.extend({"mime_type": "image/jpeg", "data": image} for image in optimized_images)
+        context = f"сравнение {len(image_data_list)} образов для {occasion}"
+        async for chunk in _stream_cleaned_advice(parts, context, prompt, cache_key, meta, deadline):
+            yield chunk
+        logger.info("✅ Потоковое сравнение образов завершено")
+    except (GeminiUnavailableError, DeadlineExceeded):
+        raise
+    except Exception as e:
+        logger.error(f"❌ Ошибка потокового сравнения {len(image_data_list)} образов для {occasion}: {e}")
+        raise RuntimeError(f"Произошла ошибка при обработке запроса: {type(e).__name__}")
+
+# Фразы-метакомментарии: строка обрезается от начала фразы до конца строки.
+# Для пар (начало, продолжение) фраза срабатывает, только если продолжение
+# встречается в той же строке после начала. Порядок важен: правила
+# применяются к строке последовательно.
+_META_PHRASES: List[Tuple[str, ...]] = [
+    ("Я проанализировал",),
+    ("Анализируя",),
+    ("При анализе",),
+    ("Исходя из анализа",),
+    ("Как ИИ-стилист",),
+    ("В качестве ИИ",),
+    ("Я как ИИ",),
+    ("Надеюсь", "помогл"),
+    ("Если у вас есть", "вопросы"),
+    ("Буду рад", "помочь"),
+    ("Пожалуйста", "дайте знать"),
+    ("Обратите внимание", "качество"),
+    ("Учтите что", "ограничения"),
+    ("В заключение",),
+    ("Подводя итог",),
+    ("Таким образом",),
+]
+
+# Только литералы: каждый поиск линеен по длине строки, без возвратов
+_META_RULES = [
+    tuple(re.compile(re.escape(part), re.IGNORECASE) for part in phrase)
+    for phrase in _META_PHRASES
+]
+# Быстрый фильтр: строки без начала какой-либо фразы не проверяются правилами
+_META_PREFILTER = re.compile("|".join(re.escape(phrase[0]) for phrase in _META_PHRASES), re.IGNORECASE)
+
+# Начала фраз в нижнем регистре для быстрого поиска str.find по всему ответу
+_META_HEADS = [phrase[0].lower() for phrase in _META_PHRASES]
+# Символы, которые re.IGNORECASE считает равными буквам фраз, а str.lower() - нет
+_META_CASE_VARIANTS = re.compile("[\u1c80-\u1c85]")
+
+def _meta_candidate_lines(text: str, lines: List[str]) -> Optional[set]:
+    """
+    Номера строк, в которых встречается начало какой-либо фразы.
+
+    None - быстрый поиск неприменим (нижний регистр меняет длину текста
+    или есть редкие варианты букв), тогда проверяется каждая строка.
+    """
+    lowered = text.lower()
+    if len(lowered) != len(text) or _META_CASE_VARIANTS.search(text):
+        return None
+    positions = []
+    for head in _META_HEADS:
+        index = lowered.find(head)
+        while index != -1:
+            positions.append(index)
+            index = lowered.find(head, index + 1)
+    if not positions:
+        return set()
+    line_starts = []
+    offset = 0
+    for line in lines:
+        line_starts.append(offset)
+        offset += len(line) + 1
+    return {bisect.bisect_right(line_starts, position) - 1 for position in positions}
+
+def _strip_meta_line(line: str, lowered: Optional[str] = None) -> str:
+    """
+    Вырезает метакомментарии из одной строки ответа.
+
+    lowered - line.lower(), если быстрый поиск применим (см. _meta_candidate_lines):
+    тогда правила, начала которых нет в строке, пропускаются без regex.
+    """
+    if lowered is None and not _META_PREFILTER.search(line):
+        return line
+    for (head, *tail), head_text in zip(_META_RULES, _META_HEADS):
+        if lowered is not None and head_text not in lowered:
+            continue
+        match = head.search(line)
+        if match and all(part.search(line, match.end()) for part in tail):
+            line = line[:match.start()]
+    return line
+
+class IncrementalResponseCleaner:
+    """
+    🧹 Потоковая очистка ответа Gemini.
+
+    Копит фрагменты до конца строки, вырезает метакомментарии построчно
+    и схлопывает серии пустых строк по тем же правилам, что _clean_gemini_response.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._blank_lines: List[str] = []
+        self._started = False
+
+    def _emit(self, line: str) -> str:
+        if not line.strip():
+            if self._started:
+                self._blank_lines.append(line)
+            return ""
+        if not self._started:
+            self._started = True
+            return line.lstrip()
+        blanks = [""] if len(self._blank_lines) >= 2 else self._blank_lines
+        self._blank_lines = []
+        return "".join("\n" + blank for blank in blanks) + "\n" + line
+
+    def feed(self, chunk: str) -> str:
+        """Принять фрагмент и вернуть очищенный текст, готовый к отправке"""
+        self._buffer += chunk
+        *lines, self._buffer = self._buffer.split("\n")
+        return "".join(self._emit(_strip_meta_line(line)) for line in lines)
+
+    def flush(self) -> str:
+        """Завершить поток и вернуть остаток"""
+        tail = self._emit(_strip_meta_line(self._buffer).rstrip())
+        self._buffer = ""
+        return tail
+
 def _clean_gemini_response(response: str) -> str:
-    """🧹 Очистка ответа Gemini от метакомментариев"""
+    """
+    🧹 Очистка ответа Gemini от метакомментариев.
+
+    Один проход по строкам: метакомментарии вырезаются до конца строки,
+    серии из двух и более пустых строк внутри текста заменяются одной
+    пустой строкой. Время работы линейно по длине ответа.
+    """
     if not response:
         return response
-    meta_patterns = [
-        r"Я проанализировал.*?(?=\n|$)",
-        r"Анализируя.*?(?=\n|$)", 
-        r"При анализе.*?(?=\n|$)",
-        r"Исходя из анализа.*?(?=\n|$)",
-        r"Как ИИ-стилист.*?(?=\n|$)",
-        r"В качестве ИИ.*?(?=\n|$)",
-        r"Я как ИИ.*?(?=\n|$)",
-        r"Надеюсь.*помогли?.*?(?=\n|$)",
-        r"Если у вас есть.*вопросы.*?(?=\n|$)",
-        r"Буду рад.*помочь.*?(?=\n|$)",
-        r"Пожалуйста.*дайте знать.*?(?=\n|$)",
-        r"Обратите внимание.*качество.*?(?=\n|$)",
-        r"Учтите что.*ограничения.*?(?=\n|$)",
-        r"В заключение.*?(?=\n|$)",
-        r"Подводя итог.*?(?=\n|$)",
-        r"Таким образом.*?(?=\n|$)"
-    ]
-    cleaned = response.strip()
-    for pattern in meta_patterns:
-        cleaned = re.sub(pattern, "", cleaned, flags=re.IGNORECASE | re.DOTALL)
-    cleaned = re.sub(r'\n\s*\n\s*\n', '\n\n', cleaned)
-    cleaned = cleaned.strip()
+    text = response.strip()
+    raw_lines = text.split("\n")
+    candidates = _meta_candidate_lines(text, raw_lines)
+    lines: List[str] = []
+    blank_lines: List[str] = []
+    for index, line in enumerate(raw_lines):
+        if candidates is None:
+            line = _strip_meta_line(line)
+        elif index in candidates:
+            line = _strip_meta_line(line, line.lower())
+        if not line.strip():
+            blank_lines.append(line)
+            continue
+        if lines:
+            lines.extend([""] if len(blank_lines) >= 2 else blank_lines)
+        blank_lines = []
+        lines.append(line)
+    cleaned = "\n".join(lines).strip()
     if len(cleaned) < len(response) * 0.3:
         return response
     return cleaned
@@ -486,7 +1083,9 @@ class MishuraGeminiAI:
         return await test_gemini_connection()
     
     async def analyze_clothing_image(self, image_data: bytes, occasion: str, 
-                                   preferences: Optional[str] = None) -> str:
+                                   preferences: Optional[str] = None,
+                                   meta: Optional[Dict[str, Any]] = None,
+                                   deadline: Optional[Deadline] = None) -> str:
         """
         Анализирует одежду на изображении с помощью Gemini AI.
         
@@ -494,14 +1093,20 @@ class MishuraGeminiAI:
             image_data: Бинарные данные изображения
             occasion: Повод для консультации
             preferences: Предпочтения пользователя
+            meta: Словарь для сведений о запросе (cache_hit и т.п.)
+            deadline: Срок запроса (DeadlineExceeded по истечении)
             
         Returns:
             str: Анализ и рекомендации
         """
-        return await analyze_clothing_image(image_data, occasion, preferences)
+        return await analyze_clothing_image(image_data, occasion, preferences, meta=meta, deadline=deadline)
     
     async def compare_clothing_images(self, image_data_list: List[bytes], occasion: str, 
-                                    preferences: Optional[str] = None) -> str:
+                                    preferences: Optional[str] = None,
+                                    meta: Optional[Dict[str, Any]] = None,
+                                    deadline: Optional[Deadline] = None,
+                                    layout: Optional[str] = None, ranking: bool = False,
+                                    refresh: bool = False) -> str:
         """
         Сравнивает несколько образов одежды.
         
@@ -509,11 +1114,108 @@ class MishuraGeminiAI:
             image_data_list: Список бинарных данных изображений
             occasion: Повод для консультации
             preferences: Предпочтения пользователя
+            meta: Словарь для сведений о запросе (cache_hit и т.п.)
+            deadline: Срок запроса (DeadlineExceeded по истечении)
+            layout: "images", "collage" (все образы одним коллажем) или "fanout"
+                (параллельные описания образов и текстовое сравнение); None - GEMINI_COMPARE_LAYOUT
+            ranking: Завершить ответ строкой рейтинга (турнир)
+            refresh: Не брать ответ из кэша советов
             
         Returns:
             str: Сравнительный анализ
         """
-        return await compare_clothing_images(image_data_list, occasion, preferences)
+        return await compare_clothing_images(image_data_list, occasion, preferences, meta=meta, deadline=deadline,
+                                             layout=layout, ranking=ranking, refresh=refresh)
+
+    def stream_clothing_analysis(self, image_data: bytes, occasion: str,
+                                 preferences: Optional[str] = None,
+                                 meta: Optional[Dict[str, Any]] = None,
+                                 deadline: Optional[Deadline] = None) -> AsyncIterator[str]:
+        """
+        Потоковый анализ образа (фрагменты текста по мере генерации).
+
+        Итоговый совет после завершения потока - в meta["advice"].
+        """
+        return stream_clothing_analysis(image_data, occasion, preferences, meta=meta, deadline=deadline)
+
+    def stream_clothing_comparison(self, image_data_list: List[bytes], occasion: str,
+                                   preferences: Optional[str] = None,
+                                   meta: Optional[Dict[str, Any]] = None,
+                                   deadline: Optional[Deadline] = None,
+                                   layout: Optional[str] = None) -> AsyncIterator[str]:
+        """
+        Потоковое сравнение образов (фрагменты текста по мере генерации).
+
+        Итоговый совет после завершения потока - в meta["advice"].
+        """
+        return stream_clothing_comparison(image_data_list, occasion, preferences, meta=meta, deadline=deadline,
+                                          layout=layout)
+
+    def get_cache_stats(self) -> Dict[str, Any]:
+        """
+        Возвращает счетчики кэша ответов.
+        
+        Returns:
+            dict: Попадания/промахи по уровням кэша
+        """
+        return self.cache_manager.stats()
+
+    def get_limiter_stats(self) -> Dict[str, Any]:
+        """
+        Возвращает состояние лимитера запросов к Gemini.
+
+        Returns:
+            dict: Текущий лимит, очередь, отказы
+        """
+        return gemini_limiter.stats()
+
+    def get_breaker_stats(self) -> Dict[str, Any]:
+        """
+        Возвращает состояние автомата защиты и бюджета повторов.
+
+        Returns:
+            dict: Состояние автомата, счетчики отказов и повторов
+        """
+        return {
+            "circuit_breaker": gemini_breaker.stats(),
+            "retry_budget": retry_budget.stats()
+        }
+
+    def get_routing_stats(self) -> Dict[str, Any]:
+        """
+        Возвращает статистику цепочки моделей.
+
+        Returns:
+            dict: Порядок цепочки, хеджи, задержки и ошибки по моделям
+        """
+        return model_router.stats()
+
+    def get_prompt_report(self) -> Dict[str, Any]:
+        """
+        Возвращает сравнение версий промптов.
+
+        Returns:
+            dict: Живые версии, вызовы, токены и задержки по версиям
+        """
+        return prompt_registry.report()
+
+    async def warm_up(self, channel_timeout: float = 5.0) -> Dict[str, Any]:
+        """
+        Прогревает модели и каналы Gemini после старта процесса.
+
+        Returns:
+            dict: Отчет прогрева (см. warm_up_gemini)
+        """
+        return await warm_up_gemini(channel_timeout)
+
+    def get_key_pool_stats(self) -> Dict[str, Any]:
+        """
+        Возвращает состояние пула ключей Gemini.
+
+        Returns:
+            dict: Использование, 429 и остывание по каждому ключу (ключи маскированы)
+        """
+        return gemini_key_pool.stats()
     
     def get_model_info(self) -> Dict[str, Any]:
         """
@@ -527,7 +1229,17 @@ class MishuraGeminiAI:
             "api_configured": self.api_configured,
             "version": __version__,
             "max_retries": MAX_RETRIES,
-            "retry_delay": RETRY_DELAY
+            "retry_delay": RETRY_DELAY,
+            "registered_modes": sorted({mode for mode, _ in _model_registry}),
+            "model_chain": MODEL_CHAIN,
+            "transport": gemini_transport.stats(),
+            "api_keys": gemini_key_pool.stats(),
+            "prompt_versions": prompt_registry.live_versions(),
+            "compare_layout": GEMINI_COMPARE_LAYOUT,
+            "cache": self.cache_manager.stats(),
+            "limiter": gemini_limiter.stats(),
+            **self.get_breaker_stats(),
+            "routing": model_router.stats()
         }
 
 # Тестирование при прямом запуске
@@ -0,0 +1,201 @@
+"""
+🔌 МИШУРА - Gemini Circuit Breaker
+Автомат защиты и общий бюджет повторов для запросов к Gemini
+
+- Автомат размыкается после серии ошибок квоты/аутентификации/5xx и,
+  пока разомкнут, сразу отвечает GeminiUnavailableError - api.py отдает
+  запасной совет без ожидания повторов
+- После паузы автомат полуоткрывается: проходит один пробный запрос
+- Бюджет повторов ограничивает повторы долей от общего числа запросов процесса
+"""
+
+import os
+import time
+import logging
+from collections import deque
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('GEMINI_BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_OPEN_SECONDS = float(os.getenv('GEMINI_BREAKER_OPEN_SECONDS', 30))
+# Исчерпанная квота не восстановится за 30 секунд
+BREAKER_QUOTA_OPEN_SECONDS = float(os.getenv('GEMINI_BREAKER_QUOTA_OPEN_SECONDS', 300))
+
+RETRY_BUDGET_RATIO = float(os.getenv('GEMINI_RETRY_BUDGET_RATIO', 0.2))
+RETRY_BUDGET_MIN_PER_WINDOW = int(os.getenv('GEMINI_RETRY_BUDGET_MIN', 3))
+RETRY_BUDGET_WINDOW_SECONDS = float(os.getenv('GEMINI_RETRY_BUDGET_WINDOW', 60))
+
+_QUOTA_MARKERS = ('429', 'quota', 'resource exhausted', 'resourceexhausted', 'rate limit')
+_AUTH_MARKERS = ('api key', 'authentication', 'unauthenticated', 'permission denied', 'permissiondenied', '401', '403')
+_SERVER_MARKERS = ('500', '502', '503', '504', 'internal error', 'internalservererror',
+                   'service unavailable', 'serviceunavailable', 'bad gateway')
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half_open'
+
+
+class GeminiUnavailableError(Exception):
+    """Автомат разомкнут: Gemini сейчас не вызывается"""
+
+    def __init__(self, message: str = "Сервис анализа временно недоступен", retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def classify_failure(error: BaseException) -> Optional[str]:
+    """Тип ошибки для автомата: quota / auth / server или None (ошибка не про доступность)"""
+    text = f"{type(error).__name__} {error}".lower()
+    if any(marker in text for marker in _QUOTA_MARKERS):
+        return 'quota'
+    if any(marker in text for marker in _AUTH_MARKERS):
+        return 'auth'
+    if any(marker in text for marker in _SERVER_MARKERS):
+        return 'server'
+    return None
+
+
+class CircuitBreaker:
+    """🔌 Автомат защиты closed -> open -> half_open -> closed"""
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 open_seconds: float = BREAKER_OPEN_SECONDS,
+                 quota_open_seconds: float = BREAKER_QUOTA_OPEN_SECONDS):
+        self.failure_threshold = max(1, failure_threshold)
+        self.open_seconds = open_seconds
+        self.quota_open_seconds = quota_open_seconds
+        self.state = STATE_CLOSED
+        self.consecutive_failures = 0
+        self.last_failure_kind: Optional[str] = None
+        self._opened_at: Optional[float] = None
+        self._open_for = open_seconds
+        self._probe_in_flight = False
+        self.counters = {
+            'opened': 0,
+            'rejected': 0,
+            'probes': 0
+        }
+
+    def _retry_after(self) -> float:
+        if self._opened_at is None:
+            return 0.0
+        return max(0.0, self._opened_at + self._open_for - time.monotonic())
+
+    def before_call(self) -> None:
+        """Пропустить вызов или сразу отказать GeminiUnavailableError"""
+        if self.state == STATE_CLOSED:
+            return
+        if self.state == STATE_OPEN and self._retry_after() <= 0:
+            self.state = STATE_HALF_OPEN
+            self._probe_in_flight = False
+            logger.info("🔌 Автомат Gemini полуоткрыт: пропускаем пробный запрос")
+        if self.state == STATE_HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            self.counters['probes'] += 1
+            return
+        self.counters['rejected'] += 1
+        raise GeminiUnavailableError(retry_after=self._retry_after())
+
+    def record_success(self) -> None:
+        """Gemini ответил (в том числе отказом по содержимому) - сервис доступен"""
+        if self.state != STATE_CLOSED:
+            logger.info("✅ Автомат Gemini замкнут: пробный запрос успешен")
+        self.state = STATE_CLOSED
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+        self._opened_at = None
+
+    def record_failure(self, error: BaseException) -> None:
+        """Учесть ошибку; ошибки, не связанные с доступностью, игнорируются"""
+        kind = classify_failure(error)
+        if kind is None:
+            if self.state == STATE_HALF_OPEN:
+                self.record_success()
+            return
+        self.last_failure_kind = kind
+        self.consecutive_failures += 1
+        if self.state == STATE_HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self._open(kind)
+
+    def release_probe(self) -> None:
+        """Пробный вызов отменен без результата - разрешить следующий"""
+        if self.state == STATE_HALF_OPEN:
+            self._probe_in_flight = False
+
+    def _open(self, kind: str) -> None:
+        self.state = STATE_OPEN
+        self._opened_at = time.monotonic()
+        self._open_for = self.quota_open_seconds if kind == 'quota' else self.open_seconds
+        self._probe_in_flight = False
+        self.counters['opened'] += 1
+        logger.error(f"🔌 Автомат Gemini разомкнут ({kind}) на {self._open_for:.0f} с")
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == STATE_OPEN and self._retry_after() > 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'failure_threshold': self.failure_threshold,
+            'last_failure_kind': self.last_failure_kind,
+            'retry_after_s': round(self._retry_after(), 1),
+            **self.counters
+        }
+
+
+class RetryBudget:
+    """
+    🔁 Общий бюджет повторов процесса
+
+    В скользящем окне повторов может быть не больше
+    min_per_window + ratio * число_запросов.
+    """
+
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, min_per_window: int = RETRY_BUDGET_MIN_PER_WINDOW,
+                 window_seconds: float = RETRY_BUDGET_WINDOW_SECONDS):
+        self.ratio = ratio
+        self.min_per_window = min_per_window
+        self.window_seconds = window_seconds
+        self._requests: deque = deque()
+        self._retries: deque = deque()
+        self.denied = 0
+
+    def _trim(self, now: float) -> None:
+        border = now - self.window_seconds
+        for events in (self._requests, self._retries):
+            while events and events[0] < border:
+                events.popleft()
+
+    def record_request(self) -> None:
+        """Учесть новый (первичный) запрос к Gemini"""
+        now = time.monotonic()
+        self._trim(now)
+        self._requests.append(now)
+
+    def try_acquire(self) -> bool:
+        """Можно ли сделать еще один повтор"""
+        now = time.monotonic()
+        self._trim(now)
+        if len(self._retries) < self.min_per_window + self.ratio * len(self._requests):
+            self._retries.append(now)
+            return True
+        self.denied += 1
+        return False
+
+    def stats(self) -> Dict[str, Any]:
+        self._trim(time.monotonic())
+        return {
+            'ratio': self.ratio,
+            'window_s': self.window_seconds,
+            'requests_in_window': len(self._requests),
+            'retries_in_window': len(self._retries),
+            'denied': self.denied
+        }
+
+
+# Глобальные экземпляры процесса
+gemini_breaker = CircuitBreaker()
+retry_budget = RetryBudget()
@@ -0,0 +1,324 @@
+"""
+🔑 МИШУРА - Gemini Key Pool
+Пул ключей Gemini API с учетом квоты каждого ключа и ротацией
+
+- Ключи задаются GEMINI_API_KEYS (через запятую); без него - один GEMINI_API_KEY
+- Для каждого ключа считаются запросы за сутки, успехи, ошибки и 429
+- Запрос идет через самый здоровый ключ: с наибольшим остатком суточной
+  квоты и наименьшим числом запросов в работе
+- Ключ, получивший 429, остывает: поминутный лимит - GEMINI_KEY_COOLDOWN_SECONDS
+  с удвоением при повторах, исчерпанная суточная квота - до сброса в 00:00 UTC
+- На 429 вызов сразу повторяется через следующий доступный ключ, поэтому
+  автомат защиты и лимитер видят ошибку квоты, только когда исчерпан весь пул
+
+Места вызова не меняются: транспорт отдает PooledModel вместо GenerativeModel.
+"""
+
+import os
+import time
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Any, List, Optional
+
+from gemini_breaker import GeminiUnavailableError
+
+logger = logging.getLogger(__name__)
+
+GEMINI_KEY_DAILY_LIMIT = int(os.getenv('GEMINI_KEY_DAILY_LIMIT', 50))
+GEMINI_KEY_COOLDOWN_SECONDS = float(os.getenv('GEMINI_KEY_COOLDOWN_SECONDS', 60))
+
+_RATE_LIMIT_MARKERS = ('429', 'quota', 'resource exhausted', 'resourceexhausted', 'rate limit')
+_DAILY_QUOTA_MARKERS = ('per day', 'perday', 'daily')
+# Только признаки самого ключа: 403 на модель, не включенную в проекте (запасная модель),
+# - обычная ошибка вызова, иначе одна такая ошибка навсегда выключила бы ключ
+_INVALID_KEY_MARKERS = ('api key not valid', 'api_key_invalid')
+
+STATE_ACTIVE = 'active'
+STATE_COOLING = 'cooling'
+STATE_INVALID = 'invalid'
+
+# События пула для внешних учетчиков (ApiKeyPool.add_listener)
+EVENT_CALL = 'call'
+EVENT_RATE_LIMITED = 'rate_limited'
+EVENT_DAILY_EXHAUSTED = 'daily_exhausted'
+
+
+class GeminiKeysExhaustedError(GeminiUnavailableError):
+    """Все ключи пула остывают или исчерпали суточную квоту"""
+
+    def __init__(self, retry_after: Optional[float] = None):
+        super().__init__("Квота всех ключей Gemini исчерпана", retry_after=retry_after)
+
+
+def load_api_keys() -> List[str]:
+    """Ключи из окружения без повторов и пустых значений"""
+    raw = os.getenv('GEMINI_API_KEYS') or os.getenv('GEMINI_API_KEY') or ''
+    keys = []
+    for key in raw.split(','):
+        key = key.strip()
+        if key and key not in keys:
+            keys.append(key)
+    return keys
+
+
+def next_quota_reset(now: Optional[datetime] = None) -> datetime:
+    """Суточная квота сбрасывается в 00:00 UTC"""
+    now = now or datetime.now(timezone.utc)
+    return (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class ApiKeyState:
+    """📊 Состояние одного ключа; сам ключ наружу не отдается"""
+
+    def __init__(self, index: int, api_key: str, daily_limit: int = GEMINI_KEY_DAILY_LIMIT):
+        self.index = index
+        self.api_key = api_key
+        self.label = f"key-{index + 1} (…{api_key[-4:]})"
+        # Устойчивый идентификатор ключа для общих хранилищ: сам ключ не сохраняется
+        self.fingerprint = hashlib.sha256(api_key.encode()).hexdigest()[:16]
+        self.daily_limit = daily_limit
+        self.day = datetime.now(timezone.utc).date()
+        self.used_today = 0
+        self.in_flight = 0
+        self.successes = 0
+        self.failures = 0
+        self.rate_limited = 0
+        self.consecutive_rate_limits = 0
+        self.cooldown_until = 0.0  # time.time()
+        self.invalid = False
+        self.last_error: Optional[str] = None
+        self.async_client: Any = None
+
+    def _roll_day(self) -> None:
+        today = datetime.now(timezone.utc).date()
+        if today != self.day:
+            self.day = today
+            self.used_today = 0
+
+    @property
+    def remaining_today(self) -> int:
+        self._roll_day()
+        return max(0, self.daily_limit - self.used_today)
+
+    @property
+    def state(self) -> str:
+        if self.invalid:
+            return STATE_INVALID
+        if self.cooldown_until > time.time() or self.remaining_today <= 0:
+            return STATE_COOLING
+        return STATE_ACTIVE
+
+    def retry_after(self) -> Optional[float]:
+        if self.invalid:
+            return None
+        if self.remaining_today <= 0:
+            return (next_quota_reset() - datetime.now(timezone.utc)).total_seconds()
+        return max(0.0, self.cooldown_until - time.time())
+
+    def stats(self) -> Dict[str, Any]:
+        retry_after = self.retry_after() if self.state == STATE_COOLING else None
+        return {
+            'key': self.label,
+            'state': self.state,
+            'used_today': self.used_today,
+            'daily_limit': self.daily_limit,
+            'remaining_today': self.remaining_today,
+            'in_flight': self.in_flight,
+            'successes': self.successes,
+            'failures': self.failures,
+            'rate_limited': self.rate_limited,
+            'retry_after_s': round(retry_after) if retry_after is not None else None,
+            'last_error': self.last_error
+        }
+
+
+class ApiKeyPool:
+    """🔑 Выбор ключа и учет его квоты"""
+
+    def __init__(self, api_keys: List[str], daily_limit: int = GEMINI_KEY_DAILY_LIMIT,
+                 cooldown_seconds: float = GEMINI_KEY_COOLDOWN_SECONDS):
+        self.cooldown_seconds = cooldown_seconds
+        self.keys = [ApiKeyState(index, key, daily_limit) for index, key in enumerate(api_keys)]
+        self.rotations = 0
+        self.exhausted = 0
+        self._listeners: List[Callable[[ApiKeyState, str], None]] = []
+
+    def add_listener(self, callback: Callable[[ApiKeyState, str], None]) -> None:
+        """Подписка на события ключей: call, rate_limited, daily_exhausted"""
+        self._listeners.append(callback)
+
+    def _notify(self, key: ApiKeyState, event: str) -> None:
+        for callback in self._listeners:
+            try:
+                callback(key, event)
+            except Exception as e:
+                logger.warning(f"⚠️ Ошибка обработчика событий пула ключей: {e}")
+
+    @property
+    def size(self) -> int:
+        return len(self.keys)
+
+    def acquire(self, exclude: Optional[List[ApiKeyState]] = None) -> ApiKeyState:
+        """Самый здоровый доступный ключ; запрос сразу учитывается в его квоте"""
+        candidates = [key for key in self.keys if key.state == STATE_ACTIVE and key not in (exclude or [])]
+        if not candidates:
+            self.exhausted += 1
+            waits = [key.retry_after() for key in self.keys if key.retry_after() is not None]
+            raise GeminiKeysExhaustedError(retry_after=min(waits) if waits else None)
+        key = max(candidates, key=lambda k: (k.remaining_today - k.in_flight, -k.in_flight, -k.index))
+        key.used_today += 1
+        key.in_flight += 1
+        self._notify(key, EVENT_CALL)
+        return key
+
+    def release(self, key: ApiKeyState) -> None:
+        key.in_flight = max(0, key.in_flight - 1)
+
+    def record_success(self, key: ApiKeyState) -> None:
+        key.successes += 1
+        key.consecutive_rate_limits = 0
+
+    def record_failure(self, key: ApiKeyState, error: BaseException) -> bool:
+        """
+        Учесть ошибку ключа.
+
+        Returns:
+            True, если ошибка относится к ключу (квота/недействительный ключ)
+            и запрос стоит повторить через другой ключ
+        """
+        key.failures += 1
+        text = f"{type(error).__name__} {error}".lower()
+        key.last_error = str(error)[:200]
+        if any(marker in text for marker in _INVALID_KEY_MARKERS):
+            key.invalid = True
+            logger.error(f"🔑 Ключ Gemini {key.label} недействителен и исключен из пула")
+            return True
+        if not any(marker in text for marker in _RATE_LIMIT_MARKERS):
+            return False
+
+        key.rate_limited += 1
+        key.consecutive_rate_limits += 1
+        if any(marker in text for marker in _DAILY_QUOTA_MARKERS):
+            # Суточная квота исчерпана раньше нашего счетчика (запросы из других процессов)
+            key.used_today = key.daily_limit
+            logger.warning(f"🔑 Суточная квота ключа {key.label} исчерпана до 00:00 UTC")
+            self._notify(key, EVENT_DAILY_EXHAUSTED)
+        else:
+            cooldown = self.cooldown_seconds * (2 ** (key.consecutive_rate_limits - 1))
+            key.cooldown_until = time.time() + cooldown
+            logger.warning(f"🔑 Ключ {key.label} получил 429, остывает {cooldown:.0f} с")
+            self._notify(key, EVENT_RATE_LIMITED)
+        return True
+
+    async def open_channels(self, timeout: float) -> Dict[str, str]:
+        """
+        Открыть gRPC-каналы всех ключей заранее (прогрев после деплоя).
+
+        TCP/TLS-рукопожатие с Gemini не ложится на первый запрос пользователя;
+        квота при этом не расходуется.
+        """
+        async def open_one(key: ApiKeyState) -> str:
+            try:
+                if key.async_client is None:
+                    key.async_client = _async_client_for(key.api_key)
+                await asyncio.wait_for(key.async_client.transport.grpc_channel.channel_ready(), timeout)
+                return 'ready'
+            except asyncio.TimeoutError:
+                return 'timeout'
+            except Exception as e:
+                return f"error: {e}"
+
+        keys = [key for key in self.keys if not key.invalid]
+        results = await asyncio.gather(*(open_one(key) for key in keys))
+        return {key.label: result for key, result in zip(keys, results)}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'size': self.size,
+            'active': sum(1 for key in self.keys if key.state == STATE_ACTIVE),
+            'remaining_today': sum(key.remaining_today for key in self.keys if not key.invalid),
+            'rotations': self.rotations,
+            'exhausted': self.exhausted,
+            'keys': [key.stats() for key in self.keys]
+        }
+
+
+def _async_client_for(api_key: str) -> Any:
+    """Асинхронный клиент SDK с собственным ключом (genai.configure задает один ключ на процесс)"""
+    from google.generativeai import client as genai_client
+    manager = genai_client._ClientManager()
+    manager.configure(api_key=api_key)
+    return manager.make_client("generative_async")
+
+
+class PooledModel:
+    """
+    🔑 GenerativeModel поверх пула ключей.
+
+    Для каждого ключа держится своя модель со своим клиентом; на 429
+    вызов повторяется через следующий доступный ключ.
+    """
+
+    def __init__(self, model_name: str, generation_config: Dict[str, Any], pool: ApiKeyPool):
+        self.model_name = model_name
+        self.generation_config = generation_config
+        self.pool = pool
+        self._models: Dict[int, Any] = {}
+
+    def _model_for(self, key: ApiKeyState) -> Any:
+        model = self._models.get(key.index)
+        if model is None:
+            import google.generativeai as genai
+            model = genai.GenerativeModel(
+                self.model_name,
+                generation_config=genai.types.GenerationConfig(**self.generation_config)
+            )
+            # Клиент создается внутри event loop при первом вызове через ключ
+            if key.async_client is None:
+                key.async_client = _async_client_for(key.api_key)
+            model._async_client = key.async_client
+            self._models[key.index] = model
+        return model
+
+    def prebuild(self) -> None:
+        """Создать модели и клиенты всех ключей заранее (вызывается внутри event loop)"""
+        for key in self.pool.keys:
+            if not key.invalid:
+                self._model_for(key)
+
+    async def generate_content_async(self, contents: Any, **kwargs) -> Any:
+        tried: List[ApiKeyState] = []
+        while True:
+            try:
+                key = self.pool.acquire(exclude=tried)
+            except GeminiKeysExhaustedError:
+                if not tried:
+                    raise
+                # Ротация не помогла - отдаем последнюю ошибку квоты лимитеру и автомату
+                raise last_error
+            if tried:
+                self.pool.rotations += 1
+                logger.info(f"🔑 Повтор через ключ {key.label}")
+            tried.append(key)
+            try:
+                response = await self._model_for(key).generate_content_async(contents, **kwargs)
+            except Exception as e:
+                if not self.pool.record_failure(key, e):
+                    raise
+                last_error = e
+                continue
+            finally:
+                self.pool.release(key)
+            self.pool.record_success(key)
+            # Учет расхода (gemini_usage) видит, через какой ключ прошел вызов
+            try:
+                response.gemini_key_id = key.fingerprint
+            except AttributeError:
+                pass
+            return response
+
+
+# Глобальный пул процесса
+gemini_key_pool = ApiKeyPool(load_api_keys())
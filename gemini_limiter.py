@@ -0,0 +1,324 @@
+"""
+🚦 МИШУРА - Gemini Limiter
+Адаптивное (AIMD) ограничение числа одновременных запросов к Gemini
+
+- Пока вызовы успешны, лимит растет аддитивно (примерно +1 за "окно" из limit вызовов)
+- На 429 / исчерпании квоты / превышении времени лимит уменьшается мультипликативно
+- Запросы сверх лимита ждут в очереди ограниченной длины и ограниченное время
+- Очередь разделена по классам приоритета (request_priority): свободный слот
+  получает класс с наименьшим виртуальным временем (взвешенная справедливая
+  очередь по GEMINI_PRIORITY_WEIGHTS), а класс, не получавший слотов дольше
+  GEMINI_PRIORITY_MAX_WAIT при ждущем запросе, обслуживается вне очереди
+"""
+
+import os
+import time
+import asyncio
+import logging
+import contextvars
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+GEMINI_LIMIT_INITIAL = float(os.getenv('GEMINI_LIMIT_INITIAL', 4))
+GEMINI_LIMIT_MIN = float(os.getenv('GEMINI_LIMIT_MIN', 1))
+GEMINI_LIMIT_MAX = float(os.getenv('GEMINI_LIMIT_MAX', 32))
+GEMINI_LIMIT_BACKOFF = float(os.getenv('GEMINI_LIMIT_BACKOFF', 0.5))
+GEMINI_QUEUE_MAX = int(os.getenv('GEMINI_QUEUE_MAX', 50))
+GEMINI_QUEUE_TIMEOUT = float(os.getenv('GEMINI_QUEUE_TIMEOUT', 20))
+
+PRIORITY_PREMIUM = 'premium'
+PRIORITY_PAID = 'paid'
+PRIORITY_FREE = 'free'
+DEFAULT_PRIORITY = PRIORITY_FREE
+
+
+def _parse_weights(raw: str) -> Dict[str, float]:
+    weights = {}
+    for item in raw.split(','):
+        name, _, weight = item.partition(':')
+        if name.strip() and weight.strip():
+            weights[name.strip()] = max(0.1, float(weight))
+    return weights
+
+
+# Доля слотов класса при конкуренции: premium:paid:free = 4:2:1
+GEMINI_PRIORITY_WEIGHTS = _parse_weights(os.getenv('GEMINI_PRIORITY_WEIGHTS', 'premium:4,paid:2,free:1'))
+# Защита от голодания: класс с ждущим запросом не остается без слота дольше этого
+GEMINI_PRIORITY_MAX_WAIT = float(os.getenv('GEMINI_PRIORITY_MAX_WAIT', 5))
+
+# Класс приоритета текущего запроса; задачи asyncio наследуют его от обработчика запроса
+request_priority: contextvars.ContextVar[str] = contextvars.ContextVar('request_priority', default=DEFAULT_PRIORITY)
+
+_WAIT_SAMPLES = 500
+
+# Признаки перегрузки в ответе Gemini: только они уменьшают лимит
+_OVERLOAD_MARKERS = (
+    '429', 'quota', 'resource exhausted', 'resourceexhausted', 'rate limit',
+    'too many requests', 'deadline', 'timeout', 'timed out'
+)
+
+
+class GeminiOverloadedError(Exception):
+    """Запрос не дождался свободного слота (очередь переполнена или истекло ожидание)"""
+
+
+def is_overload_error(error: BaseException) -> bool:
+    """Ошибка означает перегрузку Gemini (429/квота/дедлайн)"""
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    text = f"{type(error).__name__} {error}".lower()
+    return any(marker in text for marker in _OVERLOAD_MARKERS)
+
+
+class _Waiter:
+    __slots__ = ('future', 'priority', 'enqueued_at')
+
+    def __init__(self, future: asyncio.Future, priority: str):
+        self.future = future
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+
+
+def _percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    🚦 AIMD-лимитер одновременных вызовов
+
+    Уменьшение применяется не чаще одного раза на "поколение": ошибки вызовов,
+    начатых до последнего снижения, лимит повторно не режут.
+    """
+
+    def __init__(self, initial: float = GEMINI_LIMIT_INITIAL, min_limit: float = GEMINI_LIMIT_MIN,
+                 max_limit: float = GEMINI_LIMIT_MAX, backoff: float = GEMINI_LIMIT_BACKOFF,
+                 max_queue: int = GEMINI_QUEUE_MAX, queue_timeout: float = GEMINI_QUEUE_TIMEOUT,
+                 weights: Optional[Dict[str, float]] = None, max_wait: float = GEMINI_PRIORITY_MAX_WAIT):
+        self.min_limit = max(1.0, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = min(max(initial, self.min_limit), self.max_limit)
+        self.backoff = backoff
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.weights = dict(weights if weights is not None else GEMINI_PRIORITY_WEIGHTS)
+        self.max_wait = max_wait
+        self._queues: Dict[str, deque] = {}
+        # Виртуальное время классов: обслуженный класс сдвигается на 1/вес
+        self._virtual_time: Dict[str, float] = {}
+        self._clock = 0.0
+        self._last_served: Dict[str, float] = {}
+        self._wait_samples: Dict[str, deque] = {}
+        self._class_counters: Dict[str, Dict[str, int]] = {}
+        self._generation = 0
+        self.counters = {
+            'acquired': 0,
+            'successes': 0,
+            'overloads': 0,
+            'decreases': 0,
+            'rejected_queue_full': 0,
+            'rejected_timeout': 0,
+            'shed_for_priority': 0,
+            'starvation_promotions': 0
+        }
+        self._last_decrease_at: Optional[float] = None
+
+    def _has_capacity(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    def _weight(self, priority: str) -> float:
+        return self.weights.get(priority, self.weights.get(DEFAULT_PRIORITY, 1.0))
+
+    def _queue_length(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _class_counter(self, priority: str) -> Dict[str, int]:
+        return self._class_counters.setdefault(priority, {'acquired': 0, 'queued': 0, 'rejected': 0, 'shed': 0})
+
+    def _record_wait(self, priority: str, waited: float) -> None:
+        self._wait_samples.setdefault(priority, deque(maxlen=_WAIT_SAMPLES)).append(waited)
+        self._class_counter(priority)['acquired'] += 1
+
+    def _next_waiter(self) -> Optional[_Waiter]:
+        """Следующий ожидающий: сначала голодающий класс, иначе класс с наименьшим виртуальным временем"""
+        heads = [queue[0] for queue in self._queues.values() if queue]
+        if not heads:
+            return None
+        now = time.monotonic()
+        waiter = min(heads, key=lambda w: (self._virtual_time.get(w.priority, 0.0), w.enqueued_at))
+        # Голодание: запрос ждет дольше max_wait, и его класс столько же не получал слотов
+        starving = [w for w in heads if now - w.enqueued_at >= self.max_wait
+                    and now - self._last_served.get(w.priority, w.enqueued_at) >= self.max_wait]
+        if starving:
+            oldest = min(starving, key=lambda w: w.enqueued_at)
+            if oldest is not waiter:
+                self.counters['starvation_promotions'] += 1
+                waiter = oldest
+        self._last_served[waiter.priority] = now
+        self._queues[waiter.priority].popleft()
+        self._clock = self._virtual_time.get(waiter.priority, 0.0)
+        self._virtual_time[waiter.priority] = self._clock + 1.0 / self._weight(waiter.priority)
+        return waiter
+
+    def _wake_waiters(self) -> None:
+        while self._has_capacity():
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            if not waiter.future.done():
+                self.in_flight += 1
+                waiter.future.set_result(True)
+
+    def _shed_lower_priority(self, priority: str) -> bool:
+        """Очередь полна: уступить место, отказав последнему ожидающему более низкого класса"""
+        candidates = [queue for name, queue in self._queues.items()
+                      if queue and self._weight(name) < self._weight(priority)]
+        if not candidates:
+            return False
+        queue = min(candidates, key=lambda q: self._weight(q[0].priority))
+        victim = queue.pop()
+        self.counters['shed_for_priority'] += 1
+        self._class_counter(victim.priority)['shed'] += 1
+        if not victim.future.done():
+            victim.future.set_exception(GeminiOverloadedError("Очередь к Gemini занята запросами с более высоким приоритетом"))
+        return True
+
+    def _enqueue(self, priority: str) -> _Waiter:
+        queue = self._queues.setdefault(priority, deque())
+        if not queue:
+            # Класс после простоя не копит "кредит": стартует с текущего виртуального времени
+            self._virtual_time[priority] = max(self._virtual_time.get(priority, 0.0), self._clock)
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), priority)
+        queue.append(waiter)
+        self._class_counter(priority)['queued'] += 1
+        return waiter
+
+    async def acquire(self, priority: Optional[str] = None) -> int:
+        """Занять слот; возвращает поколение лимита на момент старта вызова"""
+        priority = priority or request_priority.get()
+        if self._has_capacity() and not self._queue_length():
+            self.in_flight += 1
+            self.counters['acquired'] += 1
+            self._record_wait(priority, 0.0)
+            return self._generation
+
+        if self._queue_length() >= self.max_queue and not self._shed_lower_priority(priority):
+            self.counters['rejected_queue_full'] += 1
+            self._class_counter(priority)['rejected'] += 1
+            raise GeminiOverloadedError("Очередь запросов к Gemini переполнена")
+
+        waiter = self._enqueue(priority)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.future.done() and waiter.future.exception() is None:
+                # Слот выдан в момент истечения ожидания - возвращаем его
+                self.release()
+            else:
+                waiter.future.cancel()
+                self._remove_waiter(waiter)
+            self.counters['rejected_timeout'] += 1
+            self._class_counter(priority)['rejected'] += 1
+            raise GeminiOverloadedError("Превышено время ожидания очереди к Gemini")
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+                self.release()
+            else:
+                waiter.future.cancel()
+                self._remove_waiter(waiter)
+            raise
+        self.counters['acquired'] += 1
+        self._record_wait(priority, time.monotonic() - waiter.enqueued_at)
+        return self._generation
+
+    def _remove_waiter(self, waiter: _Waiter) -> None:
+        try:
+            self._queues.get(waiter.priority, deque()).remove(waiter)
+        except ValueError:
+            pass
+
+    def release(self) -> None:
+        self.in_flight = max(0, self.in_flight - 1)
+        self._wake_waiters()
+
+    def on_success(self) -> None:
+        """Аддитивный рост: +1 к лимиту за каждые limit успешных вызовов"""
+        self.counters['successes'] += 1
+        self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+        self._wake_waiters()
+
+    def on_overload(self, generation: int) -> None:
+        """Мультипликативное снижение (один раз на поколение)"""
+        self.counters['overloads'] += 1
+        if generation != self._generation:
+            return
+        old_limit = self.limit
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+        self._generation += 1
+        self._last_decrease_at = time.time()
+        self.counters['decreases'] += 1
+        logger.warning(f"🚦 Перегрузка Gemini: лимит {old_limit:.1f} -> {self.limit:.1f}")
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        Слот на время одного вызова Gemini.
+
+        Исход вызова определяется по исключению, выброшенному из блока.
+        """
+        generation = await self.acquire()
+        try:
+            yield
+        except BaseException as e:
+            if is_overload_error(e):
+                self.on_overload(generation)
+            raise
+        else:
+            self.on_success()
+        finally:
+            self.release()
+
+    def stats(self) -> Dict[str, Any]:
+        """Текущее состояние для диагностики"""
+        return {
+            'limit': round(self.limit, 2),
+            'effective_limit': int(self.limit),
+            'min_limit': self.min_limit,
+            'max_limit': self.max_limit,
+            'in_flight': self.in_flight,
+            'queue_length': self._queue_length(),
+            'max_queue': self.max_queue,
+            'queue_timeout_s': self.queue_timeout,
+            'rejections': self.counters['rejected_queue_full'] + self.counters['rejected_timeout'],
+            'last_decrease_at': self._last_decrease_at,
+            **self.counters,
+            'priority': self.priority_stats()
+        }
+
+    def priority_stats(self) -> Dict[str, Any]:
+        """Ожидание слота по классам приоритета (последние вызовы)"""
+        classes = {}
+        for priority in sorted(set(self.weights) | set(self._class_counters), key=lambda p: -self._weight(p)):
+            samples = list(self._wait_samples.get(priority, ()))
+            p50 = _percentile(samples, 50)
+            p95 = _percentile(samples, 95)
+            classes[priority] = {
+                'weight': self._weight(priority),
+                'queued_now': len(self._queues.get(priority, ())),
+                'wait_p50_ms': round(p50 * 1000) if p50 is not None else None,
+                'wait_p95_ms': round(p95 * 1000) if p95 is not None else None,
+                'wait_max_ms': round(max(samples) * 1000) if samples else None,
+                **self._class_counter(priority)
+            }
+        return {'max_wait_s': self.max_wait, 'classes': classes}
+
+
+# Глобальный лимитер процесса
+gemini_limiter = AdaptiveConcurrencyLimiter()
@@ -0,0 +1,98 @@
+"""
+🎟️ МИШУРА - Gemini Priority
+Класс приоритета запросов к Gemini по истории платежей пользователя
+
+- premium - успешная оплата тарифа из GEMINI_PRIORITY_PREMIUM_PLANS
+- paid    - любая другая успешная оплата
+- free    - только стартовый баланс
+Учитываются платежи за последние GEMINI_PRIORITY_PAYMENT_DAYS дней.
+
+Класс задается на время запроса (request_priority) и используется очередью
+лимитера Gemini: при нехватке слотов платящие пользователи обслуживаются
+раньше, но бесплатные не голодают (см. gemini_limiter).
+"""
+
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Any, Optional, Tuple
+
+from gemini_limiter import PRIORITY_FREE, PRIORITY_PAID, PRIORITY_PREMIUM, request_priority
+
+logger = logging.getLogger(__name__)
+
+GEMINI_PRIORITY_PREMIUM_PLANS = {
+    plan.strip() for plan in os.getenv('GEMINI_PRIORITY_PREMIUM_PLANS', 'premium,standard').split(',') if plan.strip()
+}
+GEMINI_PRIORITY_PAYMENT_DAYS = int(os.getenv('GEMINI_PRIORITY_PAYMENT_DAYS', 90))
+GEMINI_PRIORITY_CACHE_SECONDS = float(os.getenv('GEMINI_PRIORITY_CACHE_SECONDS', 300))
+
+
+def classify_payments(plans: Dict[str, int]) -> str:
+    """Класс по числу успешных платежей на тариф"""
+    if any(plan in GEMINI_PRIORITY_PREMIUM_PLANS for plan in plans):
+        return PRIORITY_PREMIUM
+    if plans:
+        return PRIORITY_PAID
+    return PRIORITY_FREE
+
+
+class PriorityResolver:
+    """🎟️ Класс приоритета пользователя с кэшем на GEMINI_PRIORITY_CACHE_SECONDS"""
+
+    def __init__(self, cache_seconds: float = GEMINI_PRIORITY_CACHE_SECONDS):
+        self.cache_seconds = cache_seconds
+        self.db = None
+        self._cache: Dict[int, Tuple[str, float]] = {}
+        self.lookups = 0
+        self.cache_hits = 0
+
+    def attach(self, db) -> None:
+        """Подключить MishuraDB (в lifespan приложения)"""
+        self.db = db
+
+    def invalidate(self, telegram_id: int) -> None:
+        """Платеж прошел - класс пересчитывается при следующем запросе"""
+        self._cache.pop(telegram_id, None)
+
+    async def resolve(self, telegram_id: Optional[int]) -> str:
+        if self.db is None or telegram_id is None:
+            return PRIORITY_FREE
+        cached = self._cache.get(telegram_id)
+        if cached and time.monotonic() - cached[1] < self.cache_seconds:
+            self.cache_hits += 1
+            return cached[0]
+        self.lookups += 1
+        since = datetime.utcnow() - timedelta(days=GEMINI_PRIORITY_PAYMENT_DAYS)
+        try:
+            plans = await asyncio.to_thread(self.db.get_succeeded_payment_plans, telegram_id, since)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось определить приоритет пользователя {telegram_id}: {e}")
+            return PRIORITY_FREE
+        priority = classify_payments(plans)
+        self._cache[telegram_id] = (priority, time.monotonic())
+        return priority
+
+    async def apply(self, telegram_id: Optional[int]) -> str:
+        """Определить класс пользователя и назначить его текущему запросу"""
+        priority = await self.resolve(telegram_id)
+        request_priority.set(priority)
+        return priority
+
+    def stats(self) -> Dict[str, Any]:
+        classes: Dict[str, int] = {}
+        for priority, _ in self._cache.values():
+            classes[priority] = classes.get(priority, 0) + 1
+        return {
+            'premium_plans': sorted(GEMINI_PRIORITY_PREMIUM_PLANS),
+            'payment_days': GEMINI_PRIORITY_PAYMENT_DAYS,
+            'cached_users': classes,
+            'lookups': self.lookups,
+            'cache_hits': self.cache_hits
+        }
+
+
+# Глобальный определитель приоритета процесса
+priority_resolver = PriorityResolver()
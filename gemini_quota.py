@@ -0,0 +1,210 @@
+"""
+📒 МИШУРА - Gemini Quota Ledger
+Общий для всех воркеров учет суточной квоты Gemini
+
+- Каждый вызов и каждый 429 ключа атомарно пишутся в таблицу
+  gemini_quota_ledger (MishuraDB: SQLite или PostgreSQL) по ключу и суткам UTC
+- Счетчик из таблицы возвращается в пул ключей: ротация учитывает вызовы
+  всех воркеров gunicorn, а не только своего процесса
+- По темпу вызовов за сутки прогнозируется время исчерпания квоты пула
+- Когда остаток квоты пула опускается до GEMINI_QUOTA_RESERVE, api.py
+  заранее отдает запасной совет - без списания и последующего возврата STcoins
+
+Записи в БД идут в фоновом потоке и не задерживают вызов Gemini.
+"""
+
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional, Set
+
+from gemini_keys import (ApiKeyPool, ApiKeyState, EVENT_CALL, EVENT_DAILY_EXHAUSTED,
+                         gemini_key_pool, next_quota_reset)
+
+logger = logging.getLogger(__name__)
+
+# Вызовы, оставляемые про запас: повторы и хеджи уже принятых запросов
+GEMINI_QUOTA_RESERVE = int(os.getenv('GEMINI_QUOTA_RESERVE', 3))
+# Как часто перечитывать таблицу (вызовы других воркеров)
+GEMINI_QUOTA_SYNC_SECONDS = float(os.getenv('GEMINI_QUOTA_SYNC_SECONDS', 10))
+# Предупреждать, если по прогнозу квота кончится раньше чем через столько секунд
+GEMINI_QUOTA_WARN_SECONDS = float(os.getenv('GEMINI_QUOTA_WARN_SECONDS', 3600))
+
+# Темп считается не меньше чем по такому окну - первые вызовы суток не дают скачка прогноза
+_MIN_RATE_WINDOW_SECONDS = 300
+
+
+def quota_day(now: Optional[datetime] = None) -> str:
+    return (now or datetime.now(timezone.utc)).strftime('%Y-%m-%d')
+
+
+class QuotaLedger:
+    """📒 Учет вызовов пула ключей в общей таблице и прогноз исчерпания"""
+
+    def __init__(self, pool: ApiKeyPool, reserve: int = GEMINI_QUOTA_RESERVE,
+                 sync_seconds: float = GEMINI_QUOTA_SYNC_SECONDS):
+        self.pool = pool
+        self.reserve = reserve
+        self.sync_seconds = sync_seconds
+        self.db = None
+        self._rows: Dict[str, Dict[str, Any]] = {}
+        self._synced_at = 0.0
+        self._synced_day: Optional[str] = None
+        self._pending: Set[asyncio.Task] = set()
+        self.writes = 0
+        self.write_errors = 0
+        self.degraded_requests = 0
+        self._warned_day: Optional[str] = None
+        pool.add_listener(self._on_key_event)
+
+    def attach(self, db) -> None:
+        """Подключить MishuraDB (в lifespan приложения)"""
+        self.db = db
+        self._synced_at = 0.0
+        logger.info("📒 Учет квоты Gemini подключен к базе данных")
+
+    @property
+    def enabled(self) -> bool:
+        return self.db is not None and self.pool.size > 0
+
+    # --- Запись ---
+
+    def _on_key_event(self, key: ApiKeyState, event: str) -> None:
+        if not self.enabled:
+            return
+        now = time.time()
+        if event == EVENT_CALL:
+            write, args = self._write_call, (key, quota_day(), now)
+        else:
+            write, args = self._write_error, (key, quota_day(), now, event == EVENT_DAILY_EXHAUSTED)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Вне event loop (скрипты) - пишем сразу
+            write(*args)
+            return
+        task = loop.create_task(asyncio.to_thread(write, *args))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    def _write_call(self, key: ApiKeyState, day: str, now: float) -> None:
+        calls = self.db.record_gemini_quota_call(key.fingerprint, day, now)
+        if calls is None:
+            self.write_errors += 1
+            return
+        self.writes += 1
+        # Вызовы других воркеров тоже расходуют квоту ключа
+        if day == quota_day() and calls > key.used_today:
+            key.used_today = calls
+
+    def _write_error(self, key: ApiKeyState, day: str, now: float, exhausted: bool) -> None:
+        if self.db.record_gemini_quota_error(key.fingerprint, day, now, exhausted=exhausted):
+            self.writes += 1
+        else:
+            self.write_errors += 1
+
+    async def flush(self) -> None:
+        """Дождаться фоновых записей (остановка приложения, тесты)"""
+        if self._pending:
+            await asyncio.gather(*list(self._pending), return_exceptions=True)
+
+    # --- Чтение и прогноз ---
+
+    def _apply_rows(self, day: str, rows: list) -> None:
+        self._rows = {row['key_id']: row for row in rows}
+        self._synced_at = time.monotonic()
+        self._synced_day = day
+        for key in self.pool.keys:
+            row = self._rows.get(key.fingerprint)
+            if not row:
+                continue
+            if row.get('exhausted_ts'):
+                key.used_today = max(key.used_today, key.daily_limit)
+            elif row['calls'] > key.used_today:
+                key.used_today = row['calls']
+
+    async def sync(self, force: bool = False) -> None:
+        """Перечитать таблицу, если данные устарели"""
+        if not self.enabled:
+            return
+        day = quota_day()
+        fresh = time.monotonic() - self._synced_at < self.sync_seconds and self._synced_day == day
+        if fresh and not force:
+            return
+        rows = await asyncio.to_thread(self.db.get_gemini_quota_usage, day)
+        self._apply_rows(day, rows)
+
+    def projection(self) -> Dict[str, Any]:
+        """Остаток квоты пула, темп вызовов за сутки и прогноз исчерпания"""
+        now = time.time()
+        reset_at = next_quota_reset()
+        usable = [key for key in self.pool.keys if not key.invalid]
+        remaining = sum(key.remaining_today for key in usable)
+        calls_today = sum(key.used_today for key in usable)
+
+        first_calls = [row['first_call_ts'] for row in self._rows.values() if row.get('first_call_ts')]
+        rate_per_hour = None
+        exhaustion_at = None
+        if first_calls and calls_today:
+            window = max(_MIN_RATE_WINDOW_SECONDS, now - min(first_calls))
+            rate_per_hour = calls_today / window * 3600
+            seconds_left = remaining / rate_per_hour * 3600
+            if now + seconds_left < reset_at.timestamp():
+                exhaustion_at = datetime.fromtimestamp(now + seconds_left, timezone.utc)
+
+        return {
+            'quota_day': quota_day(),
+            'calls_today': calls_today,
+            'remaining_today': remaining,
+            'reserve': self.reserve,
+            'rate_per_hour': round(rate_per_hour, 2) if rate_per_hour is not None else None,
+            # None - при текущем темпе квоты хватит до сброса
+            'projected_exhaustion_at': exhaustion_at.isoformat() if exhaustion_at else None,
+            'resets_at': reset_at.isoformat()
+        }
+
+    async def should_degrade(self) -> Optional[float]:
+        """
+        Проверка перед списанием STcoins.
+
+        Returns:
+            Секунды до сброса квоты, если остаток пула не выше резерва
+            (запрос стоит сразу обслужить запасным советом), иначе None
+        """
+        if not self.enabled:
+            return None
+        try:
+            await self.sync()
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось прочитать учет квоты Gemini: {e}")
+
+        projection = self.projection()
+        exhaustion_at = projection['projected_exhaustion_at']
+        if exhaustion_at and self._warned_day != projection['quota_day']:
+            seconds_left = (datetime.fromisoformat(exhaustion_at) - datetime.now(timezone.utc)).total_seconds()
+            if seconds_left < GEMINI_QUOTA_WARN_SECONDS:
+                self._warned_day = projection['quota_day']
+                logger.warning(f"📒 Квота Gemini по прогнозу кончится в {exhaustion_at} "
+                               f"(темп {projection['rate_per_hour']}/ч, остаток {projection['remaining_today']})")
+
+        if projection['remaining_today'] > self.reserve:
+            return None
+        self.degraded_requests += 1
+        return (next_quota_reset() - datetime.now(timezone.utc)).total_seconds()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'enabled': self.enabled,
+            **self.projection(),
+            'synced_ago_s': round(time.monotonic() - self._synced_at, 1) if self._synced_at else None,
+            'writes': self.writes,
+            'write_errors': self.write_errors,
+            'pending_writes': len(self._pending),
+            'degraded_requests': self.degraded_requests
+        }
+
+
+# Глобальный учет квоты процесса
+quota_ledger = QuotaLedger(gemini_key_pool)
@@ -0,0 +1,171 @@
+"""
+🧭 МИШУРА - Gemini Routing
+Цепочка моделей Gemini с резервированием и хеджированием запросов
+
+- Порядок цепочки задается GEMINI_MODEL и GEMINI_FALLBACK_MODELS; модели
+  с высокой долей ошибок в последних вызовах опускаются в конец. Исходы
+  старше GEMINI_MODEL_HEALTH_TTL забываются, и опущенная модель снова
+  получает запросы (без трафика ее окно иначе никогда бы не обновилось)
+- Если основная модель отвечает дольше своего перцентиля задержки
+  (GEMINI_HEDGE_PERCENTILE), параллельно запускается следующая модель
+  цепочки; используется первый ответ, проигравший запрос отменяется
+- Доля хеджированных запросов ограничена GEMINI_HEDGE_MAX_RATIO,
+  чтобы средняя стоимость консультации не удваивалась
+"""
+
+import os
+import time
+import logging
+from collections import deque
+from typing import Dict, Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+GEMINI_HEDGE_ENABLED = os.getenv('GEMINI_HEDGE_ENABLED', 'true').lower() == 'true'
+GEMINI_HEDGE_PERCENTILE = float(os.getenv('GEMINI_HEDGE_PERCENTILE', 95))
+GEMINI_HEDGE_MAX_RATIO = float(os.getenv('GEMINI_HEDGE_MAX_RATIO', 0.1))
+# Пока замеров мало, хеджируем после фиксированной задержки
+GEMINI_HEDGE_DEFAULT_DELAY = float(os.getenv('GEMINI_HEDGE_DEFAULT_DELAY', 12))
+GEMINI_HEDGE_MIN_DELAY = float(os.getenv('GEMINI_HEDGE_MIN_DELAY', 2))
+GEMINI_HEDGE_MIN_SAMPLES = int(os.getenv('GEMINI_HEDGE_MIN_SAMPLES', 20))
+
+MODEL_STATS_WINDOW = 100
+# Модель считается нездоровой, если среди последних вызовов доля ошибок выше порога
+UNHEALTHY_WINDOW = 10
+UNHEALTHY_FAILURE_RATE = 0.5
+UNHEALTHY_MIN_CALLS = 3
+# Через сколько секунд исход вызова перестает влиять на здоровье модели
+GEMINI_MODEL_HEALTH_TTL = float(os.getenv('GEMINI_MODEL_HEALTH_TTL', 60))
+
+
+def build_model_chain(primary: str, fallbacks: Optional[str] = None) -> List[str]:
+    """Цепочка моделей без повторов: основная, затем резервные"""
+    if fallbacks is None:
+        fallbacks = os.getenv('GEMINI_FALLBACK_MODELS', 'gemini-1.5-flash-8b')
+    chain = []
+    for name in [primary] + fallbacks.split(','):
+        name = name.strip()
+        if name and name not in chain:
+            chain.append(name)
+    return chain
+
+
+class ModelStats:
+    """📈 Задержки и исходы последних вызовов одной модели"""
+
+    def __init__(self, window: int = MODEL_STATS_WINDOW):
+        self.latencies: deque = deque(maxlen=window)
+        self.outcomes: deque = deque(maxlen=UNHEALTHY_WINDOW)
+        self.successes = 0
+        self.failures = 0
+        self.cancelled = 0
+        self.hedge_wins = 0
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def record_outcome(self, ok: bool) -> None:
+        self.outcomes.append((time.monotonic(), ok))
+
+    @property
+    def healthy(self) -> bool:
+        horizon = time.monotonic() - GEMINI_MODEL_HEALTH_TTL
+        recent = [ok for at, ok in self.outcomes if at >= horizon]
+        if len(recent) < UNHEALTHY_MIN_CALLS:
+            return True
+        failure_rate = recent.count(False) / len(recent)
+        return failure_rate <= UNHEALTHY_FAILURE_RATE
+
+    def stats(self) -> Dict[str, Any]:
+        p50 = self.percentile(50)
+        p95 = self.percentile(95)
+        p99 = self.percentile(99)
+        return {
+            'successes': self.successes,
+            'failures': self.failures,
+            'cancelled': self.cancelled,
+            'hedge_wins': self.hedge_wins,
+            'healthy': self.healthy,
+            'samples': len(self.latencies),
+            'p50_ms': round(p50 * 1000) if p50 is not None else None,
+            'p95_ms': round(p95 * 1000) if p95 is not None else None,
+            'p99_ms': round(p99 * 1000) if p99 is not None else None
+        }
+
+
+class ModelRouter:
+    """🧭 Выбор порядка моделей и момента хеджирования по статистике вызовов"""
+
+    def __init__(self, chain: List[str], hedge_enabled: bool = GEMINI_HEDGE_ENABLED,
+                 hedge_percentile: float = GEMINI_HEDGE_PERCENTILE,
+                 hedge_max_ratio: float = GEMINI_HEDGE_MAX_RATIO):
+        self.configured_chain = list(chain)
+        self.hedge_enabled = hedge_enabled
+        self.hedge_percentile = hedge_percentile
+        self.hedge_max_ratio = hedge_max_ratio
+        self.models: Dict[str, ModelStats] = {name: ModelStats() for name in chain}
+        self.requests = 0
+        self.hedges = 0
+        self.fallbacks = 0
+
+    def _stats_for(self, model_name: str) -> ModelStats:
+        if model_name not in self.models:
+            self.models[model_name] = ModelStats()
+        return self.models[model_name]
+
+    def chain(self) -> List[str]:
+        """Порядок моделей для нового запроса: здоровые модели сохраняют исходный порядок"""
+        return sorted(self.configured_chain, key=lambda name: not self._stats_for(name).healthy)
+
+    def hedge_delay(self, model_name: str) -> Optional[float]:
+        """Через сколько секунд запускать хедж (None - хеджирование запрещено)"""
+        if not self.hedge_enabled or self.hedges >= 1 + self.hedge_max_ratio * self.requests:
+            return None
+        stats = self._stats_for(model_name)
+        if len(stats.latencies) < GEMINI_HEDGE_MIN_SAMPLES:
+            return GEMINI_HEDGE_DEFAULT_DELAY
+        return max(GEMINI_HEDGE_MIN_DELAY, stats.percentile(self.hedge_percentile))
+
+    def record_request(self) -> None:
+        self.requests += 1
+
+    def record_hedge(self, model_name: str) -> None:
+        self.hedges += 1
+        logger.info(f"🧭 Хедж-запрос к {model_name}: основная модель отвечает дольше p{self.hedge_percentile:.0f}")
+
+    def record_fallback(self, model_name: str) -> None:
+        self.fallbacks += 1
+        logger.warning(f"🧭 Переход на резервную модель {model_name}")
+
+    def record_success(self, model_name: str, latency: Optional[float], hedged: bool = False) -> None:
+        stats = self._stats_for(model_name)
+        stats.successes += 1
+        stats.record_outcome(True)
+        if latency is not None:
+            stats.latencies.append(latency)
+        if hedged:
+            stats.hedge_wins += 1
+
+    def record_failure(self, model_name: str) -> None:
+        stats = self._stats_for(model_name)
+        stats.failures += 1
+        stats.record_outcome(False)
+
+    def record_cancelled(self, model_name: str) -> None:
+        self._stats_for(model_name).cancelled += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'chain': self.chain(),
+            'hedge_enabled': self.hedge_enabled,
+            'hedge_percentile': self.hedge_percentile,
+            'requests': self.requests,
+            'hedges': self.hedges,
+            'hedge_ratio': round(self.hedges / self.requests, 3) if self.requests else 0.0,
+            'fallbacks': self.fallbacks,
+            'models': {name: stats.stats() for name, stats in self.models.items()}
+        }
@@ -0,0 +1,390 @@
+"""
+🔌 МИШУРА - Gemini Transport
+Подключаемый транспорт Gemini: настоящий API, локальная имитация, запись и воспроизведение
+
+GEMINI_TRANSPORT:
+- google (по умолчанию) - google.generativeai
+- fake   - локальная имитация: задержка по распределению профиля, потоковая
+           выдача токенов, 429/5xx/таймауты с заданной частотой
+- record - настоящий API, ответы дописываются в GEMINI_RECORDING_PATH (NDJSON)
+- replay - ответы из GEMINI_RECORDING_PATH с записанными задержками и токенами,
+           ошибки - по профилю
+
+Имитация проходит весь конвейер (оптимизация изображений, лимитер, автомат
+защиты, списания и сохранение консультаций), поэтому endpoints можно
+нагружать без расхода квоты. В продакшн режиме fake/replay запрещены.
+
+Профиль задается GEMINI_FAKE_PROFILE: имя из FAKE_PROFILES или JSON
+с полями профиля (недостающие берутся из "realistic").
+"""
+
+import os
+import json
+import time
+import random
+import asyncio
+import hashlib
+import logging
+import threading
+from typing import Dict, Any, List, Optional
+
+from google.api_core import exceptions as google_exceptions
+
+from gemini_keys import PooledModel, gemini_key_pool
+from prompt_registry import RANKING_LINE_PREFIX, requested_ranking_size
+
+logger = logging.getLogger(__name__)
+
+GEMINI_TRANSPORT = os.getenv('GEMINI_TRANSPORT', 'google').lower()
+GEMINI_FAKE_PROFILE = os.getenv('GEMINI_FAKE_PROFILE', 'realistic')
+GEMINI_RECORDING_PATH = os.getenv('GEMINI_RECORDING_PATH', 'gemini_recordings.ndjson')
+GEMINI_FAKE_SEED = os.getenv('GEMINI_FAKE_SEED')
+ENVIRONMENT = os.getenv('ENVIRONMENT', 'development')
+
+TRANSPORTS = ('google', 'fake', 'record', 'replay')
+# Транспорты без обращения к настоящему API
+LOCAL_TRANSPORTS = ('fake', 'replay')
+
+# Задержка до первого токена - логнормальная (медиана, sigma);
+# дальше токены идут со скоростью tokens_per_s
+FAKE_PROFILES: Dict[str, Dict[str, Any]] = {
+    'fast': {
+        'latency_median_s': 0.05, 'latency_sigma': 0.2, 'tokens_per_s': 5000,
+        'output_tokens': 400, 'rate_429': 0.0, 'rate_5xx': 0.0, 'rate_timeout': 0.0,
+        'timeout_s': 1.0
+    },
+    'realistic': {
+        'latency_median_s': 1.5, 'latency_sigma': 0.5, 'tokens_per_s': 120,
+        'output_tokens': 600, 'rate_429': 0.01, 'rate_5xx': 0.005, 'rate_timeout': 0.002,
+        'timeout_s': 60.0
+    },
+    'degraded': {
+        'latency_median_s': 4.0, 'latency_sigma': 0.8, 'tokens_per_s': 40,
+        'output_tokens': 600, 'rate_429': 0.15, 'rate_5xx': 0.05, 'rate_timeout': 0.02,
+        'timeout_s': 30.0
+    },
+    'quota_exhausted': {
+        'latency_median_s': 0.2, 'latency_sigma': 0.2, 'tokens_per_s': 120,
+        'output_tokens': 600, 'rate_429': 1.0, 'rate_5xx': 0.0, 'rate_timeout': 0.0,
+        'timeout_s': 60.0
+    }
+}
+
+# Примерно 4 символа на токен - как в оценках Gemini для русского текста с разметкой
+CHARS_PER_TOKEN = 4
+
+_FAKE_ADVICE_BLOCKS = [
+    "# 👗 Оценка образа\n\nСилуэт сбалансирован, цвета сочетаются спокойно и уместно для повода.",
+    "## ✅ Что работает\n\n- Посадка по фигуре\n- Сдержанная палитра\n- Аккуратная длина рукава",
+    "## 💡 Что улучшить\n\n- Добавьте акцентный аксессуар\n- Подберите обувь в тон ремню\n- Уберите лишний объем на талии",
+    "## 🎯 Итог\n\nОбраз подходит для повода; один контрастный акцент сделает его завершенным.",
+]
+
+
+def load_profile(spec: Optional[str] = None) -> Dict[str, Any]:
+    """Профиль имитации по имени или из JSON"""
+    spec = spec or GEMINI_FAKE_PROFILE
+    if spec in FAKE_PROFILES:
+        return dict(FAKE_PROFILES[spec])
+    try:
+        overrides = json.loads(spec)
+    except ValueError:
+        raise ValueError(f"Неизвестный профиль имитации Gemini: {spec}")
+    return {**FAKE_PROFILES['realistic'], **overrides}
+
+
+def prompt_fingerprint(parts: Any) -> str:
+    """Отпечаток запроса для сопоставления записи и воспроизведения"""
+    digest = hashlib.sha256()
+    for part in parts if isinstance(parts, list) else [parts]:
+        if isinstance(part, dict):
+            data = part.get('data', b'')
+            digest.update(data if isinstance(data, bytes) else str(data).encode('utf-8'))
+        else:
+            digest.update(str(part).encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+def _config_value(generation_config: Any, name: str) -> Any:
+    if generation_config is None:
+        return None
+    if isinstance(generation_config, dict):
+        return generation_config.get(name)
+    return getattr(generation_config, name, None)
+
+
+# === ОТВЕТЫ ===
+
+class FakeUsageMetadata:
+    def __init__(self, prompt_token_count: int, candidates_token_count: int):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+class FakeChunk:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeResponse:
+    """Ответ в форме GenerateContentResponse: text, usage_metadata, async-итерация фрагментов"""
+
+    def __init__(self, text: str, input_tokens: int, output_tokens: int,
+                 tokens_per_s: float = 0, fail_after_chunk: Optional[Exception] = None):
+        self._text = text
+        self._tokens_per_s = tokens_per_s
+        self._fail_after_chunk = fail_after_chunk
+        self.usage_metadata = FakeUsageMetadata(input_tokens, output_tokens)
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    async def __aiter__(self):
+        # Фрагменты по ~20 токенов, как в потоке Gemini
+        step = 20 * CHARS_PER_TOKEN
+        for start in range(0, len(self._text), step):
+            if self._tokens_per_s:
+                await asyncio.sleep(20 / self._tokens_per_s)
+            if self._fail_after_chunk is not None and start:
+                raise self._fail_after_chunk
+            yield FakeChunk(self._text[start:start + step])
+
+
+# === МОДЕЛИ ===
+
+class FakeGenerativeModel:
+    """
+    🧪 Локальная имитация GenerativeModel.
+
+    Без записей генерирует советы из шаблонных блоков нужной длины;
+    с записями (replay) отдает записанные ответы режима.
+    """
+
+    def __init__(self, model_name: str, mode: str, generation_config: Optional[Dict[str, Any]] = None,
+                 profile: Optional[Dict[str, Any]] = None, recordings: Optional[List[Dict[str, Any]]] = None,
+                 rng: Optional[random.Random] = None):
+        self.model_name = model_name
+        self.mode = mode
+        self.generation_config = generation_config or {}
+        self.profile = profile or load_profile()
+        self.recordings = recordings or []
+        self._by_fingerprint = {item.get('fingerprint'): item for item in self.recordings}
+        self._rng = rng or random.Random()
+        self._replay_index = 0
+        self.calls = 0
+
+    def _pick_failure(self) -> Optional[Exception]:
+        roll = self._rng.random()
+        if roll < self.profile['rate_429']:
+            return google_exceptions.ResourceExhausted("429 Resource has been exhausted (e.g. check quota).")
+        roll -= self.profile['rate_429']
+        if roll < self.profile['rate_5xx']:
+            return google_exceptions.ServiceUnavailable("503 The service is currently unavailable.")
+        roll -= self.profile['rate_5xx']
+        if roll < self.profile['rate_timeout']:
+            return google_exceptions.DeadlineExceeded("504 Deadline Exceeded")
+        return None
+
+    def _pick_recording(self, fingerprint: str) -> Optional[Dict[str, Any]]:
+        if not self.recordings:
+            return None
+        recording = self._by_fingerprint.get(fingerprint)
+        if recording is None:
+            recording = self.recordings[self._replay_index % len(self.recordings)]
+            self._replay_index += 1
+        return recording
+
+    def _generated_text(self, max_tokens: int, ranking_size: Optional[int] = None) -> str:
+        target = max(1, min(self.profile['output_tokens'], max_tokens)) * CHARS_PER_TOKEN
+        blocks = []
+        while sum(len(block) + 2 for block in blocks) < target:
+            blocks.append(_FAKE_ADVICE_BLOCKS[len(blocks) % len(_FAKE_ADVICE_BLOCKS)])
+        text = "\n\n".join(blocks)[:target].rstrip()
+        if ranking_size:
+            # Турнирный промпт требует строку рейтинга последней строкой ответа
+            ranking = list(range(1, ranking_size + 1))
+            self._rng.shuffle(ranking)
+            text += f"\n\n{RANKING_LINE_PREFIX} {', '.join(map(str, ranking))}"
+        return text
+
+    def _latency(self, recording: Optional[Dict[str, Any]]) -> float:
+        if recording is not None and recording.get('latency_ms') is not None:
+            return recording['latency_ms'] / 1000
+        return self._rng.lognormvariate(0, self.profile['latency_sigma']) * self.profile['latency_median_s']
+
+    async def generate_content_async(self, contents: Any, stream: bool = False,
+                                     generation_config: Any = None, **kwargs) -> FakeResponse:
+        self.calls += 1
+        fingerprint = prompt_fingerprint(contents)
+        recording = self._pick_recording(fingerprint)
+        failure = self._pick_failure()
+
+        if isinstance(failure, google_exceptions.DeadlineExceeded):
+            await asyncio.sleep(self.profile['timeout_s'])
+            raise failure
+        await asyncio.sleep(self._latency(recording))
+        if failure is not None and not stream:
+            raise failure
+
+        max_tokens = _config_value(generation_config, 'max_output_tokens') \
+            or self.generation_config.get('max_output_tokens') or self.profile['output_tokens']
+        if recording is not None:
+            text = recording['text']
+            input_tokens = recording.get('input_tokens') or 0
+            output_tokens = recording.get('output_tokens') or len(text) // CHARS_PER_TOKEN
+        else:
+            prompt_text = " ".join(part for part in (contents if isinstance(contents, list) else [contents])
+                                   if isinstance(part, str))
+            text = self._generated_text(max_tokens, requested_ranking_size(prompt_text))
+            input_tokens = sum(258 if isinstance(part, dict) else len(str(part)) // CHARS_PER_TOKEN
+                               for part in (contents if isinstance(contents, list) else [contents]))
+            output_tokens = len(text) // CHARS_PER_TOKEN
+
+        if not stream:
+            # Время генерации без потока тоже зависит от длины ответа
+            await asyncio.sleep(output_tokens / self.profile['tokens_per_s'])
+            return FakeResponse(text, input_tokens, output_tokens)
+        # В потоке ошибка 429/5xx может прийти посреди ответа
+        return FakeResponse(text, input_tokens, output_tokens, tokens_per_s=self.profile['tokens_per_s'],
+                            fail_after_chunk=failure)
+
+
+class RecordingModel:
+    """📼 Настоящая модель, ответы которой дописываются в файл записей"""
+
+    def __init__(self, model: Any, model_name: str, mode: str, recorder: 'ResponseRecorder'):
+        self._model = model
+        self.model_name = model_name
+        self.mode = mode
+        self._recorder = recorder
+
+    async def generate_content_async(self, contents: Any, stream: bool = False, **kwargs) -> Any:
+        started = time.monotonic()
+        response = await self._model.generate_content_async(contents, stream=stream, **kwargs)
+        fingerprint = prompt_fingerprint(contents)
+        if not stream:
+            self._recorder.record(self.mode, self.model_name, fingerprint, response.text,
+                                  response, time.monotonic() - started)
+            return response
+        return _RecordingStream(response, self, fingerprint, started)
+
+
+class _RecordingStream:
+    """Поток настоящего ответа: фрагменты отдаются как есть, запись - после последнего"""
+
+    def __init__(self, response: Any, model: RecordingModel, fingerprint: str, started: float):
+        self._response = response
+        self._model = model
+        self._fingerprint = fingerprint
+        self._started = started
+
+    @property
+    def usage_metadata(self) -> Any:
+        return getattr(self._response, 'usage_metadata', None)
+
+    async def __aiter__(self):
+        texts = []
+        async for chunk in self._response:
+            texts.append(chunk.text or "")
+            yield chunk
+        self._model._recorder.record(self._model.mode, self._model.model_name, self._fingerprint,
+                                     "".join(texts), self._response, time.monotonic() - self._started)
+
+
+class ResponseRecorder:
+    """Запись ответов в NDJSON (по строке на ответ)"""
+
+    def __init__(self, path: str = GEMINI_RECORDING_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.recorded = 0
+
+    def record(self, mode: str, model_name: str, fingerprint: str, text: str,
+               response: Any, latency: float) -> None:
+        usage = getattr(response, 'usage_metadata', None)
+        record = {
+            'mode': mode,
+            'model': model_name,
+            'fingerprint': fingerprint,
+            'text': text,
+            'input_tokens': getattr(usage, 'prompt_token_count', None),
+            'output_tokens': getattr(usage, 'candidates_token_count', None),
+            'latency_ms': round(latency * 1000)
+        }
+        try:
+            with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.recorded += 1
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось записать ответ Gemini в {self.path}: {e}")
+
+
+def load_recordings(path: str = GEMINI_RECORDING_PATH) -> Dict[str, List[Dict[str, Any]]]:
+    """Записанные ответы по режимам"""
+    by_mode: Dict[str, List[Dict[str, Any]]] = {}
+    if not os.path.exists(path):
+        logger.warning(f"⚠️ Файл записей Gemini не найден: {path} - ответы будут сгенерированы")
+        return by_mode
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                item = json.loads(line)
+                by_mode.setdefault(item.get('mode', 'analyze'), []).append(item)
+    logger.info(f"📼 Загружено записей Gemini: {sum(len(v) for v in by_mode.values())} из {path}")
+    return by_mode
+
+
+# === ТРАНСПОРТ ===
+
+class GeminiTransport:
+    """🔌 Фабрика моделей выбранного транспорта"""
+
+    def __init__(self, kind: str = GEMINI_TRANSPORT, environment: str = ENVIRONMENT):
+        if kind not in TRANSPORTS:
+            raise ValueError(f"Неизвестный GEMINI_TRANSPORT: {kind} (допустимо: {', '.join(TRANSPORTS)})")
+        if kind in LOCAL_TRANSPORTS and environment == 'production':
+            raise ValueError(f"❌ GEMINI_TRANSPORT={kind} запрещен в продакшн режиме")
+        self.kind = kind
+        self.profile = load_profile() if kind in LOCAL_TRANSPORTS else None
+        self._rng = random.Random(int(GEMINI_FAKE_SEED)) if GEMINI_FAKE_SEED else random.Random()
+        self._recordings = load_recordings() if kind == 'replay' else {}
+        self._recorder = ResponseRecorder() if kind == 'record' else None
+        if self.is_local:
+            logger.warning(f"🧪 Gemini работает через локальную имитацию ({kind}), настоящий API не вызывается")
+
+    @property
+    def is_local(self) -> bool:
+        """Ответы формируются локально - ключ API не нужен"""
+        return self.kind in LOCAL_TRANSPORTS
+
+    def create_model(self, model_name: str, mode: str, generation_config: Dict[str, Any]) -> Any:
+        if self.is_local:
+            return FakeGenerativeModel(model_name, mode, generation_config, self.profile,
+                                       self._recordings.get(mode), self._rng)
+        if gemini_key_pool.size:
+            # Ключ выбирается на каждый вызов из пула GEMINI_API_KEYS
+            model = PooledModel(model_name, generation_config, gemini_key_pool)
+        else:
+            import google.generativeai as genai
+            model = genai.GenerativeModel(model_name, generation_config=genai.types.GenerationConfig(**generation_config))
+        if self._recorder is not None:
+            return RecordingModel(model, model_name, mode, self._recorder)
+        return model
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {'transport': self.kind}
+        if self.profile is not None:
+            stats['profile'] = self.profile
+        if self._recordings:
+            stats['recordings'] = {mode: len(items) for mode, items in self._recordings.items()}
+        if self._recorder is not None:
+            stats['recorded'] = self._recorder.recorded
+        return stats
+
+
+# Глобальный транспорт процесса
+gemini_transport = GeminiTransport()
@@ -0,0 +1,226 @@
+"""
+📊 МИШУРА - Gemini Usage
+Учет расхода Gemini по консультациям: токены, изображения, задержка, стоимость
+
+Каждая консультация, дошедшая до Gemini или до кэша ответов, пишет строку
+в таблицу gemini_usage (MishuraDB) со ссылкой на consultations.id и
+correlation_id запроса:
+- режим, endpoint, статус, модель, ключ пула (отпечаток), версия промпта
+- токены запроса и ответа, число и объем отправленных изображений
+- задержка ответившего вызова, число попыток, попадание в кэш
+- оценка стоимости по GEMINI_PRICING (доллары за 1M токенов)
+
+Запись идет в фоновом потоке и не задерживает ответ пользователю.
+Сводки по дням (стоимость, p50/p95 задержки) строит summarize_usage.
+"""
+
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Цены за 1M токенов (запрос/ответ), USD; изображения входят в токены запроса
+_DEFAULT_PRICING = 'gemini-1.5-flash-8b=0.0375/0.15,gemini-1.5-flash=0.075/0.30,' \
+                   'gemini-1.5-pro=1.25/5.00,gemini-2.0-flash=0.10/0.40'
+
+STATUS_SUCCESS = 'success'
+STATUS_ERROR = 'error'
+STATUS_TIMEOUT = 'timeout'
+STATUS_CANCELLED = 'cancelled'  # клиент отключился во время потока
+
+GROUP_BY_FIELDS = ('mode', 'endpoint', 'model', 'key_id', 'prompt_version', 'telegram_id', 'status')
+
+
+def parse_pricing(raw: str) -> Dict[str, Tuple[float, float]]:
+    """'модель=вход/выход,...' -> {модель: (вход, выход)}; ошибочные записи пропускаются"""
+    pricing = {}
+    for item in raw.split(','):
+        try:
+            model, prices = item.split('=')
+            input_price, output_price = prices.split('/')
+            pricing[model.strip()] = (float(input_price), float(output_price))
+        except ValueError:
+            if item.strip():
+                logger.warning(f"⚠️ Некорректная цена Gemini в GEMINI_PRICING: {item}")
+    return pricing
+
+
+GEMINI_PRICING = parse_pricing(os.getenv('GEMINI_PRICING', _DEFAULT_PRICING))
+
+
+def estimate_cost(model: Optional[str], input_tokens: int, output_tokens: int) -> float:
+    """
+    Стоимость вызова в USD.
+
+    Цена берется по самому длинному совпадающему префиксу имени модели
+    (gemini-1.5-flash-002 -> gemini-1.5-flash); неизвестная модель стоит 0.
+    """
+    if not model:
+        return 0.0
+    matches = [name for name in GEMINI_PRICING if model.startswith(name)]
+    if not matches:
+        return 0.0
+    input_price, output_price = GEMINI_PRICING[max(matches, key=len)]
+    return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+
+def build_usage_record(meta: Dict[str, Any], *, endpoint: str, user_id: Optional[int],
+                       correlation_id: str, consultation_id: Optional[int], status: str) -> Dict[str, Any]:
+    """Строка gemini_usage из meta вызова gemini_ai"""
+    input_tokens = meta.get('input_tokens') or 0
+    output_tokens = meta.get('output_tokens') or 0
+    return {
+        'consultation_id': consultation_id,
+        'correlation_id': correlation_id,
+        'telegram_id': user_id,
+        'mode': meta.get('mode', 'unknown'),
+        'endpoint': endpoint,
+        'status': status,
+        'model': meta.get('model'),
+        'key_id': meta.get('key_id'),
+        'prompt_version': meta.get('prompt_version'),
+        'input_tokens': input_tokens,
+        'output_tokens': output_tokens,
+        'image_count': meta.get('image_count', 0),
+        'image_bytes': meta.get('image_bytes', 0),
+        'latency_ms': meta.get('latency_ms'),
+        'attempts': meta.get('attempts', 0),
+        'cache_hit': 1 if meta.get('cache_hit') else 0,
+        'cost_usd': estimate_cost(meta.get('model'), input_tokens, output_tokens),
+        'created_ts': time.time()
+    }
+
+
+def _percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def _usage_day(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d')
+
+
+def _summarize_group(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    calls = [row for row in rows if not row['cache_hit']]
+    latencies = [row['latency_ms'] for row in calls if row['status'] == STATUS_SUCCESS and row['latency_ms'] is not None]
+    cost = sum(row['cost_usd'] or 0 for row in rows)
+    p50 = _percentile(latencies, 50)
+    p95 = _percentile(latencies, 95)
+    return {
+        'consultations': len(rows),
+        'gemini_calls': len(calls),
+        'cache_hits': len(rows) - len(calls),
+        'cache_hit_rate': round((len(rows) - len(calls)) / len(rows), 3) if rows else None,
+        'errors': sum(1 for row in rows if row['status'] != STATUS_SUCCESS),
+        'attempts': sum(row['attempts'] or 0 for row in calls),
+        'input_tokens': sum(row['input_tokens'] or 0 for row in rows),
+        'output_tokens': sum(row['output_tokens'] or 0 for row in rows),
+        'image_bytes': sum(row['image_bytes'] or 0 for row in rows),
+        'cost_usd': round(cost, 6),
+        'latency_p50_ms': round(p50, 1) if p50 is not None else None,
+        'latency_p95_ms': round(p95, 1) if p95 is not None else None
+    }
+
+
+def summarize_usage(rows: List[Dict[str, Any]], group_by: str = 'mode') -> Dict[str, Any]:
+    """
+    Сводка строк gemini_usage по суткам UTC и полю group_by.
+
+    Задержки считаются только по успешным вызовам Gemini (попадания в кэш
+    и ошибки в перцентили не входят).
+    """
+    if group_by not in GROUP_BY_FIELDS:
+        raise ValueError(f"group_by должен быть одним из: {', '.join(GROUP_BY_FIELDS)}")
+    days: Dict[str, Dict[str, List[Dict[str, Any]]]] = {}
+    totals: Dict[str, List[Dict[str, Any]]] = {}
+    for row in rows:
+        group = str(row.get(group_by))
+        days.setdefault(_usage_day(row['created_ts']), {}).setdefault(group, []).append(row)
+        totals.setdefault(group, []).append(row)
+    return {
+        'group_by': group_by,
+        'days': [
+            {
+                'day': day,
+                'cost_usd': round(sum(row['cost_usd'] or 0 for group in groups.values() for row in group), 6),
+                'groups': {group: _summarize_group(group_rows) for group, group_rows in sorted(groups.items())}
+            }
+            for day, groups in sorted(days.items(), reverse=True)
+        ],
+        'totals': {group: _summarize_group(group_rows) for group, group_rows in sorted(totals.items())}
+    }
+
+
+class UsageRecorder:
+    """📊 Фоновая запись строк gemini_usage"""
+
+    def __init__(self):
+        self.db = None
+        self._pending: Set[asyncio.Task] = set()
+        self.writes = 0
+        self.write_errors = 0
+        self.cost_usd = 0.0
+
+    def attach(self, db) -> None:
+        """Подключить MishuraDB (в lifespan приложения)"""
+        self.db = db
+
+    def record(self, meta: Dict[str, Any], *, endpoint: str, user_id: Optional[int], correlation_id: str,
+               consultation_id: Optional[int] = None, status: str = STATUS_SUCCESS) -> None:
+        """
+        Учесть консультацию. Запросы, не дошедшие ни до Gemini, ни до кэша
+        (демо-режим, разомкнутый автомат, ошибка до вызова), не пишутся.
+        """
+        if self.db is None or not (meta.get('attempts') or meta.get('cache_hit')):
+            return
+        record = build_usage_record(meta, endpoint=endpoint, user_id=user_id, correlation_id=correlation_id,
+                                    consultation_id=consultation_id, status=status)
+        self.cost_usd += record['cost_usd']
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(record)
+            return
+        task = loop.create_task(asyncio.to_thread(self._write, record))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        if self.db.save_gemini_usage(record):
+            self.writes += 1
+        else:
+            self.write_errors += 1
+
+    async def flush(self) -> None:
+        """Дождаться фоновых записей (остановка приложения, тесты)"""
+        if self._pending:
+            await asyncio.gather(*list(self._pending), return_exceptions=True)
+
+    async def summary(self, days: int = 7, group_by: str = 'mode') -> Dict[str, Any]:
+        """Сводка за последние days суток"""
+        if self.db is None:
+            return summarize_usage([], group_by)
+        since = time.time() - days * 86400
+        rows = await asyncio.to_thread(self.db.get_gemini_usage, since)
+        return summarize_usage(rows, group_by)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'enabled': self.db is not None,
+            'writes': self.writes,
+            'write_errors': self.write_errors,
+            'pending_writes': len(self._pending),
+            'cost_usd_since_start': round(self.cost_usd, 6),
+            'pricing_per_1m_tokens': {model: {'input': prices[0], 'output': prices[1]}
+                                      for model, prices in GEMINI_PRICING.items()}
+        }
+
+
+# Глобальный учет расхода процесса
+usage_recorder = UsageRecorder()
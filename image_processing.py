@@ -0,0 +1,726 @@
+"""
+🖼️ МИШУРА - Image Processing
+Подготовка изображений для Gemini вне event loop
+
+Декодирование, ресайз и JPEG-кодирование выполняются в пуле процессов.
+Исходные байты загрузки передаются воркеру через multiprocessing.shared_memory,
+а не сериализуются pickle через канал пула.
+
+Автообрезка (IMAGE_AUTOCROP_MODES): после декодирования однородные поля фона
+(стена, зеркало, пол) вокруг человека обрезаются до рамки содержимого с запасом,
+чтобы не платить за них объемом загрузки и токенами изображения. Рамка ищется
+векторно (NumPy) по дисперсии строк/столбцов и средней величине перепадов
+цвета на уменьшенной копии кадра; без NumPy обрезка не выполняется.
+
+Кодирование под бюджет (IMAGE_PAYLOAD_BUDGETS): вместо постоянного quality=85
+качество JPEG подбирается ограниченным двоичным поиском - самый маленький файл,
+сходство которого с исходником (SSIM) не ниже IMAGE_JPEG_MIN_SSIM и который
+укладывается в бюджет байт на изображение. Однотонные вещи кодируются с
+низким качеством без видимых потерь, пестрые - не выходят за бюджет.
+
+Коллаж сравнения (build_collage): 2-4 образа собираются в одно изображение-сетку
+с номерами панелей 1..N - в Gemini уходит одна картинка вместо нескольких.
+"""
+
+import os
+import math
+import time
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from multiprocessing import shared_memory
+from typing import Optional, List, Dict, Any, Tuple
+
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# 0 - пул процессов отключен, обработка идет в потоке
+IMAGE_POOL_WORKERS = int(os.getenv('IMAGE_POOL_WORKERS', 1))
+IMAGE_POOL_MAX_QUEUE = int(os.getenv('IMAGE_POOL_MAX_QUEUE', 16))
+
+DEFAULT_MAX_SIZE = 1024
+DEFAULT_QUALITY = 85
+
+# Финальный ресайз: сначала быстрое целочисленное уменьшение, затем LANCZOS
+RESIZE_REDUCING_GAP = 3.0
+
+# Режимы консультаций, в которых фон обрезается перед кодированием
+IMAGE_AUTOCROP_MODES = {
+    mode.strip() for mode in os.getenv('IMAGE_AUTOCROP_MODES', 'analyze,compare').split(',') if mode.strip()
+}
+# Запас вокруг найденного содержимого - доля его ширины/высоты
+IMAGE_AUTOCROP_MARGIN = float(os.getenv('IMAGE_AUTOCROP_MARGIN', 0.08))
+# Обрезка, убирающая меньше этой доли площади, не выполняется
+IMAGE_AUTOCROP_MIN_SAVING = float(os.getenv('IMAGE_AUTOCROP_MIN_SAVING', 0.1))
+# Рамка меньше этой доли кадра считается ошибкой поиска - кадр не обрезается
+IMAGE_AUTOCROP_MIN_AREA = float(os.getenv('IMAGE_AUTOCROP_MIN_AREA', 0.15))
+
+# Поиск рамки идет на копии не крупнее этого размера
+_AUTOCROP_PROBE_SIZE = 256
+# Полосы у краев кадра, по которым оценивается уровень фона
+_AUTOCROP_BORDER = 0.04
+# Строка/столбец - содержимое, если дисперсия или перепады выше фона во столько раз
+_AUTOCROP_NOISE_FACTOR = 3.0
+# Минимальные пороги (сумма по каналам RGB): почти идеальный фон не дает ложных срабатываний
+_AUTOCROP_MIN_VARIANCE = 75.0
+_AUTOCROP_MIN_EDGE = 6.0
+# Фон с перепадами выше этого уровня - пестрый (комната, улица), такой кадр не обрезается
+_AUTOCROP_MAX_BACKGROUND_EDGE = 12.0
+
+# Подбор качества JPEG под бюджет; false - всегда DEFAULT_QUALITY
+IMAGE_JPEG_ADAPTIVE = os.getenv('IMAGE_JPEG_ADAPTIVE', 'true').lower() == 'true'
+# Бюджет байт на весь запрос по режимам: при сравнении делится между изображениями,
+# поэтому сравнение 4 образов не превышает бюджета режима
+IMAGE_PAYLOAD_BUDGETS = {
+    mode.strip(): int(budget)
+    for mode, budget in (item.split('=') for item in
+                         os.getenv('IMAGE_PAYLOAD_BUDGETS', 'analyze=180000,compare=360000').split(',') if '=' in item)
+}
+IMAGE_JPEG_MIN_SSIM = float(os.getenv('IMAGE_JPEG_MIN_SSIM', 0.97))
+IMAGE_JPEG_MIN_QUALITY = int(os.getenv('IMAGE_JPEG_MIN_QUALITY', 40))
+IMAGE_JPEG_MAX_QUALITY = int(os.getenv('IMAGE_JPEG_MAX_QUALITY', 90))
+# Шагов двоичного поиска на вариант кодирования (каждый - кодирование, декодирование и SSIM)
+IMAGE_JPEG_SEARCH_STEPS = int(os.getenv('IMAGE_JPEG_SEARCH_STEPS', 5))
+# Пробовать прогрессивный JPEG и цветность 4:4:4
+IMAGE_JPEG_TRY_VARIANTS = os.getenv('IMAGE_JPEG_TRY_VARIANTS', 'true').lower() == 'true'
+
+# Субдискретизация цветности в терминах PIL
+_SUBSAMPLING_420 = 2
+_SUBSAMPLING_444 = 0
+# SSIM по блокам 8x8, сдвинутым на 4 px относительно сетки JPEG: видны и размытие, и швы блоков
+_SSIM_BLOCK = 8
+_SSIM_OFFSET = 4
+_SSIM_C1 = (0.01 * 255) ** 2
+_SSIM_C2 = (0.03 * 255) ** 2
+
+# Коллаж сравнения: наибольшая сторона итоговой сетки
+IMAGE_COLLAGE_MAX_SIZE = int(os.getenv('IMAGE_COLLAGE_MAX_SIZE', 1536))
+# Качество промежуточных панелей; итоговый коллаж кодируется под бюджет режима
+IMAGE_COLLAGE_PANEL_QUALITY = int(os.getenv('IMAGE_COLLAGE_PANEL_QUALITY', 95))
+
+# Сетка (столбцы, строки) по числу панелей: 2-3 образа в ряд, 4 - квадратом
+_COLLAGE_GRIDS = {1: (1, 1), 2: (2, 1), 3: (3, 1), 4: (2, 2)}
+_COLLAGE_GAP = 8
+# Высота полосы с номером над панелью - доля высоты панели
+_COLLAGE_CAPTION_RATIO = 0.1
+# Темный фон отделяет панели даже при белых стенах на фото
+_COLLAGE_BACKGROUND = (32, 32, 32)
+_COLLAGE_CAPTION_COLOR = (255, 255, 255)
+
+
+def autocrop_enabled(mode: str) -> bool:
+    """Включена ли автообрезка фона для режима консультации"""
+    return NUMPY_AVAILABLE and mode in IMAGE_AUTOCROP_MODES
+
+
+def image_byte_budget(mode: str, image_count: int = 1) -> Optional[int]:
+    """Бюджет байт на одно изображение запроса или None - кодирование с постоянным качеством"""
+    budget = IMAGE_PAYLOAD_BUDGETS.get(mode)
+    if not IMAGE_JPEG_ADAPTIVE or budget is None:
+        return None
+    return budget // max(1, image_count)
+
+
+def mode_options(mode: str, image_count: int = 1) -> Dict[str, Any]:
+    """Параметры подготовки изображений для режима консультации (обрезка фона, бюджет байт)"""
+    return {'autocrop': autocrop_enabled(mode), 'byte_budget': image_byte_budget(mode, image_count)}
+
+
+def _content_span(variance, edges) -> Optional[Tuple[int, int]]:
+    """Первая и последняя строка (столбец), отличающиеся от фона у краев"""
+    length = len(variance)
+    border = max(2, int(length * _AUTOCROP_BORDER))
+    # Уровень фона - по более спокойному краю: человек может касаться одного края кадра
+    variance_level = min(np.median(variance[:border]), np.median(variance[-border:]))
+    edge_level = min(np.median(edges[:border]), np.median(edges[-border:]))
+    if edge_level > _AUTOCROP_MAX_BACKGROUND_EDGE:
+        return None
+    content = ((variance > max(_AUTOCROP_MIN_VARIANCE, variance_level * _AUTOCROP_NOISE_FACTOR)) |
+               (edges > max(_AUTOCROP_MIN_EDGE, edge_level * _AUTOCROP_NOISE_FACTOR)))
+    indices = np.flatnonzero(content)
+    if not len(indices):
+        return None
+    return int(indices[0]), int(indices[-1]) + 1
+
+
+def find_content_box(img_pil: Image.Image) -> Optional[Tuple[int, int, int, int]]:
+    """
+    Рамка содержимого кадра (left, top, right, bottom) с запасом IMAGE_AUTOCROP_MARGIN.
+
+    Returns:
+        None, если обрезка не нужна, рамка выглядит ненадежной или поиск не удался
+        (тогда кадр уходит без обрезки)
+    """
+    if not NUMPY_AVAILABLE:
+        return None
+    try:
+        return _find_content_box(img_pil)
+    except Exception as e:
+        logger.warning(f"⚠️ Автообрезка пропущена ({img_pil.mode} {img_pil.size[0]}x{img_pil.size[1]}): {e}")
+        return None
+
+
+def _find_content_box(img_pil: Image.Image) -> Optional[Tuple[int, int, int, int]]:
+    width, height = img_pil.size
+    # reduce() поддерживает не все режимы (P, 1, I;16 - "image has wrong mode"): проба по копии в RGB
+    if img_pil.mode not in ('RGB', 'L'):
+        img_pil = img_pil.convert('RGB')
+    factor = max(1, max(width, height) // _AUTOCROP_PROBE_SIZE)
+    probe = img_pil.reduce(factor) if factor > 1 else img_pil
+    # По каналам RGB, а не по яркости: лицо или ткань того же тона, что стена, отличаются цветом
+    pixels = np.asarray(probe.convert('RGB'), dtype=np.float32)
+    if min(pixels.shape[:2]) < 16:
+        return None
+
+    # Перепады: по строке - между соседними столбцами, по столбцу - между соседними строками
+    rows = _content_span(pixels.var(axis=1).sum(axis=1), np.abs(np.diff(pixels, axis=1)).mean(axis=1).sum(axis=1))
+    columns = _content_span(pixels.var(axis=0).sum(axis=1), np.abs(np.diff(pixels, axis=0)).mean(axis=0).sum(axis=1))
+    if rows is None or columns is None:
+        return None
+
+    scale_y = height / pixels.shape[0]
+    scale_x = width / pixels.shape[1]
+    top, bottom = rows[0] * scale_y, rows[1] * scale_y
+    left, right = columns[0] * scale_x, columns[1] * scale_x
+    margin_y = (bottom - top) * IMAGE_AUTOCROP_MARGIN
+    margin_x = (right - left) * IMAGE_AUTOCROP_MARGIN
+    box = (max(0, int(left - margin_x)), max(0, int(top - margin_y)),
+           min(width, int(right + margin_x + 0.5)), min(height, int(bottom + margin_y + 0.5)))
+
+    area = (box[2] - box[0]) * (box[3] - box[1]) / (width * height)
+    if area < IMAGE_AUTOCROP_MIN_AREA or area > 1 - IMAGE_AUTOCROP_MIN_SAVING:
+        return None
+    return box
+
+
+def _fit_size(width: int, height: int, max_size: int) -> Optional[Tuple[int, int]]:
+    """Размер после вписывания в max_size или None, если уменьшение не нужно"""
+    if width <= max_size and height <= max_size:
+        return None
+    if width > height:
+        return max_size, int(height * (max_size / width))
+    return int(width * (max_size / height)), max_size
+
+
+def _encode_jpeg(img_pil: Image.Image, quality: int, subsampling: int = _SUBSAMPLING_420,
+                 progressive: bool = False) -> bytes:
+    buffer = BytesIO()
+    img_pil.save(buffer, format='JPEG', quality=quality, optimize=True,
+                 subsampling=subsampling, progressive=progressive)
+    return buffer.getvalue()
+
+
+def _block_means(plane):
+    height, width = plane.shape
+    return (plane.reshape(height // _SSIM_BLOCK, _SSIM_BLOCK, width).sum(axis=1)
+            .reshape(height // _SSIM_BLOCK, width // _SSIM_BLOCK, _SSIM_BLOCK).sum(axis=2)) / _SSIM_BLOCK ** 2
+
+
+def _ssim_planes(img_pil: Image.Image) -> list:
+    """Плоскости Y и Cb, Cr в половинном разрешении (float32), обрезанные под блоки SSIM"""
+    if img_pil.mode != 'YCbCr':
+        img_pil = img_pil.convert('YCbCr')
+    luma, cb, cr = img_pil.split()
+    planes = []
+    for plane in (luma, cb.reduce(2), cr.reduce(2)):
+        array = np.asarray(plane, dtype=np.float32)[_SSIM_OFFSET:, _SSIM_OFFSET:]
+        height = array.shape[0] // _SSIM_BLOCK * _SSIM_BLOCK
+        width = array.shape[1] // _SSIM_BLOCK * _SSIM_BLOCK
+        planes.append(np.ascontiguousarray(array[:height, :width]))
+    return planes
+
+
+def _plane_ssim(x, y) -> float:
+    # Плоскость меньше блока SSIM (крошечный кадр): сравнивать нечего, порог не применяется
+    if not x.size or not y.size:
+        return 1.0
+    mean_x, mean_y = _block_means(x), _block_means(y)
+    var_x = _block_means(x * x) - mean_x * mean_x
+    var_y = _block_means(y * y) - mean_y * mean_y
+    covariance = _block_means(x * y) - mean_x * mean_y
+    ssim = (((2 * mean_x * mean_y + _SSIM_C1) * (2 * covariance + _SSIM_C2)) /
+            ((mean_x * mean_x + mean_y * mean_y + _SSIM_C1) * (var_x + var_y + _SSIM_C2)))
+    return float(ssim.mean())
+
+
+def jpeg_ssim(reference: list, data: bytes) -> float:
+    """SSIM закодированного JPEG относительно плоскостей исходника (_ssim_planes), веса Y:Cb:Cr = 6:1:1"""
+    decoded = Image.open(BytesIO(data))
+    # Декодер JPEG отдает YCbCr напрямую, без преобразования в RGB и обратно
+    decoded.draft('YCbCr', decoded.size)
+    planes = _ssim_planes(decoded)
+    luma, cb, cr = (_plane_ssim(ref, plane) for ref, plane in zip(reference, planes))
+    return (6 * luma + cb + cr) / 8
+
+
+def _search_quality(img_pil: Image.Image, reference: Optional[list], subsampling: int, byte_budget: int,
+                    min_ssim: float, floor_quality: int) -> Tuple[Optional[tuple], Optional[tuple]]:
+    """
+    Двоичный поиск качества для одного варианта цветности.
+
+    Без эталона (нет NumPy) сходство не измеряется: проходит любое качество не ниже floor_quality.
+
+    Returns:
+        (самый маленький кандидат, прошедший порог и бюджет;
+         лучший по качеству кандидат в бюджете, не прошедший порог) - кортежи (data, ssim, quality)
+    """
+    low, high = IMAGE_JPEG_MIN_QUALITY, IMAGE_JPEG_MAX_QUALITY
+    passed = None
+    within_budget = None
+    # Первая проба - минимальное качество: однотонному кадру его хватает, и поиск
+    # заканчивается за шаг; если минимальное не влезает в бюджет, не влезет ничто
+    quality = low
+    for _ in range(IMAGE_JPEG_SEARCH_STEPS):
+        data = _encode_jpeg(img_pil, quality, subsampling)
+        if len(data) > byte_budget:
+            if quality <= IMAGE_JPEG_MIN_QUALITY:
+                break
+            high = quality - 1
+        else:
+            if reference is not None:
+                score = jpeg_ssim(reference, data)
+                ok = score >= min_ssim
+            else:
+                score, ok = None, quality >= floor_quality
+            if ok:
+                passed = (data, score, quality)
+                high = quality - 1
+            else:
+                if within_budget is None or quality > within_budget[2]:
+                    within_budget = (data, score, quality)
+                low = quality + 1
+        if low > high:
+            break
+        quality = (low + high) // 2
+    return passed, within_budget
+
+
+def _shrink_to_budget(img_pil: Image.Image, byte_budget: int) -> bytes:
+    """Бюджет не достижим и при минимальном качестве (мелкий узор): уменьшаем кадр"""
+    data = _encode_jpeg(img_pil, IMAGE_JPEG_MIN_QUALITY)
+    for _ in range(3):
+        if len(data) <= byte_budget:
+            break
+        # Объем JPEG примерно пропорционален площади кадра
+        scale = math.sqrt(byte_budget / len(data)) * 0.95
+        size = (max(1, int(img_pil.size[0] * scale)), max(1, int(img_pil.size[1] * scale)))
+        img_pil = img_pil.resize(size, Image.Resampling.LANCZOS)
+        data = _encode_jpeg(img_pil, IMAGE_JPEG_MIN_QUALITY)
+    logger.warning(f"⚠️ JPEG не уложился в бюджет {byte_budget} байт при качестве {IMAGE_JPEG_MIN_QUALITY}, "
+                   f"кадр уменьшен до {img_pil.size[0]}x{img_pil.size[1]}: {len(data)} байт")
+    return data
+
+
+def encode_jpeg_budget(img_pil: Image.Image, byte_budget: int, min_ssim: float = IMAGE_JPEG_MIN_SSIM,
+                       quality: int = DEFAULT_QUALITY) -> bytes:
+    """
+    Самый маленький JPEG с SSIM не ниже min_ssim, укладывающийся в byte_budget.
+
+    Сначала ищется качество для цветности 4:2:0; если порог в бюджете не
+    достигнут - для 4:4:4 (насыщенные узоры страдают от субдискретизации
+    цветности). Если порог недостижим, берется лучшее качество в бюджете, а
+    если не помещается и минимальное - кадр уменьшается. Прогрессивная
+    версия найденного варианта берется, если она меньше (пиксели те же).
+    Без NumPy вместо SSIM используется порог качества quality.
+    """
+    reference = _ssim_planes(img_pil) if NUMPY_AVAILABLE else None
+    variants = [_SUBSAMPLING_420, _SUBSAMPLING_444] if IMAGE_JPEG_TRY_VARIANTS else [_SUBSAMPLING_420]
+
+    fallback = None
+    chosen = None
+    for subsampling in variants:
+        passed, within_budget = _search_quality(img_pil, reference, subsampling, byte_budget, min_ssim, quality)
+        if passed:
+            chosen = (*passed, subsampling)
+            break
+        if within_budget and (fallback is None or (within_budget[1] or 0) > (fallback[1] or 0)):
+            fallback = (*within_budget, subsampling)
+    if chosen is None:
+        chosen = fallback
+    if chosen is None:
+        return _shrink_to_budget(img_pil, byte_budget)
+
+    data, score, chosen_quality, subsampling = chosen
+    progressive = False
+    if IMAGE_JPEG_TRY_VARIANTS:
+        progressive_data = _encode_jpeg(img_pil, chosen_quality, subsampling, progressive=True)
+        if len(progressive_data) < len(data):
+            data, progressive = progressive_data, True
+    logger.info(f"🎚️ JPEG q={chosen_quality} {'4:2:0' if subsampling == _SUBSAMPLING_420 else '4:4:4'}"
+                f"{' progressive' if progressive else ''}"
+                f"{f' SSIM {score:.4f}' if score is not None else ''}: {len(data)} байт (бюджет {byte_budget})")
+    return data
+
+
+def optimize_image(img_pil: Image.Image, max_size: int = DEFAULT_MAX_SIZE, quality: int = DEFAULT_QUALITY,
+                   autocrop: bool = False, byte_budget: Optional[int] = None) -> bytes:
+    """
+    Оптимизирует изображение для отправки в API.
+
+    Args:
+        img_pil: Объект PIL.Image
+        max_size: Максимальный размер стороны
+        quality: Качество JPEG
+        autocrop: Обрезать однородный фон вокруг содержимого (find_content_box)
+        byte_budget: Бюджет байт (encode_jpeg_budget); None - постоянное качество quality
+
+    Returns:
+        bytes: Оптимизированные данные изображения
+    """
+    logger.info(f"📷 Оптимизация изображения: исходный размер {img_pil.size}")
+
+    try:
+        # Обрезка фона до ресайза: оставшиеся пиксели получают все разрешение max_size
+        if autocrop:
+            box = find_content_box(img_pil)
+            if box:
+                img_pil = img_pil.crop(box)
+                logger.info(f"✂️ Фон обрезан до {img_pil.size[0]}x{img_pil.size[1]}")
+
+        # Изменение размера если нужно
+        new_size = _fit_size(*img_pil.size, max_size)
+        if new_size:
+            img_pil = img_pil.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+            logger.info(f"📏 Размер изменен на {new_size[0]}x{new_size[1]}")
+
+        # Конвертация в RGB если нужно
+        if img_pil.mode in ('RGBA', 'LA') or (img_pil.mode == 'P' and 'transparency' in img_pil.info):
+            background = Image.new("RGB", img_pil.size, (255, 255, 255))
+            if img_pil.mode == 'P':
+                img_pil = img_pil.convert('RGBA')
+            background.paste(img_pil, mask=img_pil.split()[-1] if img_pil.mode == 'RGBA' else None)
+            img_pil = background
+        elif img_pil.mode != 'RGB':
+            img_pil = img_pil.convert('RGB')
+
+        # Сохранение в JPEG
+        if byte_budget:
+            optimized_bytes = encode_jpeg_budget(img_pil, byte_budget, quality=quality)
+        else:
+            img_byte_arr = BytesIO()
+            img_pil.save(img_byte_arr, format='JPEG', quality=quality, optimize=True)
+            optimized_bytes = img_byte_arr.getvalue()
+
+        logger.info(f"✅ Изображение оптимизировано: {len(optimized_bytes)} байт")
+        return optimized_bytes
+
+    except Exception as e:
+        logger.error(f"❌ Ошибка оптимизации изображения: {str(e)}")
+        raise ValueError(f"Ошибка оптимизации изображения: {str(e)}")
+
+
+def decode_image(image_data, max_size: int = DEFAULT_MAX_SIZE) -> Image.Image:
+    """
+    Декодирует байты загрузки с учетом целевого размера.
+
+    Для JPEG декодер через draft() сразу масштабирует DCT (1/2, 1/4, 1/8)
+    до наименьшего размера, который все еще не меньше max_size, поэтому
+    12-мегапиксельное фото не распаковывается целиком. Ориентация из EXIF
+    применяется здесь же; метаданные при последующем JPEG-кодировании
+    не переносятся.
+    """
+    try:
+        img_pil = Image.open(BytesIO(image_data))
+        if img_pil.format == 'JPEG':
+            draft_size = _fit_size(*img_pil.size, max_size)
+            if draft_size:
+                img_pil.draft(None, draft_size)
+        ImageOps.exif_transpose(img_pil, in_place=True)
+        return img_pil
+    except Exception as e:
+        raise ValueError(f"Некорректные данные изображения: {str(e)}")
+
+
+def optimize_image_bytes(image_data, max_size: int = DEFAULT_MAX_SIZE, quality: int = DEFAULT_QUALITY,
+                         autocrop: bool = False, byte_budget: Optional[int] = None) -> bytes:
+    """Декодирует байты загрузки и оптимизирует изображение"""
+    return optimize_image(decode_image(image_data, max_size), max_size, quality, autocrop, byte_budget)
+
+
+def collage_grid(count: int) -> Tuple[int, int]:
+    """Сетка коллажа (столбцы, строки) для 1-4 панелей"""
+    if count not in _COLLAGE_GRIDS:
+        raise ValueError(f"Коллаж собирается из 1-4 изображений, передано: {count}")
+    return _COLLAGE_GRIDS[count]
+
+
+def _caption_font(size: int):
+    try:
+        return ImageFont.load_default(size=size)
+    except Exception:
+        # Без FreeType - встроенный растровый шрифт фиксированного размера
+        return ImageFont.load_default()
+
+
+def build_collage(images: List[bytes], max_size: int = IMAGE_COLLAGE_MAX_SIZE,
+                  byte_budget: Optional[int] = None, quality: int = DEFAULT_QUALITY) -> bytes:
+    """
+    Собирает изображения в одну сетку с номерами 1..N над панелями
+    (слева направо, сверху вниз).
+
+    Все ячейки одного размера: пропорции - по самому широкому изображению,
+    размер - наибольший, при котором коллаж не длиннее max_size; изображения
+    не увеличиваются. Коллаж кодируется под byte_budget (encode_jpeg_budget),
+    без бюджета - с качеством quality.
+    """
+    panels = [decode_image(data).convert('RGB') for data in images]
+    cols, rows = collage_grid(len(panels))
+    aspect = max(panel.width / panel.height for panel in panels)
+    cell_height = int(min(
+        (max_size - (cols + 1) * _COLLAGE_GAP) / (cols * aspect),
+        (max_size - (rows + 1) * _COLLAGE_GAP) / (rows * (1 + _COLLAGE_CAPTION_RATIO)),
+        max(panel.height for panel in panels)
+    ))
+    cell_width = int(cell_height * aspect)
+    caption_height = int(cell_height * _COLLAGE_CAPTION_RATIO)
+
+    canvas = Image.new('RGB', (cols * cell_width + (cols + 1) * _COLLAGE_GAP,
+                               rows * (cell_height + caption_height) + (rows + 1) * _COLLAGE_GAP),
+                       _COLLAGE_BACKGROUND)
+    draw = ImageDraw.Draw(canvas)
+    font = _caption_font(int(caption_height * 0.8))
+    for index, panel in enumerate(panels):
+        left = _COLLAGE_GAP + (index % cols) * (cell_width + _COLLAGE_GAP)
+        top = _COLLAGE_GAP + (index // cols) * (cell_height + caption_height + _COLLAGE_GAP)
+        label = str(index + 1)
+        bbox = draw.textbbox((0, 0), label, font=font)
+        draw.text((left + (cell_width - bbox[0] - bbox[2]) / 2, top + (caption_height - bbox[1] - bbox[3]) / 2),
+                  label, fill=_COLLAGE_CAPTION_COLOR, font=font)
+        panel.thumbnail((cell_width, cell_height), Image.Resampling.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+        canvas.paste(panel, (left + (cell_width - panel.width) // 2,
+                             top + caption_height + (cell_height - panel.height) // 2))
+
+    data = encode_jpeg_budget(canvas, byte_budget, quality=quality) if byte_budget else _encode_jpeg(canvas, quality)
+    logger.info(f"🧩 Коллаж {cols}x{rows} из {len(panels)} изображений: "
+                f"{canvas.size[0]}x{canvas.size[1]}, {len(data)} байт")
+    return data
+
+
+def warm_up_codecs() -> Dict[str, Any]:
+    """
+    Прогрев PIL: регистрация плагинов и первое кодирование/декодирование JPEG и PNG.
+
+    Returns:
+        Зарегистрированные форматы (для отчета прогрева)
+    """
+    Image.init()
+    tiny = Image.new('RGB', (16, 16), (128, 64, 32))
+    for image_format in ('JPEG', 'PNG'):
+        buffer = BytesIO()
+        tiny.save(buffer, image_format)
+        optimize_image_bytes(buffer.getvalue())
+    return {'formats': len(Image.OPEN)}
+
+
+def _tiny_jpeg() -> bytes:
+    buffer = BytesIO()
+    Image.new('RGB', (16, 16), (128, 64, 32)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def _timed(func, *args) -> Tuple[Any, float]:
+    """Выполнить задачу и вернуть (результат, время работы в секундах) - без ожидания в очереди пула"""
+    started = time.perf_counter()
+    return func(*args), time.perf_counter() - started
+
+
+def _optimize_from_shared_memory(shm_name: str, size: int, max_size: int, quality: int, autocrop: bool,
+                                 byte_budget: Optional[int]) -> bytes:
+    """Точка входа воркера: читает загрузку из shared memory и оптимизирует ее"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        view = shm.buf[:size]
+        try:
+            return optimize_image_bytes(view, max_size, quality, autocrop, byte_budget)
+        finally:
+            view.release()
+    finally:
+        shm.close()
+
+
+class ImageProcessingPool:
+    """
+    🖼️ Пул процессов для подготовки изображений
+
+    Ограничивает число одновременно ожидающих задач (IMAGE_POOL_MAX_QUEUE),
+    чтобы всплеск загрузок не раздувал память сервиса.
+    """
+
+    def __init__(self, workers: int = IMAGE_POOL_WORKERS, max_queue: int = IMAGE_POOL_MAX_QUEUE):
+        self.workers = max(0, workers)
+        self.max_queue = max(1, max_queue)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.waiting = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        # Сглаженные время работы задачи и ожидание в очереди (мс) - для контроля допуска
+        self.service_ms = 0.0
+        self.queue_wait_ms = 0.0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn: воркеры не наследуют gRPC-потоки и состояние родителя
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            logger.info(f"🖼️ Пул обработки изображений запущен: {self.workers} процесс(ов)")
+        return self._executor
+
+    async def _run_in_pool(self, image_data: bytes, max_size: int, quality: int, autocrop: bool,
+                           byte_budget: Optional[int]) -> bytes:
+        loop = asyncio.get_running_loop()
+        shm = shared_memory.SharedMemory(create=True, size=max(1, len(image_data)))
+        try:
+            shm.buf[:len(image_data)] = image_data
+            return await loop.run_in_executor(
+                self._get_executor(), _timed, _optimize_from_shared_memory,
+                shm.name, len(image_data), max_size, quality, autocrop, byte_budget
+            )
+        finally:
+            shm.close()
+            shm.unlink()
+
+    async def _run_pickled(self, func, *args):
+        """Задача с небольшими аргументами (уже оптимизированные изображения) - через канал пула"""
+        return await asyncio.get_running_loop().run_in_executor(self._get_executor(), _timed, func, *args)
+
+    async def _execute(self, run_in_pool, func, args: tuple):
+        """Выполнить задачу в пуле с ограничением очереди; без процессов или после падения пула - в потоке"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_queue)
+
+        entered = time.monotonic()
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.in_flight += 1
+        try:
+            if self.workers == 0:
+                result, service_s = await asyncio.to_thread(_timed, func, *args)
+            else:
+                try:
+                    result, service_s = await run_in_pool(*args)
+                except BrokenProcessPool:
+                    logger.error("❌ Пул обработки изображений упал, пересоздаем")
+                    self._executor = None
+                    result, service_s = await asyncio.to_thread(_timed, func, *args)
+            self.completed += 1
+            self._observe(time.monotonic() - entered, service_s)
+            return result
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+    def _observe(self, total_s: float, service_s: float) -> None:
+        self.service_ms = 0.8 * self.service_ms + 0.2 * service_s * 1000
+        self.queue_wait_ms = 0.8 * self.queue_wait_ms + 0.2 * max(0.0, total_s - service_s) * 1000
+
+    @property
+    def queue_depth(self) -> int:
+        """Задачи, ожидающие свободного процесса"""
+        return self.waiting + max(0, self.in_flight - max(1, self.workers))
+
+    def current_wait_ms(self) -> float:
+        """Измеренное ожидание в очереди, пока в ней есть задачи; свободный пул - 0"""
+        return self.queue_wait_ms if self.queue_depth > 0 else 0.0
+
+    async def optimize(self, image_data: bytes, max_size: int = DEFAULT_MAX_SIZE,
+                       quality: int = DEFAULT_QUALITY, autocrop: bool = False,
+                       byte_budget: Optional[int] = None) -> bytes:
+        """Оптимизировать изображение вне event loop"""
+        return await self._execute(self._run_in_pool, optimize_image_bytes,
+                                   (image_data, max_size, quality, autocrop, byte_budget))
+
+    async def optimize_many(self, images: List[bytes], max_size: int = DEFAULT_MAX_SIZE,
+                            quality: int = DEFAULT_QUALITY, autocrop: bool = False,
+                            byte_budget: Optional[int] = None) -> List[bytes]:
+        """Параллельно оптимизировать несколько изображений (режим сравнения; byte_budget - на одно изображение)"""
+        return list(await asyncio.gather(*(self.optimize(img, max_size, quality, autocrop, byte_budget)
+                                           for img in images)))
+
+    async def collage(self, images: List[bytes], max_size: int = IMAGE_COLLAGE_MAX_SIZE,
+                      byte_budget: Optional[int] = None) -> bytes:
+        """Собрать коллаж из оптимизированных изображений вне event loop"""
+        return await self._execute(partial(self._run_pickled, build_collage), build_collage,
+                                   (images, max_size, byte_budget))
+
+    async def warm_up(self) -> None:
+        """Запустить процессы пула и импортировать PIL в каждом из них до первой загрузки"""
+        image = _tiny_jpeg()
+        await asyncio.gather(*(self.optimize(image) for _ in range(max(1, self.workers))))
+
+    def stats(self) -> Dict[str, Any]:
+        """Состояние пула для диагностики"""
+        return {
+            'mode': 'process_pool' if self.workers else 'thread',
+            'autocrop_modes': sorted(IMAGE_AUTOCROP_MODES) if NUMPY_AVAILABLE else [],
+            'payload_budgets': IMAGE_PAYLOAD_BUDGETS if IMAGE_JPEG_ADAPTIVE else {},
+            'collage_max_size': IMAGE_COLLAGE_MAX_SIZE,
+            'workers': self.workers,
+            'started': self._executor is not None,
+            'max_queue': self.max_queue,
+            'queue_depth': self.queue_depth,
+            'waiting': self.waiting,
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'failed': self.failed,
+            'service_ms': round(self.service_ms, 1),
+            'queue_wait_ms': round(self.queue_wait_ms, 1),
+            'current_wait_ms': round(self.current_wait_ms(), 1)
+        }
+
+    def shutdown(self) -> None:
+        """Остановить процессы пула"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            logger.info("🛑 Пул обработки изображений остановлен")
+
+
+# Глобальный пул процесса
+image_pool = ImageProcessingPool()
+
+
+async def optimize_image_async(image_data: bytes, max_size: int = DEFAULT_MAX_SIZE,
+                               quality: int = DEFAULT_QUALITY, autocrop: bool = False,
+                               byte_budget: Optional[int] = None) -> bytes:
+    """Оптимизация одного изображения через глобальный пул"""
+    return await image_pool.optimize(image_data, max_size, quality, autocrop, byte_budget)
+
+
+async def optimize_images_async(images: List[bytes], max_size: int = DEFAULT_MAX_SIZE,
+                                quality: int = DEFAULT_QUALITY, autocrop: bool = False,
+                                byte_budget: Optional[int] = None) -> List[bytes]:
+    """Параллельная оптимизация нескольких изображений через глобальный пул"""
+    return await image_pool.optimize_many(images, max_size, quality, autocrop, byte_budget)
+
+
+async def optimize_collage_async(images: List[bytes], mode: str = 'compare') -> bytes:
+    """
+    Коллаж режима через глобальный пул: панели оптимизируются параллельно
+    (обрезка фона режима, высокое качество), коллаж кодируется под бюджет
+    режима на одно изображение.
+    """
+    panels = await image_pool.optimize_many(images, quality=IMAGE_COLLAGE_PANEL_QUALITY,
+                                            autocrop=autocrop_enabled(mode))
+    return await image_pool.collage(panels, byte_budget=image_byte_budget(mode, 1))
@@ -12,6 +12,7 @@ from yookassa.domain.models import Currency
 from yookassa.domain.exceptions import ApiError, ResponseProcessingError
 
 from database import MishuraDB
+from gemini_priority import priority_resolver
 
 logger = logging.getLogger(__name__)
 
@@ -169,6 +170,8 @@ class PaymentService:
             
             if success:
                 logger.info(f"✅ Платеж {yookassa_payment_id} успешно обработан. Новый баланс: {new_balance}")
+                # Оплативший пользователь сразу получает приоритет в очереди Gemini
+                priority_resolver.invalidate(telegram_id)
                 return True
             else:
                 logger.error(f"❌ Не удалось отметить платеж {yookassa_payment_id} как обработанный")
@@ -0,0 +1,478 @@
+"""
+🧾 МИШУРА - Prompt Registry
+Версионированные промпты консультаций, параметры генерации и учет токенов
+
+- Каждый режим (analyze/compare) имеет несколько версий промпта; живая
+  версия задается PROMPT_VERSION_<MODE>, экспериментальная -
+  PROMPT_EXPERIMENT_<MODE> с долей трафика PROMPT_EXPERIMENT_SHARE
+- Шаблон строится один раз на (режим, версия, число изображений, повод),
+  пожелания пользователя подставляются в готовый шаблон
+- Сравнение веером (fan-out): outfit_card - короткое описание одного образа
+  без привязки к поводу (переиспользуется в следующих сравнениях),
+  compare_rank - текстовое сравнение готовых описаний под повод
+- Для сравнения коллажем (все образы на одном изображении) к шаблону любой
+  версии добавляется пояснение о нумерованных панелях, для турнира -
+  требование итоговой строки рейтинга (РЕЙТИНГ: 2, 1, 3)
+- Токены запроса/ответа (usage_metadata Gemini) и задержка учитываются
+  по каждой версии; report() сравнивает стоимость версий
+"""
+
+import os
+import re
+import random
+import logging
+import threading
+from collections import deque
+from functools import lru_cache
+from typing import Optional, Dict, Any, Callable, List
+
+logger = logging.getLogger(__name__)
+
+PROMPT_EXPERIMENT_SHARE = float(os.getenv('PROMPT_EXPERIMENT_SHARE', 0))
+PROMPT_TEMPLATE_CACHE_SIZE = int(os.getenv('PROMPT_TEMPLATE_CACHE_SIZE', 512))
+
+# Место для пожеланий пользователя в готовом шаблоне
+_PREFERENCES_SLOT = "\x00preferences\x00"
+
+LATENCY_WINDOW = 200
+
+
+# === ШАБЛОНЫ ===
+
+def _concise_analysis(occasion: str, image_count: int) -> str:
+    # 🔧 ИСПРАВЛЕННЫЙ ПРОМТ БЕЗ МЕТАКОММЕНТАРИЕВ
+    return f"""Ты профессиональный стилист-консультант. Проанализируй образ на фотографии и дай ТОЛЬКО практические рекомендации.
+
+ПРАВИЛА ОТВЕТА:
+- НЕ комментируй свою работу
+- НЕ объясняй как ты анализируешь
+- НЕ добавляй метаинформацию
+- Отвечай ТОЛЬКО как стилист клиенту
+
+ФОРМАТ ОТВЕТА:
+Дай краткий анализ образа и практические советы для улучшения стиля.
+
+КОНТЕКСТ:
+Повод: {occasion}
+Пожелания: {_PREFERENCES_SLOT}
+
+Проанализируй образ и дай профессиональные рекомендации по стилю."""
+
+
+def _concise_comparison(occasion: str, image_count: int) -> str:
+    return f"""Ты профессиональный стилист. Сравни образы на фотографиях и дай ТОЛЬКО практические рекомендации.
+
+ПРАВИЛА ОТВЕТА:
+- НЕ комментируй процесс анализа
+- НЕ объясняй как ты сравниваешь
+- НЕ добавляй метаинформацию о своей работе
+- Отвечай ТОЛЬКО как стилист клиенту
+
+ФОРМАТ ОТВЕТА:
+1. Краткая оценка каждого образа
+2. Рейтинг от лучшего к худшему
+3. Рекомендации по улучшению
+
+КОНТЕКСТ:
+Повод: {occasion}
+Пожелания: {_PREFERENCES_SLOT}
+
+Сравни образы и дай профессиональную оценку."""
+
+
+def _concise_preferences(preferences: Optional[str]) -> str:
+    return preferences if preferences else "Общие рекомендации"
+
+
+def _structured_analysis(occasion: str, image_count: int) -> str:
+    return f"""Ты - профессиональный стилист МИШУРА. Проанализируй одежду на изображении для повода: {occasion}.
+
+ВАЖНО! Используй точно такую структуру ответа:
+
+🎽 **АНАЛИЗ ОБРАЗА**
+
+**🎯 Общая оценка**
+✅ Краткая оценка уместности образа для указанного повода
+
+**🎨 Цветовая гамма**
+✅ Анализ цветов и их сочетания в образе
+
+**⚖️ Гармония образа**
+✅ Оценка сбалансированности всех элементов
+
+**👟 Практичность**
+✅ Удобство и функциональность для повода
+
+⸻
+
+**📌 РЕКОМЕНДАЦИИ**
+
+**Дополнить образ:**
+• Конкретные предметы гардероба
+• Аксессуары и обувь
+
+**Общие советы:**
+• Практические рекомендации по стилю
+
+⸻
+
+💡 **Совет от МИШУРЫ:** [практический совет для будущих консультаций]
+
+Отвечай на русском языке, дружелюбно и профессионально. НЕ используй цифры в конце предложений.{_PREFERENCES_SLOT}"""
+
+
+def _structured_analysis_preferences(preferences: Optional[str]) -> str:
+    return f"\n\nУчитывай дополнительный вопрос: {preferences}" if preferences else ""
+
+
+def _structured_comparison(occasion: str, image_count: int) -> str:
+    image_emojis = ["🎽", "👖", "👔", "👗", "🧥", "👕"]
+
+    base_prompt = f"""Ты - профессиональный стилист МИШУРА.
+
+⚠️ КРИТИЧЕСКИ ВАЖНО: Я отправляю тебе ТОЧНО {image_count} изображений. Ты ОБЯЗАН проанализировать КАЖДОЕ из {image_count} изображений. НЕ пропускай ни одного!
+
+Сравни ВСЕ {image_count} представленных образов для повода: {occasion}.
+
+СТРУКТУРА ОБЯЗАТЕЛЬНОГО ОТВЕТА (АНАЛИЗИРУЙ КАЖДЫЙ ОБРАЗ, НЕ ПРОПУСКАЙ!):
+
+"""
+
+    for i in range(image_count):
+        emoji = image_emojis[i % len(image_emojis)]
+        base_prompt += f"""{emoji} **ОБРАЗ {i+1} (ОБЯЗАТЕЛЬНО АНАЛИЗИРУЙ):** [опиши что видишь на {i+1}-м изображении]
+
+**Уместность для {occasion}**
+✅ Подходит ли этот образ для {occasion}
+
+**Цветовая гамма образа {i+1}**
+✅ Какие цвета в {i+1}-м образе
+
+**Гармония образа {i+1}**
+✅ Насколько сбалансирован {i+1}-й образ
+
+**Практичность образа {i+1}**
+✅ Удобство {i+1}-го образа для {occasion}
+
+⸻
+
+"""
+
+    base_prompt += f"""🏆 **ОБЯЗАТЕЛЬНОЕ СРАВНЕНИЕ ВСЕХ {image_count} ОБРАЗОВ**
+
+⚠️ ВАЖНО: Ты ДОЛЖЕН сравнить ВСЕ {image_count} образов!
+
+**Лучший образ из {image_count}:** Образ [номер от 1 до {image_count}] - [почему именно этот]
+
+**Худший образ из {image_count}:** Образ [номер от 1 до {image_count}] - [почему именно этот]
+
+**Рекомендации по улучшению (ДЛЯ КАЖДОГО ИЗ {image_count} ОБРАЗОВ):**"""
+
+    for i in range(image_count):
+        base_prompt += f"\n• ОБРАЗ {i+1}: [как улучшить {i+1}-й образ]"
+
+    base_prompt += f"""
+
+⸻
+
+💡 **Совет от МИШУРЫ:** [практический совет учитывая все {image_count} образа]
+
+⚠️ ПРОВЕРЬ СЕБЯ: Ты проанализировал ВСЕ {image_count} образов? Если нет - начни заново!
+
+**ЧЕК-ЛИСТ для тебя:**
+- [ ] Проанализированы ВСЕ {image_count} образов
+- [ ] Даны рекомендации для КАЖДОГО образа
+- [ ] Выбран лучший и худший образ
+- [ ] Дана финальная рекомендация
+
+Отвечай на русском языке, дружелюбно и профессионально."""
+
+    return base_prompt + _PREFERENCES_SLOT
+
+
+def _structured_comparison_preferences(preferences: Optional[str]) -> str:
+    return f"\n\nДополнительно учитывай: {preferences}" if preferences else ""
+
+
+def _outfit_card(occasion: str, image_count: int) -> str:
+    # Повод не используется: описание одного и того же фото подходит для любого сравнения
+    return """Ты профессиональный стилист. Опиши образ на фотографии для последующего сравнения с другими образами.
+Отвечай строго по пунктам, кратко, без вступлений и без советов:
+
+Вещи: [одежда, обувь и аксессуары]
+Цвета: [основные цвета и их сочетание]
+Силуэт и посадка: [как сидят вещи, пропорции]
+Стиль: [стиль; формальность от 1 (домашний) до 5 (вечерний)]
+Сильные стороны: [1-2 пункта]
+Слабые стороны: [1-2 пункта]"""
+
+
+def _no_preferences(preferences: Optional[str]) -> str:
+    return ""
+
+
+def _concise_ranking(occasion: str, image_count: int) -> str:
+    return f"""Ты профессиональный стилист. Ниже - описания {image_count} образов, составленные по фотографиям клиента. Сравни образы и дай ТОЛЬКО практические рекомендации.
+
+ПРАВИЛА ОТВЕТА:
+- НЕ комментируй процесс анализа
+- НЕ упоминай, что видишь описания, а не фотографии
+- НЕ добавляй метаинформацию о своей работе
+- Отвечай ТОЛЬКО как стилист клиенту
+
+ФОРМАТ ОТВЕТА:
+1. Краткая оценка каждого образа
+2. Рейтинг от лучшего к худшему
+3. Рекомендации по улучшению
+
+КОНТЕКСТ:
+Повод: {occasion}
+Пожелания: {_PREFERENCES_SLOT}
+
+ОПИСАНИЯ ОБРАЗОВ:"""
+
+
+# Сравнение коллажем: одно изображение, образы - пронумерованные панели
+_COLLAGE_NOTE = """ВАЖНО: все {image_count} образов собраны на ОДНОМ изображении-коллаже. Каждый образ - отдельная панель, номер образа (1-{image_count}) подписан над панелью; панели пронумерованы слева направо, сверху вниз. Образ N - это панель с номером N. Когда ниже говорится об изображениях, имеются в виду панели коллажа.
+
+"""
+
+
+# Турнир: машиночитаемый рейтинг последней строкой ответа
+RANKING_LINE_PREFIX = "РЕЙТИНГ:"
+_RANKING_NOTE = """
+
+В САМОЙ ПОСЛЕДНЕЙ строке ответа обязательно напиши номера всех {image_count} образов от лучшего к худшему в формате:
+""" + RANKING_LINE_PREFIX + " 2, 1, 3"
+_RANKING_REQUEST = re.compile(r'номера всех (\d+) образов от лучшего к худшему')
+
+
+def requested_ranking_size(prompt_text: str) -> Optional[int]:
+    """Сколько образов должна назвать строка рейтинга (None - рейтинг не запрошен)"""
+    match = _RANKING_REQUEST.search(prompt_text or "")
+    return int(match.group(1)) if match else None
+
+
+# === РЕЕСТР ===
+
+class PromptVersion:
+    """Одна версия промпта режима вместе с параметрами генерации"""
+
+    def __init__(self, mode: str, version: str, builder: Callable[[str, int], str],
+                 format_preferences: Callable[[Optional[str]], str],
+                 generation_config: Dict[str, Any], description: str = ""):
+        self.mode = mode
+        self.version = version
+        self.builder = builder
+        self.format_preferences = format_preferences
+        self.generation_config = generation_config
+        self.description = description
+
+
+class RenderedPrompt:
+    """Готовый текст промпта и версия, по которой он построен"""
+
+    def __init__(self, mode: str, version: str, text: str, generation_config: Dict[str, Any]):
+        self.mode = mode
+        self.version = version
+        self.text = text
+        self.generation_config = generation_config
+
+
+class _VersionStats:
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.calls_with_usage = 0
+        self.latencies: deque = deque(maxlen=LATENCY_WINDOW)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+class PromptRegistry:
+    """🧾 Реестр версий промптов с учетом токенов и задержек"""
+
+    def __init__(self):
+        self._versions: Dict[str, Dict[str, PromptVersion]] = {}
+        self._live: Dict[str, str] = {}
+        self._experiments: Dict[str, str] = {}
+        self._stats: Dict[tuple, _VersionStats] = {}
+        self._lock = threading.Lock()
+        self._template = lru_cache(maxsize=PROMPT_TEMPLATE_CACHE_SIZE)(self._build_template)
+
+    def register(self, prompt: PromptVersion, live: bool = False) -> None:
+        self._versions.setdefault(prompt.mode, {})[prompt.version] = prompt
+        if live or prompt.mode not in self._live:
+            self._live[prompt.mode] = prompt.version
+
+    def configure_from_env(self) -> None:
+        """Живые и экспериментальные версии из PROMPT_VERSION_<MODE> / PROMPT_EXPERIMENT_<MODE>"""
+        for mode, versions in self._versions.items():
+            live = os.getenv(f'PROMPT_VERSION_{mode.upper()}')
+            if live:
+                if live in versions:
+                    self._live[mode] = live
+                else:
+                    logger.warning(f"⚠️ Неизвестная версия промпта {mode}: {live}, используется {self._live[mode]}")
+            experiment = os.getenv(f'PROMPT_EXPERIMENT_{mode.upper()}')
+            if experiment in versions and experiment != self._live[mode]:
+                self._experiments[mode] = experiment
+
+    def modes(self) -> List[str]:
+        return sorted(self._versions)
+
+    def live_version(self, mode: str) -> str:
+        return self._live[mode]
+
+    def live_versions(self) -> Dict[str, str]:
+        return dict(self._live)
+
+    def get(self, mode: str, version: Optional[str] = None) -> PromptVersion:
+        if mode not in self._versions:
+            raise ValueError(f"Неизвестный режим промпта: {mode}")
+        version = version or self._live[mode]
+        if version not in self._versions[mode]:
+            raise ValueError(f"Неизвестная версия промпта {mode}: {version}")
+        return self._versions[mode][version]
+
+    def generation_config(self, mode: str, version: Optional[str] = None) -> Dict[str, Any]:
+        """Параметры генерации режима (max_output_tokens и т.п.)"""
+        return dict(self.get(mode, version).generation_config)
+
+    def select_version(self, mode: str) -> str:
+        """Версия для нового запроса: живая или, с долей PROMPT_EXPERIMENT_SHARE, экспериментальная"""
+        experiment = self._experiments.get(mode)
+        if experiment and random.random() < PROMPT_EXPERIMENT_SHARE:
+            return experiment
+        return self._live[mode]
+
+    def _build_template(self, mode: str, version: str, image_count: int, occasion: str,
+                        collage: bool = False, ranking: bool = False) -> str:
+        template = self.get(mode, version).builder(occasion, image_count)
+        if collage:
+            template = _COLLAGE_NOTE.format(image_count=image_count) + template
+        if ranking:
+            template += _RANKING_NOTE.format(image_count=image_count)
+        return template
+
+    def render(self, mode: str, occasion: str, preferences: Optional[str] = None,
+               image_count: int = 1, version: Optional[str] = None, collage: bool = False,
+               ranking: bool = False) -> RenderedPrompt:
+        """
+        Промпт для запроса; шаблон берется из памяти по (режим, версия, число
+        изображений, повод, коллаж, рейтинг). collage - image_count образов на
+        одном изображении-коллаже, ranking - ответ заканчивается строкой
+        RANKING_LINE_PREFIX с номерами образов от лучшего к худшему.
+        """
+        version = version or self.select_version(mode)
+        prompt = self.get(mode, version)
+        template = self._template(mode, version, image_count, occasion, collage, ranking)
+        text = template.replace(_PREFERENCES_SLOT, prompt.format_preferences(preferences))
+        return RenderedPrompt(mode, version, text, prompt.generation_config)
+
+    def record_call(self, mode: str, version: str, latency: Optional[float] = None,
+                    input_tokens: Optional[int] = None, output_tokens: Optional[int] = None,
+                    success: bool = True) -> None:
+        """Учесть вызов Gemini по версии промпта"""
+        with self._lock:
+            stats = self._stats.setdefault((mode, version), _VersionStats())
+            stats.calls += 1
+            if not success:
+                stats.failures += 1
+                return
+            if latency is not None:
+                stats.latencies.append(latency)
+            if input_tokens is not None or output_tokens is not None:
+                stats.calls_with_usage += 1
+                stats.input_tokens += input_tokens or 0
+                stats.output_tokens += output_tokens or 0
+
+    def report(self) -> Dict[str, Any]:
+        """Сравнение стоимости версий: токены и задержка на вызов"""
+        modes = {}
+        for mode, versions in self._versions.items():
+            rows = {}
+            for version, prompt in versions.items():
+                stats = self._stats.get((mode, version), _VersionStats())
+                usage_calls = stats.calls_with_usage
+                p50 = stats.percentile(50)
+                p95 = stats.percentile(95)
+                rows[version] = {
+                    'live': version == self._live[mode],
+                    'experiment': version == self._experiments.get(mode),
+                    'description': prompt.description,
+                    'template_chars': len(self._template(mode, version, 2 if mode.startswith('compare') else 1, 'повседневный')),
+                    'max_output_tokens': prompt.generation_config.get('max_output_tokens'),
+                    'calls': stats.calls,
+                    'failures': stats.failures,
+                    'avg_input_tokens': round(stats.input_tokens / usage_calls, 1) if usage_calls else None,
+                    'avg_output_tokens': round(stats.output_tokens / usage_calls, 1) if usage_calls else None,
+                    'total_input_tokens': stats.input_tokens,
+                    'total_output_tokens': stats.output_tokens,
+                    'p50_latency_ms': round(p50 * 1000) if p50 is not None else None,
+                    'p95_latency_ms': round(p95 * 1000) if p95 is not None else None
+                }
+            modes[mode] = rows
+        cache_info = self._template.cache_info()
+        return {
+            'live_versions': self.live_versions(),
+            'experiment_share': PROMPT_EXPERIMENT_SHARE,
+            'modes': modes,
+            'template_cache': {
+                'hits': cache_info.hits,
+                'misses': cache_info.misses,
+                'size': cache_info.currsize,
+                'max_size': cache_info.maxsize
+            }
+        }
+
+
+def usage_tokens(response: Any) -> tuple:
+    """(input_tokens, output_tokens) из usage_metadata ответа Gemini или (None, None)"""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return None, None
+    input_tokens = getattr(usage, 'prompt_token_count', None)
+    output_tokens = getattr(usage, 'candidates_token_count', None)
+    return input_tokens, output_tokens
+
+
+prompt_registry = PromptRegistry()
+
+prompt_registry.register(PromptVersion(
+    "analyze", "concise-2025-06-20", _concise_analysis, _concise_preferences,
+    {"temperature": 0.7, "max_output_tokens": 2048},
+    "Короткий промпт без метакомментариев"
+), live=True)
+prompt_registry.register(PromptVersion(
+    "analyze", "structured-2025-06-20", _structured_analysis, _structured_analysis_preferences,
+    {"temperature": 0.7, "max_output_tokens": 2048},
+    "Структурированный ответ с блоками и иконками"
+))
+prompt_registry.register(PromptVersion(
+    "compare", "concise-2025-06-20", _concise_comparison, _concise_preferences,
+    {"temperature": 0.7, "max_output_tokens": 4096},
+    "Короткий промпт сравнения без метакомментариев"
+), live=True)
+prompt_registry.register(PromptVersion(
+    "compare", "structured-2025-06-20", _structured_comparison, _structured_comparison_preferences,
+    {"temperature": 0.7, "max_output_tokens": 4096},
+    "Подробная структура по каждому образу с чек-листом"
+))
+prompt_registry.register(PromptVersion(
+    "outfit_card", "card-2026-10-17", _outfit_card, _no_preferences,
+    {"temperature": 0.3, "max_output_tokens": 400},
+    "Описание одного образа для сравнения веером (без повода, кэшируется по фото)"
+), live=True)
+prompt_registry.register(PromptVersion(
+    "compare_rank", "concise-2026-10-17", _concise_ranking, _concise_preferences,
+    {"temperature": 0.7, "max_output_tokens": 4096},
+    "Текстовое сравнение описаний образов (без изображений)"
+), live=True)
+prompt_registry.configure_from_env()
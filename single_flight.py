@@ -0,0 +1,95 @@
+"""
+🛬 МИШУРА - Single Flight
+Склейка одинаковых консультаций, которые выполняются одновременно
+
+Двойное нажатие в webapp и повторы из webapp/api.js присылают несколько
+одинаковых запросов подряд. Первый запрос (ведущий) списывает STcoins и
+вызывает Gemini, остальные ждут его результат и получают тот же ответ:
+одно списание и один вызов Gemini.
+
+Ключ - (telegram_id, хэш изображений, повод, пожелания, режим).
+Работа ведущего выполняется отдельной задачей: если ведущий клиент
+отключится, ожидающие все равно получат ответ.
+"""
+
+import asyncio
+import hashlib
+import logging
+from typing import Dict, Any, Awaitable, Callable, Hashable, Iterable, Optional, Tuple
+
+from advice_cache import normalize_text
+
+logger = logging.getLogger(__name__)
+
+
+def consultation_key(telegram_id: Any, images: Iterable[str], occasion: Optional[str],
+                     preferences: Optional[str], mode: str) -> str:
+    """
+    Ключ одинаковых консультаций.
+
+    Args:
+        telegram_id: Пользователь (у разных пользователей запросы не склеиваются)
+        images: Изображения запроса в base64, как пришли от клиента (строки; иначе TypeError)
+        occasion: Повод консультации
+        preferences: Пожелания пользователя
+        mode: Режим консультации (analyze/compare)
+    """
+    digest = hashlib.sha256()
+    for part in (mode, str(telegram_id), normalize_text(occasion), normalize_text(preferences)):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\x00')
+    for image in images:
+        # Только строки base64: bytes(int) из JSON выделил бы буфер произвольного размера
+        if not isinstance(image, str):
+            raise TypeError(f"Изображение консультации должно быть строкой base64, получено {type(image).__name__}")
+        digest.update(hashlib.sha256(image.encode('ascii', 'ignore')).digest())
+    return digest.hexdigest()
+
+
+class SingleFlight:
+    """🛬 Не больше одного выполнения на ключ; остальные вызовы ждут его результат"""
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+        self.counters = {
+            'leaders': 0,
+            'coalesced': 0
+        }
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Выполнить func для ключа или присоединиться к уже идущему выполнению.
+
+        Returns:
+            (результат, True если результат получен от другого запроса)
+
+        Исключение ведущего получают все ожидающие.
+        """
+        task = self._calls.get(key)
+        if task is not None:
+            self.counters['coalesced'] += 1
+            logger.info(f"🛬 Одинаковый запрос уже выполняется, ждем его результат ({key[:12] if isinstance(key, str) else key})")
+            return await asyncio.shield(task), True
+
+        task = asyncio.ensure_future(func())
+        self._calls[key] = task
+        self.counters['leaders'] += 1
+        task.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(task), False
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Результат мог никому не понадобиться (все клиенты отключились)
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug(f"🛬 Склеенный запрос завершился ошибкой: {task.exception()}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'in_flight': len(self._calls),
+            **self.counters
+        }
+
+
+# Глобальный экземпляр для консультаций
+consultation_flights = SingleFlight()
@@ -0,0 +1,340 @@
+"""
+🏆 МИШУРА - Tournament
+Турнирное сравнение больших наборов образов (до TOURNAMENT_MAX_IMAGES)
+
+Одно сравнение Gemini надежно разбирает не больше 4 образов, поэтому набор
+проходит раунды групповых сравнений (compare_clothing_images):
+- образы раунда раздаются по группам до 4 (по кругу, группы почти равны)
+- из группы в следующий раунд проходит верхняя половина (2 из 4, 2 из 3, 1 из 2)
+- при посеве следующего раунда прошедшие из одной группы разводятся по разным
+- когда осталось не больше 4 образов, финал ранжирует их полностью
+12 образов: 3 группы по 4 -> 2 группы по 3 -> финал из 4, всего 6 сравнений.
+
+Сравнения раунда идут параллельно; одновременность ограничивает лимитер
+Gemini (каждое сравнение - обычный вызов). Каждое сравнение заканчивается
+строкой рейтинга (РЕЙТИНГ: 2, 1, 3); из нее в tournament_memo попадают
+попарные исходы. Ответ без полного рейтинга группы повторяется один раз
+мимо кэша советов; если и повтор без рейтинга, турнир завершается ошибкой
+(с возвратом средств), а не порядком, которого Gemini не давал. Группа, все пары которой уже известны и дают
+непротиворечивый порядок, ранжируется без вызова Gemini (кроме финала:
+его разбор - итоговый совет пользователю). Внутри группы
+образы упорядочены по хэшу, поэтому одинаковая группа дает одинаковый
+запрос и попадает в кэш советов.
+
+Итоговый рейтинг: финалисты по месту в финале, затем выбывшие по раундам
+(позже выбывшие выше), внутри раунда - по месту в группе.
+
+Стоимость - TOURNAMENT_MATCH_PRICE STcoins за каждое сравнение, ушедшее в
+compare_clothing_images (повтор не оплачивается); сравнения, разрешенные по
+памяти исходов, бесплатны.
+"""
+
+import os
+import re
+import math
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, AsyncIterator, Tuple
+
+from advice_cache import normalize_text
+from deadline import Deadline, within
+from gemini_usage import STATUS_SUCCESS, STATUS_ERROR, STATUS_TIMEOUT, STATUS_CANCELLED
+from prompt_registry import RANKING_LINE_PREFIX
+
+logger = logging.getLogger(__name__)
+
+TOURNAMENT_MAX_IMAGES = int(os.getenv('TOURNAMENT_MAX_IMAGES', 12))
+TOURNAMENT_MATCH_PRICE = int(os.getenv('TOURNAMENT_MATCH_PRICE', 10))
+TOURNAMENT_TIMEOUT = float(os.getenv('TOURNAMENT_TIMEOUT', 180))
+# Вид групповых сравнений: fanout описывает каждый образ один раз на весь турнир
+TOURNAMENT_LAYOUT = os.getenv('TOURNAMENT_LAYOUT', 'fanout')
+TOURNAMENT_MEMO_SIZE = int(os.getenv('TOURNAMENT_MEMO_SIZE', 4096))
+
+GROUP_SIZE = 4
+
+class TournamentRankingError(RuntimeError):
+    """Gemini не дал полного рейтинга группы и после повтора"""
+
+
+_RANKING_LINE = re.compile(rf'^[\s*_#>]*{RANKING_LINE_PREFIX}(.*)$', re.IGNORECASE | re.MULTILINE)
+
+
+def group_sizes(count: int) -> List[int]:
+    """Размеры групп раунда: минимум групп до GROUP_SIZE, размеры отличаются не больше чем на 1"""
+    groups = math.ceil(count / GROUP_SIZE)
+    return [count // groups + (1 if index < count % groups else 0) for index in range(groups)]
+
+
+def advancing_count(size: int) -> int:
+    return math.ceil(size / 2)
+
+
+def plan_tournament(count: int) -> List[List[int]]:
+    """Размеры групп по раундам; последний раунд - финал из одной группы"""
+    rounds = []
+    while count > GROUP_SIZE:
+        sizes = group_sizes(count)
+        rounds.append(sizes)
+        count = sum(advancing_count(size) for size in sizes)
+    rounds.append([count])
+    return rounds
+
+
+def planned_matches(count: int) -> int:
+    return sum(len(sizes) for sizes in plan_tournament(count))
+
+
+def tournament_price(matches: int) -> int:
+    return matches * TOURNAMENT_MATCH_PRICE
+
+
+def parse_ranking(text: str, count: int) -> Optional[List[int]]:
+    """
+    Позиции (с 0) от лучшего образа к худшему из последней строки рейтинга.
+
+    Неизвестные и повторные номера пропускаются; возвращаются только
+    названные образы (рейтинг может быть неполным). Без строки рейтинга - None.
+    """
+    matches = _RANKING_LINE.findall(text or "")
+    if not matches:
+        return None
+    positions = []
+    for number in re.findall(r'\d+', matches[-1]):
+        position = int(number) - 1
+        if 0 <= position < count and position not in positions:
+            positions.append(position)
+    return positions or None
+
+
+def strip_ranking_line(text: str) -> str:
+    """Совет без служебной строки рейтинга"""
+    return _RANKING_LINE.sub('', text or '').strip()
+
+
+class PairwiseMemo:
+    """
+    🧠 Память попарных исходов турнирных сравнений
+
+    Ключ - (повод, пожелания, хэши пары); значение - хэш победителя.
+    Ограничена TOURNAMENT_MEMO_SIZE парами (вытесняются давно не нужные).
+    """
+
+    def __init__(self, max_size: int = TOURNAMENT_MEMO_SIZE):
+        self.max_size = max_size
+        self._pairs: "OrderedDict[Tuple[str, str, str, str], str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.resolved = 0
+        self.recorded = 0
+
+    @staticmethod
+    def _key(context: Tuple[str, str], first: str, second: str) -> Tuple[str, str, str, str]:
+        low, high = sorted((first, second))
+        return (*context, low, high)
+
+    def record(self, context: Tuple[str, str], ranking: List[str]) -> None:
+        """Запомнить все пары рейтинга группы (ranking - хэши от лучшего к худшему)"""
+        with self._lock:
+            for index, winner in enumerate(ranking):
+                for loser in ranking[index + 1:]:
+                    if winner == loser:
+                        continue
+                    key = self._key(context, winner, loser)
+                    self._pairs[key] = winner
+                    self._pairs.move_to_end(key)
+                    self.recorded += 1
+            while len(self._pairs) > self.max_size:
+                self._pairs.popitem(last=False)
+
+    def resolve(self, context: Tuple[str, str], hashes: List[str]) -> Optional[List[int]]:
+        """
+        Позиции группы от лучшего к худшему, если все пары известны и дают
+        строгий порядок (без циклов и одинаковых образов); иначе None.
+        """
+        wins = [0] * len(hashes)
+        with self._lock:
+            for first in range(len(hashes)):
+                for second in range(first + 1, len(hashes)):
+                    winner = self._pairs.get(self._key(context, hashes[first], hashes[second]))
+                    if winner is None or hashes[first] == hashes[second]:
+                        return None
+                    wins[first if winner == hashes[first] else second] += 1
+        if sorted(wins) != list(range(len(hashes))):
+            return None
+        self.resolved += 1
+        return sorted(range(len(hashes)), key=lambda position: -wins[position])
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'pairs': len(self._pairs),
+            'max_size': self.max_size,
+            'recorded': self.recorded,
+            'resolved_groups': self.resolved
+        }
+
+
+# Глобальная память исходов процесса
+tournament_memo = PairwiseMemo()
+
+
+class Tournament:
+    """🏆 Один турнир: раунды групповых сравнений и итоговый рейтинг"""
+
+    def __init__(self, gemini_ai, images: List[bytes], occasion: str, preferences: str,
+                 deadline: Optional[Deadline] = None, layout: str = TOURNAMENT_LAYOUT,
+                 memo: PairwiseMemo = tournament_memo):
+        if not 2 <= len(images) <= TOURNAMENT_MAX_IMAGES:
+            raise ValueError(f"Для турнира нужно от 2 до {TOURNAMENT_MAX_IMAGES} изображений")
+        self.gemini_ai = gemini_ai
+        self.images = images
+        self.occasion = occasion
+        self.preferences = preferences
+        self.deadline = deadline
+        self.layout = layout
+        self.memo = memo
+        self.context = (normalize_text(occasion), normalize_text(preferences))
+        self.hashes = [hashlib.sha256(image).hexdigest() for image in images]
+        self.rounds = plan_tournament(len(images))
+        # (meta, статус) каждого вызова compare_clothing_images - для учета расхода
+        self.calls: List[List[Any]] = []
+        # Сравнения, дошедшие до compare_clothing_images: (раунд, номер)
+        self.charged: set = set()
+        self.final_match: Optional[Dict[str, Any]] = None
+
+    @property
+    def planned_matches(self) -> int:
+        return sum(len(sizes) for sizes in self.rounds)
+
+    @property
+    def charged_matches(self) -> int:
+        """Сравнения, ушедшие в compare_clothing_images (за них берется плата; повтор - нет)"""
+        return len(self.charged)
+
+    async def _ranked_compare(self, round_number: int, match_number: int,
+                              ordered: List[int]) -> Tuple[str, List[int], str]:
+        """
+        Сравнение группы с полным рейтингом; ответ без него повторяется один раз мимо кэша советов.
+
+        Returns:
+            (совет, позиции от лучшего к худшему, источник: gemini/cache)
+        """
+        self.charged.add((round_number, match_number))
+        for attempt in range(2):
+            call = [{}, STATUS_CANCELLED]
+            self.calls.append(call)
+            try:
+                advice = await within(self.deadline, self.gemini_ai.compare_clothing_images(
+                    [self.images[index] for index in ordered], self.occasion, self.preferences,
+                    meta=call[0], deadline=self.deadline, layout=self.layout, ranking=True, refresh=attempt > 0
+                ), f"tournament_round_{round_number}")
+            except asyncio.CancelledError:
+                raise
+            except asyncio.TimeoutError:
+                call[1] = STATUS_TIMEOUT
+                raise
+            except Exception:
+                call[1] = STATUS_ERROR
+                raise
+            call[1] = STATUS_SUCCESS
+            positions = parse_ranking(advice, len(ordered))
+            if positions is not None and len(positions) == len(ordered):
+                return advice, positions, 'cache' if call[0].get('cache_hit') else 'gemini'
+            logger.warning(f"⚠️ Турнир: неполный рейтинг в сравнении {round_number}.{match_number} "
+                           f"({positions}), попытка {attempt + 1}")
+        raise TournamentRankingError(f"Нет полного рейтинга в сравнении {round_number}.{match_number}")
+
+    async def _match(self, round_number: int, match_number: int, entries: List[int],
+                     use_memo: bool = True) -> Dict[str, Any]:
+        """Групповое сравнение: entries - индексы изображений; рейтинг - индексы от лучшего к худшему"""
+        ordered = sorted(entries, key=lambda index: self.hashes[index])
+        hashes = [self.hashes[index] for index in ordered]
+        advice = None
+        positions = self.memo.resolve(self.context, hashes) if use_memo else None
+        if positions is not None:
+            source = 'memo'
+        else:
+            advice, positions, source = await self._ranked_compare(round_number, match_number, ordered)
+            # Только полный рейтинг, данный Gemini: каждая пара группы действительно сравнена
+            self.memo.record(self.context, [hashes[position] for position in positions])
+            advice = strip_ranking_line(advice)
+        return {
+            'round': round_number,
+            'match': match_number,
+            'entries': [index + 1 for index in ordered],
+            'ranking': [ordered[position] for position in positions],
+            'source': source,
+            'advice': advice
+        }
+
+    async def _play_round(self, round_number: int, groups: List[List[int]]) -> AsyncIterator[Dict[str, Any]]:
+        """Сравнения раунда параллельно; результаты - по мере готовности. Ошибка одного отменяет остальные"""
+        final = round_number == len(self.rounds)
+        tasks = [asyncio.create_task(self._match(round_number, number, group, use_memo=not final))
+                 for number, group in enumerate(groups, 1)]
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                yield await next_result
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _final_advice(self, standings: List[int]) -> str:
+        lines = [f"🏆 Итоговый рейтинг {len(standings)} образов для повода «{self.occasion}»:"]
+        lines += [f"{place}. Образ №{index + 1}" for place, index in enumerate(standings, 1)]
+        final = self.final_match
+        if final and final['advice']:
+            legend = ", ".join(f"{number} — №{entry}" for number, entry in enumerate(final['entries'], 1))
+            lines += ["", f"Разбор финала (образы финала: {legend}):", "", final['advice']]
+        return "\n".join(lines)
+
+    async def run(self) -> AsyncIterator[Dict[str, Any]]:
+        """
+        События турнира: plan, match (каждое групповое сравнение), round
+        (прошедшие дальше) и result (итоговый рейтинг и совет).
+        Номера образов в событиях - с 1, в порядке загрузки.
+        """
+        yield {
+            'type': 'plan',
+            'entries': len(self.images),
+            'rounds': [len(sizes) for sizes in self.rounds],
+            'matches': self.planned_matches
+        }
+        entries = list(range(len(self.images)))
+        eliminated: List[List[int]] = []
+        standings: List[int] = []
+        for round_number, sizes in enumerate(self.rounds, 1):
+            group_count = len(sizes)
+            groups = [entries[number::group_count] for number in range(group_count)]
+            results = []
+            async for result in self._play_round(round_number, groups):
+                results.append(result)
+                yield {'type': 'match', **{key: value for key, value in result.items() if key != 'advice'},
+                       'ranking': [index + 1 for index in result['ranking']]}
+            results.sort(key=lambda result: result['match'])
+
+            if round_number == len(self.rounds):
+                self.final_match = results[0]
+                standings = results[0]['ranking']
+                break
+            # Посев: сначала победители групп, затем вторые места - раздача по кругу разводит соседей по группе
+            advancing, dropped = [], []
+            for result in results:
+                cut = advancing_count(len(result['ranking']))
+                advancing += [(place, result['match'], index) for place, index in enumerate(result['ranking'][:cut])]
+                dropped += [(place, result['match'], index) for place, index in enumerate(result['ranking'][cut:])]
+            entries = [index for _, _, index in sorted(advancing)]
+            eliminated.append([index for _, _, index in sorted(dropped)])
+            yield {'type': 'round', 'round': round_number, 'advancing': [index + 1 for index in entries]}
+
+        for dropped in reversed(eliminated):
+            standings = standings + dropped
+        yield {
+            'type': 'result',
+            'ranking': [index + 1 for index in standings],
+            'advice': self._final_advice(standings),
+            'matches': self.planned_matches,
+            'charged_matches': self.charged_matches
+        }
@@ -0,0 +1,116 @@
+"""
+🔥 МИШУРА - Warm-up
+Прогрев после деплоя или пробуждения сервиса
+
+Первая консультация после старта платила за ленивую инициализацию:
+загрузку плагинов PIL, запуск процессов пула изображений, создание
+клиентов Gemini и gRPC-канала, первое подключение к БД. Прогрев выполняет
+все это в фоне сразу после старта:
+
+- pil         - регистрация плагинов и первое кодирование JPEG/PNG
+- image_pool  - запуск процессов пула обработки изображений
+- database    - первое подключение и пробный запрос
+- gemini      - модели и клиенты всех ключей, открытые gRPC-каналы (без расхода квоты)
+
+Пока прогрев не завершен, /api/v1/ready отвечает 503; время каждой стадии
+попадает в отчет. Ошибка стадии не блокирует готовность - она записывается
+в отчет, а инициализация произойдет лениво, как раньше.
+"""
+
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, Any, Optional, Callable, Awaitable
+
+from image_processing import image_pool, warm_up_codecs
+
+logger = logging.getLogger(__name__)
+
+WARMUP_ENABLED = os.getenv('WARMUP_ENABLED', 'true').lower() == 'true'
+WARMUP_CHANNEL_TIMEOUT = float(os.getenv('WARMUP_CHANNEL_TIMEOUT', 5))
+
+
+def _ping_database(db) -> None:
+    """Первое подключение (SQLite-файл или PostgreSQL с TLS) и пробный запрос"""
+    db._execute_query("SELECT 1", fetch_one=True)
+
+
+class WarmUp:
+    """🔥 Фоновый прогрев и признак готовности процесса"""
+
+    def __init__(self, enabled: bool = WARMUP_ENABLED):
+        self.enabled = enabled
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._done = asyncio.Event()
+
+    @property
+    def ready(self) -> bool:
+        return self._done.is_set()
+
+    async def _stage(self, name: str, func: Callable[[], Awaitable[Any]]) -> None:
+        started = time.monotonic()
+        try:
+            details = await func()
+            self.stages[name] = {'status': 'ok', 'ms': round((time.monotonic() - started) * 1000, 1)}
+            if details:
+                self.stages[name]['details'] = details
+        except Exception as e:
+            self.stages[name] = {'status': 'error', 'ms': round((time.monotonic() - started) * 1000, 1),
+                                 'error': str(e)}
+            logger.warning(f"⚠️ Прогрев {name} не удался: {e}")
+
+    async def _run(self, db, gemini_ai) -> None:
+        try:
+            await self._stage('pil', lambda: asyncio.to_thread(warm_up_codecs))
+            # Процессы пула, БД и Gemini прогреваются параллельно
+            stages = [self._stage('image_pool', image_pool.warm_up)]
+            if db is not None:
+                stages.append(self._stage('database', lambda: asyncio.to_thread(_ping_database, db)))
+            if gemini_ai is not None:
+                stages.append(self._stage('gemini', lambda: gemini_ai.warm_up(WARMUP_CHANNEL_TIMEOUT)))
+            await asyncio.gather(*stages)
+        finally:
+            self.finished_at = time.monotonic()
+            self._done.set()
+            logger.info(f"🔥 Прогрев завершен за {self.finished_at - self.started_at:.2f} с: "
+                        f"{ {name: stage['status'] for name, stage in self.stages.items()} }")
+
+    def start(self, db=None, gemini_ai=None) -> None:
+        """Запустить прогрев в фоне (в lifespan, после инициализации сервисов)"""
+        self.started_at = time.monotonic()
+        if not self.enabled:
+            self.finished_at = self.started_at
+            self._done.set()
+            return
+        self._task = asyncio.get_running_loop().create_task(self._run(db, gemini_ai))
+
+    async def wait(self, timeout: Optional[float] = None) -> bool:
+        try:
+            await asyncio.wait_for(self._done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.ready
+
+    async def stop(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        elapsed = None
+        if self.started_at is not None:
+            elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        return {
+            'enabled': self.enabled,
+            'ready': self.ready,
+            'total_ms': round(elapsed * 1000, 1) if elapsed is not None else None,
+            'stages': dict(self.stages)
+        }
+
+
+# Глобальный прогрев процесса
+warm_up = WarmUp()
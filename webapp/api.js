@@ -339,6 +339,75 @@ class MishuraAPIService {
         }
     }
 
+    // 📡 Потоковая консультация (SSE поверх POST): onChunk получает текст по мере генерации,
+    // результат - итоговое событие done (тот же формат, что у обычного endpoint)
+    async streamConsultation(endpoint, requestData, onChunk = () => {}) {
+        const controller = new AbortController();
+        const timeoutId = setTimeout(() => controller.abort(), this.timeout);
+
+        try {
+            const response = await fetch(`${this.baseURL}${endpoint}`, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'Accept': 'text/event-stream',
+                    'X-Requested-With': 'XMLHttpRequest'
+                },
+                body: JSON.stringify(requestData),
+                signal: controller.signal
+            });
+
+            if (!response.ok) {
+                let errorDetail = null;
+                try {
+                    errorDetail = (await response.json())?.detail || null;
+                } catch (_) {}
+                const err = new Error(errorDetail ? `HTTP ${response.status}: ${errorDetail}` : `HTTP ${response.status}: ${response.statusText}`);
+                err.status = response.status;
+                if (errorDetail) err.detail = errorDetail;
+                throw err;
+            }
+
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+
+                let boundary;
+                while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                    const rawEvent = buffer.slice(0, boundary);
+                    buffer = buffer.slice(boundary + 2);
+                    if (!rawEvent.startsWith('data: ')) continue;
+
+                    const event = JSON.parse(rawEvent.slice(6));
+                    if (event.type === 'chunk') {
+                        onChunk(event.text);
+                    } else if (event.type === 'done') {
+                        return event;
+                    } else if (event.type === 'error') {
+                        const err = new Error(`HTTP ${event.status_code}: ${event.detail}`);
+                        err.status = event.status_code;
+                        err.detail = event.detail;
+                        throw err;
+                    }
+                }
+            }
+
+            throw new Error('Поток завершился без итогового ответа');
+        } catch (error) {
+            if (error.name === 'AbortError') {
+                throw new Error(`Timeout: запрос превысил ${this.timeout}ms`);
+            }
+            throw error;
+        } finally {
+            clearTimeout(timeoutId);
+        }
+    }
+
     // Вспомогательная функция для конвертации файла в base64
     async fileToBase64(file) {
         return new Promise((resolve, reject) => {